@@ -1,10 +1,11 @@
 import os
-import intelhex
 import logging
-import struct
+import time
+from typing import Callable
 
 import HciSerialPort as hci
 import hci.command as hci_cmd
+from hci_image_cache import HciImageCache
 from ifx_firmware_cfg import ifx_firmware_cfg
 
 
@@ -20,18 +21,22 @@ class HciProgrammer():
                  port: str = '',
                  baud_rate: int = 0,
                  chip_erase: bool = False,
-                 fw_cfg: ifx_firmware_cfg = None):
+                 fw_cfg: ifx_firmware_cfg = None,
+                 image_cache: HciImageCache = None):
         self.mini_driver_path = mini_driver
         self.hci_port = hci.HciSerialPort()
         self.com_port = port
         self.baud_rate = baud_rate
         self.chip_erase_enable = chip_erase
         self.fw_cfg = fw_cfg
+        self.image_cache = image_cache if image_cache is not None else HciImageCache()
+        self.timings = {}
 
     def __load_hex_file(self,
                         file_path: str,
                         max_packet_size: int = hci.HciSerialPort.WRITE_RAM_MAX_SIZE) -> list[tuple[int, bytes]]:
-        """Loads an Intel HEX file and splits it into packets for writing to memory
+        """Loads an Intel HEX file split into packets for writing to memory.
+        Parsed images are served from the image cache.
 
         Args:
             file_path (str): hex file path
@@ -40,20 +45,7 @@ class HciProgrammer():
         Returns:
             list[tuple[int, bytes]]: List of tuples containing address and data packets
         """
-
-        ih = intelhex.IntelHex(file_path)
-        packets = []  # list of (start_address, bytes)
-
-        # Each (start, end) defines a contiguous address segment
-        for seg_start, seg_end in ih.segments():  # seg_end is exclusive
-            buf = bytearray(ih.tobinarray(start=seg_start, end=seg_end-1))
-
-            # Slice into packets of up to 240 bytes — no padding
-            for offset in range(0, len(buf), max_packet_size):
-                chunk = bytes(buf[offset:offset + max_packet_size])
-                packets.append((seg_start + offset, chunk))
-
-        return packets
+        return self.image_cache.load_hex(file_path, max_packet_size).packets
 
     def __load_mini_driver(self):
         """Loads the mini driver into RAM to provide chip erase, change baud and CRC functions
@@ -74,8 +66,9 @@ class HciProgrammer():
              port: str,
              baud_rate: int,
              chip_erase: bool = False,
-             fw_cfg: ifx_firmware_cfg = None):
-        self.__init__(mini_driver, port, baud_rate, chip_erase, fw_cfg)
+             fw_cfg: ifx_firmware_cfg = None,
+             image_cache: HciImageCache = None):
+        self.__init__(mini_driver, port, baud_rate, chip_erase, fw_cfg, image_cache)
 
     def open_com_init_mini_driver(self):
         """Open the HCI port and load the mini driver
@@ -101,8 +94,12 @@ class HciProgrammer():
                          file_path: str | None = None,
                          chip_erase_enable: bool = False,
                          fw_cfg: ifx_firmware_cfg = None,
-                         verify: bool = False):
-        """Program the firmware file
+                         verify: bool = False,
+                         progress: Callable[[int, int], None] = None):
+        """Program the firmware file.
+        Time spent in each phase (open: opening the HCI port for HCD files,
+        minidriver: opening the port and loading the minidriver for hex files,
+        erase, write, verify) is stored in self.timings.
 
         Args:
             baud_rate (int): Baud rate to program the firmware at
@@ -110,6 +107,8 @@ class HciProgrammer():
             chip_erase_enable (bool): Enable chip erase before programming
             fw_cfg (ifx_firmware_cfg): Firmware configuration parameters
             verify (bool): Verify firmware while flashing with CRC checks
+            progress (Callable[[int, int], None], optional): Called with (bytes written, total bytes)
+                while programming. Defaults to None.
 
         Raises:
             Exception: raise exception on error
@@ -121,6 +120,7 @@ class HciProgrammer():
         if fw_cfg is not None:
             self.fw_cfg = fw_cfg
 
+        self.timings = {'open': 0.0, 'minidriver': 0.0, 'erase': 0.0, 'write': 0.0, 'verify': 0.0}
         is_hex = False
 
         if file_path:
@@ -135,6 +135,7 @@ class HciProgrammer():
                 raise Exception('Invalid file extension, must be .hex or .hcd')
 
         minidriver_loaded = False
+        phase_start = time.monotonic()
         if chip_erase_enable or file_path:
             if is_hex or file_path is None:
                 logging.info('Loading minidriver...')
@@ -147,10 +148,13 @@ class HciProgrammer():
         else:
             logging.info('No firmware or chip erase specified, exiting')
             return
+        self.timings['minidriver' if minidriver_loaded else 'open'] = time.monotonic() - phase_start
 
         if chip_erase_enable:
             if minidriver_loaded:
+                phase_start = time.monotonic()
                 self.chip_erase()
+                self.timings['erase'] = time.monotonic() - phase_start
             else:
                 logging.warning(
                     'Chip erase requested but mini driver not loaded, skipping chip erase')
@@ -160,48 +164,39 @@ class HciProgrammer():
                 logging.info(f'Changing baud to {baud_rate}')
                 self.hci_port.change_baud_rate(baud_rate)
 
+            phase_start = time.monotonic()
             if is_hex:
                 hex_packets = self.__load_hex_file(file_path)
                 total_bytes = sum(len(data) for addr, data in hex_packets)
                 logging.info(f'Programming firmware... ({total_bytes} bytes)')
-                self.hci_port.write_ram(hex_packets, verify=verify)
+                self.timings['verify'] = self.hci_port.write_ram(
+                    hex_packets, verify=verify, progress=progress)
                 self.hci_port.send_launch_ram(
                     self.fw_cfg.launch_firmware_addr, delay=self.fw_cfg.load_addr_delay)
             else:
                 logging.info('Programming HCD file...')
                 if verify:
                     logging.warning('Verify option ignored for HCD files')
-                # Read in file_path as binary
                 # HCD file format is a series of HCI commands to be sent to the device
-                firmware_bin = []
-                with open(file_path, 'rb') as f:
-                    firmware_bin = f.read()
-
+                hcd_commands = self.image_cache.load_hcd(file_path)
+                header_size = HciImageCache.HCD_HEADER.size
                 data_index = 0
-                total_bytes = remaining_bytes = len(firmware_bin)
-
-                while remaining_bytes > 0:
-                    # Each HCD command packet starts with a 3-byte header:
-                    #   2 bytes: opcode (little-endian)
-                    #   1 byte: payload length
-                    # followed by payload_len bytes of payload data
-                    header_format = '<HB'
-                    header_size = struct.calcsize(header_format)
-                    cmd_opcode, payload_len = struct.unpack_from(
-                        header_format, firmware_bin, data_index)
-                    payload_start = data_index + header_size
-                    data_len = payload_len + header_size
+                total_bytes = sum(header_size + len(payload) for opcode, payload in hcd_commands)
+
+                for cmd_opcode, payload in hcd_commands:
                     opcode_str = f'0x{cmd_opcode:04X}'
                     logging.debug(f'Write HCD cmd {opcode_str}')
-                    (success, payload) = self.hci_port.send_command_wait_response(hci_cmd.CommandPacket(
-                        cmd_opcode, firmware_bin[payload_start: (payload_start + payload_len)]))
+                    (success, _) = self.hci_port.send_command_wait_response(
+                        hci_cmd.CommandPacket(cmd_opcode, payload))
                     if not success:
                         raise Exception(
                             f'No response for {opcode_str} at index {data_index}')
-                    data_index += data_len
-                    remaining_bytes -= data_len
+                    data_index += header_size + len(payload)
                     logging.debug(
                         f'HCD progress: {data_index}/{total_bytes} ({round(data_index/total_bytes*100, 1)}%)')
+                    if progress:
+                        progress(data_index, total_bytes)
 
+            self.timings['write'] = time.monotonic() - phase_start - self.timings['verify']
             logging.info('Finished programming!')
         self.hci_port.close()
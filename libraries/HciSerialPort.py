@@ -1,20 +1,54 @@
+import os
 import time
 import serial
 import threading
-import queue
+import collections
 import zlib
 import hci
 import hci.command
 import hci.event
 import logging
+from typing import Callable
+from hci_btsnoop import BtsnoopRecorder
+
+
+class HciPendingCommand():
+    """Response slot for an HCI command waiting for its Command Complete/Status event
+    """
+
+    def __init__(self, opcode: int):
+        self.opcode = opcode
+        self.response = None
+        self._done = threading.Event()
+
+    def set_response(self, pkt: hci.HciPacket):
+        self.response = pkt
+        self._done.set()
+
+    def wait(self, timeout: float) -> hci.HciPacket | None:
+        """Wait for the response packet
+
+        Args:
+            timeout (float): Time to wait in seconds
+
+        Returns:
+            hci.HciPacket | None: response packet or None on timeout
+        """
+        self._done.wait(timeout)
+        return self.response
 
 
 class HciSerialPort():
     """Serial port implementation to communicate with Infineon Bluetooth HCI devices
+
+    Received HCI events are routed as they arrive. Command Complete and Command Status
+    events resolve the pending command with the same opcode. All other events are passed
+    to the handlers registered for their event code, or buffered per event code until
+    read with wait_event() or get_events().
     """
     ROBOT_LIBRARY_SCOPE = 'TEST SUITE'
 
-    CLEAR_QUEUE_TIMEOUT = 0.1
+    EVENT_BUFFER_SIZE = 64
     WRITE_RAM_MAX_SIZE = 240
 
     OPCODE_DOWNLOAD_MINIDRIVER = 0xFC2E
@@ -32,52 +66,62 @@ class HciSerialPort():
     SERIAL_PORT_RX_TIMEOUT_SECS = 0.0006076 # Based on 7 bytes at 115200 baud (a full HCI command complete event)
     SERIAL_PORT_RX_SIZE_BYTES = 1024
 
+    # When set, every opened port records a btsnoop capture to this directory
+    BTSNOOP_DIR_ENV = 'HCI_BTSNOOP_DIR'
+
     def __init__(self):
         self.port = None
         self.rx_bytes = []
-        self.rx_queue = None
         self.stop_threads = False
-        self.queue_monitor_event = threading.Event()
+        self._router_lock = threading.Condition()
+        self._pending_commands = {}
+        self._event_handlers = {}
+        self._event_buffers = {}
+        self.btsnoop = None
 
-    def __queue_monitor(self):
-        last_len = 0
-        curr_len = 0
-        if not self.rx_queue:
-            raise Exception('RX queue is NULL')
-        while True:
-            if self.stop_threads:
-                break
-            self.queue_monitor_event.wait()
-            if not self.rx_queue.empty():
-                curr_len = self.rx_queue.qsize()
-                if curr_len == last_len:
-                    logging.debug(
-                        f'Clear RX queue ({curr_len})')
-                    res = True
-                    while res:
-                        try:
-                            # TODO: Instead of clearing the queue, see if a packet can be parsed and fire an event
-                            res = self.rx_queue.get(False)
-                            logging.debug(
-                                f'Unhandled pkt: {res.binary.hex(",")}')
-                        except:
-                            break
-                    self.clear_rx_queue()
-
-                else:
-                    logging.debug(f'RX queue len: {curr_len}')
-                last_len = curr_len
-            time.sleep(self.CLEAR_QUEUE_TIMEOUT)
-
-    def __pause_queue_monitor(self):
-        self.queue_monitor_event.clear()
-
-    def __resume_queue_monitor(self):
-        self.queue_monitor_event.set()
+    @staticmethod
+    def __command_response_opcode(pkt: hci.HciPacket) -> int | None:
+        """Get the opcode a Command Complete/Status event responds to
+
+        Returns:
+            int | None: opcode or None if the packet is not a command response
+        """
+        if not isinstance(pkt, hci.event.EventPacket):
+            return None
+        if pkt.event_code == hci.event.EventCodes.HCI_COMMAND_COMPLETE:
+            return int.from_bytes(pkt.binary[4:6], HciSerialPort.LITTLE_ENDIAN)
+        if pkt.event_code == hci.event.EventCodes.COMMAND_STATUS:
+            return int.from_bytes(pkt.binary[5:7], HciSerialPort.LITTLE_ENDIAN)
+        return None
+
+    def __route_packet(self, pkt: hci.HciPacket):
+        opcode = self.__command_response_opcode(pkt)
+        with self._router_lock:
+            pending = self._pending_commands.pop(opcode, None) if opcode is not None else None
+            if pending is None:
+                if not isinstance(pkt, hci.event.EventPacket):
+                    logging.debug(f'Unhandled pkt: {pkt.binary.hex(",")}')
+                    return
+                handlers = list(self._event_handlers.get(pkt.event_code, []))
+                if not handlers:
+                    buffer = self._event_buffers.setdefault(
+                        pkt.event_code, collections.deque(maxlen=self.EVENT_BUFFER_SIZE))
+                    if len(buffer) == buffer.maxlen:
+                        logging.debug(f'Event buffer 0x{pkt.event_code:02X} full, dropping oldest event')
+                    buffer.append(pkt)
+                    self._router_lock.notify_all()
+        if pending is not None:
+            pending.set_response(pkt)
+            return
+        for handler in handlers:
+            try:
+                handler(pkt)
+            except Exception as e:
+                logging.warning(f'Event handler for 0x{pkt.event_code:02X} failed: {e}')
 
     def __serial_port_rx_thread(self):
         self.rx_bytes.clear()
-        if not self.rx_queue or not self.port:
+        if not self.port:
             raise Exception('Null object')
         while True:
             if self.stop_threads:
@@ -87,13 +131,17 @@ class HciSerialPort():
                     self.SERIAL_PORT_RX_SIZE_BYTES))
                 packets, unprocessed = hci.from_binary(
                     bytearray(self.rx_bytes))
-                if len(packets) > 0 and len(unprocessed) > 0:
-                    self.rx_bytes.clear()
-                    self.rx_bytes.extend(unprocessed)
+                if len(packets) > 0:
+                    # Keep the start of a partially received packet for the next read
+                    self.rx_bytes[:] = unprocessed
+                # stop_btsnoop() may clear the attribute at any time
+                recorder = self.btsnoop
                 for pkt in packets:
-                    logging.debug(f'RX {pkt.binary.hex(" ").upper()}')
-                    self.rx_queue.put(pkt)
-                    self.rx_bytes.clear()
+                    if recorder:
+                        recorder.record(pkt.binary, True)
+                    if logging.root.isEnabledFor(logging.DEBUG):
+                        logging.debug(f'RX {pkt.binary.hex(" ").upper()}')
+                    self.__route_packet(pkt)
             except Exception as e:
                 # logging.warning(str(e))
                 if len(self.rx_bytes) > 0:
@@ -109,25 +157,31 @@ class HciSerialPort():
         resp_payload = None
         while not success and tries > 0:
             tries -= 1
-            self.__pause_queue_monitor()
-            self.clear_rx_queue()
-            logging.debug(f'TX {packet.binary.hex(" ").upper()}')
+            pending = HciPendingCommand(packet.opcode)
+            with self._router_lock:
+                self._pending_commands[packet.opcode] = pending
+            if logging.root.isEnabledFor(logging.DEBUG):
+                logging.debug(f'TX {packet.binary.hex(" ").upper()}')
             self.port.write(packet.binary)
-            try:
-                resp_pkt = self.rx_queue.get(True, timeout)
-                if resp_pkt.status != hci.event.HCI_CommandComplete.Status.HCI_SUCCESS \
-                        or packet.opcode != resp_pkt.opcode:
-                    success = False
-                    try:
-                        logging.warning(
-                            f'Invalid response\n{resp_pkt}')
-                    except:
-                        pass
-                else:
-                    success = True
-            except:
+            recorder = self.btsnoop
+            if recorder:
+                recorder.record(packet.binary, False)
+            resp_pkt = pending.wait(timeout)
+            with self._router_lock:
+                if self._pending_commands.get(packet.opcode) is pending:
+                    del self._pending_commands[packet.opcode]
+            if resp_pkt is None:
                 success = False
-            self.__resume_queue_monitor()
+            elif resp_pkt.event_code == hci.event.EventCodes.COMMAND_STATUS:
+                success = resp_pkt.binary[3] == hci.event.HCI_CommandComplete.Status.HCI_SUCCESS
+            else:
+                success = resp_pkt.binary[6] == hci.event.HCI_CommandComplete.Status.HCI_SUCCESS
+            if resp_pkt is not None and not success:
+                try:
+                    logging.warning(
+                        f'Invalid response\n{resp_pkt}')
+                except:
+                    pass
         if success:
             resp_len = resp_pkt.binary[2:3]
             resp_len = int.from_bytes(resp_len, self.LITTLE_ENDIAN)
@@ -135,6 +189,66 @@ class HciSerialPort():
                 resp_payload = resp_pkt.binary[7:]
         return (success, resp_payload)
 
+    def register_event_handler(self, event_code: int, handler: Callable[[hci.HciPacket], None]):
+        """Register a handler for an HCI event code. Handlers are called from the RX thread.
+        Events with a registered handler are not buffered.
+
+        Args:
+            event_code (int): HCI event code (e.g. hci.event.EventCodes.LE_EVENTS)
+            handler (Callable[[hci.HciPacket], None]): Called with each received event packet
+        """
+        with self._router_lock:
+            self._event_handlers.setdefault(event_code, []).append(handler)
+
+    def unregister_event_handler(self, event_code: int, handler: Callable[[hci.HciPacket], None]):
+        """Remove a handler registered with register_event_handler
+
+        Args:
+            event_code (int): HCI event code
+            handler (Callable[[hci.HciPacket], None]): handler to remove
+        """
+        with self._router_lock:
+            handlers = self._event_handlers.get(event_code, [])
+            if handler in handlers:
+                handlers.remove(handler)
+
+    def wait_event(self, event_code: int, timeout: float = 1) -> hci.HciPacket | None:
+        """Wait for and remove the oldest buffered event with the given event code
+
+        Args:
+            event_code (int): HCI event code
+            timeout (float, optional): Time to wait in seconds. Defaults to 1.
+
+        Returns:
+            hci.HciPacket | None: event packet or None on timeout
+        """
+        with self._router_lock:
+            self._router_lock.wait_for(lambda: self._event_buffers.get(event_code), timeout)
+            buffer = self._event_buffers.get(event_code)
+            if buffer:
+                return buffer.popleft()
+        return None
+
+    def get_events(self, event_code: int | None = None) -> list[hci.HciPacket]:
+        """Remove and return buffered events
+
+        Args:
+            event_code (int | None, optional): HCI event code, or None for all events. Defaults to None.
+
+        Returns:
+            list[hci.HciPacket]: buffered event packets, oldest first
+        """
+        with self._router_lock:
+            if event_code is not None:
+                buffer = self._event_buffers.get(event_code)
+                events = list(buffer) if buffer else []
+                if buffer:
+                    buffer.clear()
+            else:
+                events = [pkt for buffer in self._event_buffers.values() for pkt in buffer]
+                self._event_buffers.clear()
+        return events
+
     def __verify_crc(self, address: int, length: int) -> int:
         """Verify CRC command (Infineon Vendor Specific HCI command)
 
@@ -174,24 +288,22 @@ class HciSerialPort():
         self.port.timeout = self.SERIAL_PORT_RX_TIMEOUT_SECS
         self.port.reset_input_buffer()
         self.port.reset_output_buffer()
-        self.rx_queue = queue.Queue()
+        self.clear_rx_queue()
+        btsnoop_dir = os.environ.get(self.BTSNOOP_DIR_ENV)
+        if btsnoop_dir and self.btsnoop is None:
+            self.start_btsnoop(os.path.join(
+                btsnoop_dir, f'hci_{os.path.basename(portName)}.btsnoop'))
         self.stop_threads = False
-        # The serial port RX thread reads all bytes received and places them in a queue
+        # The serial port RX thread reads all bytes received and routes the HCI packets
         threading.Thread(target=self.__serial_port_rx_thread,
                          daemon=True).start()
-        # The queue monitor thread clears stray HCI messages if they are not processed for
-        # CLEAR_QUEUE_TIMEOUT amount of time
-        threading.Thread(target=self.__queue_monitor, daemon=True).start()
         return self.port
 
     def clear_rx_queue(self):
-        """Clear all received HCI messages from the queue
+        """Clear all buffered HCI events
         """
-        if self.rx_queue == None:
-            return
-        with self.rx_queue.mutex:
-            self.rx_queue.queue.clear()
-            self.rx_bytes.clear()
+        with self._router_lock:
+            self._event_buffers.clear()
 
     def send_hci_reset(self):
         """Send HCI reset and wait for response
@@ -214,16 +326,23 @@ class HciSerialPort():
         if not success:
             raise Exception('Failed download minidriver')
 
-    def write_ram(self, hex_packets: list[tuple[int, bytes]], verify: bool = False):
+    def write_ram(self, hex_packets: list[tuple[int, bytes]], verify: bool = False,
+                  progress: Callable[[int, int], None] = None) -> float:
         """Write all hex packets with Write RAM command (Infineon Vendor Specific HCI command)
 
         Args:
             hex_packets (list[tuple[int, bytes]]): List of tuples containing address and data bytes
             verify (bool, optional): Whether to verify each write operation. Defaults to False.
+            progress (Callable[[int, int], None], optional): Called with (bytes written, total bytes)
+                after each packet. Defaults to None.
+
+        Returns:
+            float: Time spent verifying CRCs in seconds
         """
 
         total_bytes = sum(len(data) for addr, data in hex_packets)
         bytes_written = 0
+        verify_time = 0.0
         for addr, data in hex_packets:
             data_len = len(data)
             addr_bytes = addr.to_bytes(4, self.LITTLE_ENDIAN)
@@ -236,10 +355,12 @@ class HciSerialPort():
             if success:
                 if verify:
                     # Verify CRC
+                    verify_start = time.monotonic()
                     data_crc = zlib.crc32(bytearray(data))
                     logging.debug(f'Data CRC: {hex(data_crc)}')
                     read_crc = self.__verify_crc(addr, data_len)
                     logging.debug(f'Read CRC: {hex(read_crc)}')
+                    verify_time += time.monotonic() - verify_start
                     if data_crc != read_crc:
                         raise Exception(
                             f'Write verification failed at {addr_str} length {data_len}, {hex(read_crc)} != {hex(data_crc)}')
@@ -247,8 +368,11 @@ class HciSerialPort():
                 bytes_written += data_len
                 logging.debug(
                     f'wrote {bytes_written}/{total_bytes} ({round(bytes_written/total_bytes*100, 1)}%)')
+                if progress:
+                    progress(bytes_written, total_bytes)
             else:
                 raise Exception(f'Failed to write to address {addr_str}')
+        return verify_time
 
     def send_launch_ram(self, address: int, delay: float = 0.25):
         """Launch RAM command (Infineon Vendor Specific HCI command)
@@ -327,9 +451,33 @@ class HciSerialPort():
         }
         return version_info
 
+    def start_btsnoop(self,
+                      file_path: str,
+                      max_file_size: int = BtsnoopRecorder.DEFAULT_MAX_FILE_SIZE,
+                      backup_count: int = BtsnoopRecorder.DEFAULT_BACKUP_COUNT):
+        """Record all HCI traffic to a btsnoop file that can be opened in Wireshark
+
+        Args:
+            file_path (str): capture file path
+            max_file_size (int, optional): Rotate the file when it exceeds this size in bytes.
+            backup_count (int, optional): Number of rotated files to keep.
+        """
+        self.stop_btsnoop()
+        self.btsnoop = BtsnoopRecorder(file_path, max_file_size, backup_count)
+        logging.info(f'Recording HCI traffic to {file_path}')
+
+    def stop_btsnoop(self):
+        """Stop recording HCI traffic and close the btsnoop file
+        """
+        if self.btsnoop:
+            recorder = self.btsnoop
+            self.btsnoop = None
+            recorder.close()
+
     def close(self):
         """Close the serial port.
         """
         self.stop_threads = True
         if self.port and self.port.is_open:
             self.port.close()
+        self.stop_btsnoop()
@@ -1,5 +1,6 @@
 import logging
 import time
+from typing import Callable
 from dvk_probe import DvkProbe
 from EzSerialPort import EzSerialPort
 from ifx_board import IfxBoard
@@ -132,7 +133,8 @@ class If820Board(IfxBoard):
         """
         return super().enter_hci_download_mode(fw_cfg, port)
 
-    def flash_firmware(self, minidriver: str, firmware: str, fw_cfg: ifx_firmware_cfg = IF820_FW_CFG, chip_erase: bool = False, verify: bool = False) -> int:
+    def flash_firmware(self, minidriver: str, firmware: str, fw_cfg: ifx_firmware_cfg = IF820_FW_CFG, chip_erase: bool = False, verify: bool = False,
+                       progress: Callable[[int, int], None] = None) -> int:
         """Flash firmware to the device over HCI.
 
         Args:
@@ -141,10 +143,11 @@ class If820Board(IfxBoard):
             fw_cfg (ifx_firmware_cfg, optional): firmware configuration. Defaults to IF820_FW_CFG.
             chip_erase (bool, optional): whether to perform chip erase. Defaults to False.
             verify (bool, optional): verify firmware while flashing with CRC checks. Defaults to False.
+            progress (Callable[[int, int], None], optional): called with (bytes written, total bytes). Defaults to None.
         Returns:
             int: result code
         """
-        return super().flash_firmware(minidriver, firmware, fw_cfg, chip_erase, verify)
+        return super().flash_firmware(minidriver, firmware, fw_cfg, chip_erase, verify, progress)
     def stop_advertising(self):
         """Stop BLE advertising.
         """
@@ -30,14 +30,142 @@ def newest_image(old: tuple, new: tuple):
         new_version = parse_version(new[1])
         return new if new_version > old_version else old
 
-def find_image_file(config, base: str, image_type: str, image_name: str):
+class FileIndex:
+    """
+    This class lists all files under a base directory with a single walk, so
+    that many filename patterns can be matched without walking the tree for
+    each one.
+
+    The walk uses os.scandir() and visits directories in the same order as
+    os.walk(base) (top-down, symbolic links to directories are listed but
+    not followed, unreadable directories are skipped), so the paths and
+    their order are the same as joining the os.walk() results.
+
+    :param base: Directory to index
+    """
+    def __init__(self, base: str):
+        self.base = base
+        # File paths in walk order
+        self.files = []
+        # Directory paths in walk order
+        self.dirs = []
+        self._matches = {}
+        # Range of self.files under each walked directory
+        self._ranges = {}
+        self._tails = {}
+        self.__walk()
+
+    def __walk(self):
+        # (path, True) enters a directory, (path, False) leaves it
+        stack = [(self.base, True)]
+        while stack:
+            top, enter = stack.pop()
+            if not enter:
+                self._ranges[top] = (self._ranges[top][0], len(self.files))
+                continue
+            try:
+                with os.scandir(top) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            self._ranges[top] = (len(self.files), None)
+            stack.append((top, False))
+            subdirs = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    self.files.append(entry.path)
+                    continue
+                self.dirs.append(entry.path)
+                try:
+                    follow = not entry.is_symlink()
+                except OSError:
+                    follow = False
+                if follow:
+                    subdirs.append(entry.path)
+            # Visit the subdirectories in listing order
+            stack.extend((d, True) for d in reversed(subdirs))
+
+    def files_under(self, directory: str):
+        """
+        List the files under a directory of the index, in the same order as
+        os.walk(directory). A directory that was not walked (a symbolic link)
+        is walked now.
+
+        :param directory: Directory path as listed in dirs
+        :returns: A list of file paths
+        """
+        if directory in self._ranges:
+            start, end = self._ranges[directory]
+            return self.files[start:end]
+        return FileIndex(directory).files
+
+    def dirs_ending_with(self, parts: list):
+        """
+        Find the directories whose last path components are parts. Built on
+        first use for each number of components, so each lookup is a
+        dictionary hit.
+
+        :param parts: List of path components, e.g. ['module', 'board', 'firmware', '1.0.0']
+        :returns: A list of directory paths in walk order
+        """
+        length = len(parts)
+        if length not in self._tails:
+            tails = {}
+            for d in self.dirs:
+                tail = tuple(os.path.normpath(d).split(os.path.sep)[-length:])
+                tails.setdefault(tail, []).append(d)
+            self._tails[length] = tails
+        return self._tails[length].get(tuple(parts), [])
+
+    def match(self, patterns: list):
+        """
+        Find the files matching each pattern (with re.match against the full path).
+
+        The patterns are combined into one alternation so each path is tested
+        once; only paths that match it are tested against the individual
+        patterns. Patterns that cannot be combined (e.g. with numbered
+        backreferences or global flags) are tested one by one. Results are
+        cached per list of patterns.
+
+        :param patterns: List of regular expression strings
+        :returns: A list with a list of (path, match) tuples for each pattern
+        """
+        key = tuple(patterns)
+        if key in self._matches:
+            return self._matches[key]
+        compiled = [re.compile(p) for p in patterns]
+        candidates = self.files
+        if len(compiled) > 1 and not any(re.search(r'\\[1-9]', p) for p in patterns):
+            try:
+                combined = re.compile('|'.join(f'(?:{p})' for p in patterns))
+            except re.error:
+                combined = None
+            if combined is not None:
+                candidates = [path for path in self.files if combined.match(path)]
+        result = [[] for _ in compiled]
+        for path in candidates:
+            for i, pattern in enumerate(compiled):
+                m = pattern.match(path)
+                if m:
+                    result[i].append((path, m))
+        self._matches[key] = result
+        return result
+
+def find_image_file(config, base: str, image_type: str, image_name: str, index: FileIndex = None):
     """
     This function finds the programming image file(s) for a particular image
     type based on the selected image name
 
     :param config: Parsed station config file
+    :param base: Directory to search
     :param image_type: Type of the image
     :param image_name: Name of the image to be programmed
+    :param index: FileIndex of base to reuse across calls, a new one is
+        built if not given
 
     :returns: A list of tuples (filename, version) for each file found or None if no files
         are found.
@@ -58,21 +186,21 @@ def find_image_file(config, base: str, image_type: str, image_name: str):
         # Make the filename list empty
         image_name_info['filename'] = []
 
+    # Match all of the filename patterns against the files in our base
+    # directory in one pass
+    if index is None:
+        index = FileIndex(base)
+    matches = index.match(image_name_info['filename'])
+
     # Check each of the filename patterns in the filename list
-    for filename in image_name_info['filename']:
-        # Search all of the files in our base directory for a match against
-        # the filename pattern
+    for filename_matches in matches:
         newest_match = None
-        for dirpath, dirnames, filenames in os.walk(base):
-            for f in filenames:
-                path = os.path.join(dirpath, f)
-                m = re.match(filename, path)
-                if m:
-                    # Convert "2.1.99.12345678" to "2.1.99+12345678"
-                    version = re.sub(r'^(\d+\.\d+\.\d+)\.(\d+)$', r'\1+\2', m.group(1))
+        for path, m in filename_matches:
+            # Convert "2.1.99.12345678" to "2.1.99+12345678"
+            version = re.sub(r'^(\d+\.\d+\.\d+)\.(\d+)$', r'\1+\2', m.group(1))
 
-                    # Select this file if it is newer
-                    newest_match = newest_image(newest_match, (path, version))
+            # Select this file if it is newer
+            newest_match = newest_image(newest_match, (path, version))
 
         # Add this filename's file to the output list
         if newest_match:
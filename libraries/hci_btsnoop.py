@@ -0,0 +1,156 @@
+import logging
+import os
+import struct
+import threading
+import time
+
+
+class BtsnoopRecorder():
+    """Record HCI packets to a btsnoop file (readable by Wireshark).
+
+    record() only packs the packet into a preallocated buffer, so it is cheap
+    enough to call for every packet. A background thread writes filled buffers
+    to disk and rotates the file once it exceeds max_file_size, keeping
+    backup_count old files (capture.btsnoop.1, capture.btsnoop.2, ...).
+    If both buffers are full the packet is dropped and counted in the
+    cumulative drops field of the following records.
+    """
+
+    # btsnoop version 1, datalink 1002 = HCI UART (H4), packets include the H4 indicator byte
+    FILE_HEADER = b'btsnoop\x00' + struct.pack('>II', 1, 1002)
+    RECORD_HEADER = struct.Struct('>IIIIq')
+    # Microseconds between 0000-01-01 and 1970-01-01, btsnoop timestamps start at year 0
+    EPOCH_DELTA_US = 0x00DCDDB30F2F8000
+
+    FLAG_RECEIVED = 0x01
+    FLAG_COMMAND_EVENT = 0x02
+    H4_COMMAND = 0x01
+    H4_EVENT = 0x04
+
+    DEFAULT_BUFFER_SIZE = 256 * 1024
+    DEFAULT_MAX_FILE_SIZE = 32 * 1024 * 1024
+    DEFAULT_BACKUP_COUNT = 3
+    FLUSH_INTERVAL = 0.5
+
+    def __init__(self,
+                 file_path: str,
+                 max_file_size: int = DEFAULT_MAX_FILE_SIZE,
+                 backup_count: int = DEFAULT_BACKUP_COUNT,
+                 buffer_size: int = DEFAULT_BUFFER_SIZE):
+        self.file_path = file_path
+        self.max_file_size = max_file_size
+        self.backup_count = backup_count
+        self.dropped = 0
+        self._buffers = [bytearray(buffer_size), bytearray(buffer_size)]
+        self._active = 0
+        self._pos = 0
+        self._pending = None
+        self._lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._writer_idle = threading.Event()
+        self._writer_idle.set()
+        self._stop = False
+
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(file_path, 'wb')
+        self._file.write(self.FILE_HEADER)
+        self._file_size = len(self.FILE_HEADER)
+        self._writer = threading.Thread(target=self.__writer_thread, daemon=True)
+        self._writer.start()
+
+    def record(self, data: bytes, received: bool):
+        """Record an HCI packet
+
+        Args:
+            data (bytes): H4 packet, starting with the packet indicator byte
+            received (bool): True for controller to host, False for host to controller
+        """
+        timestamp = time.time_ns() // 1000 + self.EPOCH_DELTA_US
+        flags = self.FLAG_RECEIVED if received else 0
+        if data and data[0] in (self.H4_COMMAND, self.H4_EVENT):
+            flags |= self.FLAG_COMMAND_EVENT
+        length = len(data)
+        record_size = self.RECORD_HEADER.size + length
+        with self._lock:
+            buf = self._buffers[self._active]
+            if self._pos + record_size > len(buf):
+                if self._pending is not None or record_size > len(buf):
+                    self.dropped += 1
+                    return
+                self.__swap_buffers()
+                buf = self._buffers[self._active]
+            self.RECORD_HEADER.pack_into(buf, self._pos, length, length, flags, self.dropped, timestamp)
+            start = self._pos + self.RECORD_HEADER.size
+            buf[start:start + length] = data
+            self._pos = start + length
+
+    def __swap_buffers(self):
+        # Must be called with self._lock held and no buffer pending
+        self._pending = (self._active, self._pos)
+        self._active ^= 1
+        self._pos = 0
+        self._writer_idle.clear()
+        self._flush_event.set()
+
+    def flush(self):
+        """Write all recorded packets to the file"""
+        with self._lock:
+            if self._pos > 0 and self._pending is None:
+                self.__swap_buffers()
+        self._writer_idle.wait()
+        with self._lock:
+            if self._pos > 0 and self._pending is None:
+                self.__swap_buffers()
+        self._writer_idle.wait()
+
+    def close(self):
+        """Flush outstanding packets and close the file"""
+        if self._stop:
+            return
+        self.flush()
+        self._stop = True
+        self._flush_event.set()
+        self._writer.join()
+        self._file.close()
+        if self.dropped:
+            logging.warning(f'btsnoop capture {self.file_path} dropped {self.dropped} packets')
+
+    def __rotate(self):
+        self._file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            src = f'{self.file_path}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self.file_path}.{i + 1}')
+        if self.backup_count > 0:
+            os.replace(self.file_path, f'{self.file_path}.1')
+        self._file = open(self.file_path, 'wb')
+        self._file.write(self.FILE_HEADER)
+        self._file_size = len(self.FILE_HEADER)
+
+    def __writer_thread(self):
+        while not self._stop:
+            if not self._flush_event.wait(self.FLUSH_INTERVAL):
+                # Periodically write out a partially filled buffer
+                with self._lock:
+                    if self._pos > 0 and self._pending is None:
+                        self.__swap_buffers()
+                    else:
+                        continue
+            self._flush_event.clear()
+            with self._lock:
+                pending = self._pending
+            if pending is not None:
+                index, length = pending
+                try:
+                    if self._file_size + length > self.max_file_size and self._file_size > len(self.FILE_HEADER):
+                        self.__rotate()
+                    self._file.write(memoryview(self._buffers[index])[:length])
+                    self._file.flush()
+                    self._file_size += length
+                except OSError as e:
+                    logging.warning(f'btsnoop write to {self.file_path} failed: {e}')
+            with self._lock:
+                self._pending = None
+                self._writer_idle.set()
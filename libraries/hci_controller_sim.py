@@ -0,0 +1,313 @@
+import argparse
+import logging
+import os
+import pty
+import queue
+import random
+import struct
+import threading
+import time
+import tty
+import zlib
+
+from HciSerialPort import HciSerialPort
+
+
+class HciControllerSimulator():
+    """Simulated Infineon HCI controller on a pseudo terminal (Linux/macOS only).
+
+    Implements the commands used by HciSerialPort and HciProgrammer so they can be
+    tested and benchmarked without hardware: HCI Reset, Download Minidriver,
+    Write RAM into a sparse memory model, Launch RAM, Chip Erase, Update Baudrate,
+    Verify CRC, Read BD_ADDR and Read Local Version Information.
+
+    Open port_name with HciSerialPort like a real HCI UART.
+
+    Args:
+        command_latency (float, optional): Delay in seconds before each command is answered. Defaults to 0.
+        erase_time (float, optional): Time in seconds a chip erase takes. Defaults to 0.
+        credits (int, optional): Num_HCI_Command_Packets reported in Command Complete events.
+            Commands received while more than this many are outstanding are counted
+            in credit_violations. Defaults to 1.
+        error_rate (float, optional): Probability (0-1) of answering any command with HCI_FAILURE.
+            Defaults to 0.
+        seed (int, optional): Random seed for error_rate. Defaults to None.
+    """
+
+    OPCODE_RESET = 0x0C03
+    OPCODE_READ_LOCAL_VERSION = 0x1001
+    OPCODE_READ_BD_ADDR = 0x1009
+
+    EVENT_COMMAND_COMPLETE = 0x0E
+    STATUS_SUCCESS = 0x00
+    STATUS_UNKNOWN_COMMAND = 0x01
+    STATUS_FAILURE = 0x01
+    STATUS_INVALID_PARAMS = 0x12
+
+    H4_COMMAND = 0x01
+    H4_EVENT = 0x04
+    COMMAND_HEADER = struct.Struct('<BHB')
+
+    PAGE_SIZE = 4096
+    BD_ADDR = bytes([0x66, 0x55, 0x44, 0x33, 0x22, 0x11])
+
+    def __init__(self,
+                 command_latency: float = 0.0,
+                 erase_time: float = 0.0,
+                 credits: int = 1,
+                 error_rate: float = 0.0,
+                 seed: int | None = None):
+        self.command_latency = command_latency
+        self.erase_time = erase_time
+        self.credits = credits
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+
+        self.memory = {}
+        self.baud_rate = 115200
+        self.minidriver_loaded = False
+        self.launched_address = None
+        self.command_counts = {}
+        self.bytes_written = 0
+        self.credit_violations = 0
+        self._injected = {}
+        self._lock = threading.Lock()
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port_name = os.ttyname(self._slave)
+        self._commands = queue.Queue()
+        self._outstanding = 0
+        self._stop = False
+        self._rx_thread = threading.Thread(target=self.__rx_thread, daemon=True)
+        self._worker_thread = threading.Thread(target=self.__worker_thread, daemon=True)
+        self._rx_thread.start()
+        self._worker_thread.start()
+
+    def close(self):
+        """Stop the simulator and close the pseudo terminal"""
+        self._stop = True
+        self._commands.put(None)
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._worker_thread.join()
+
+    def inject_error(self, opcode: int, status: int = STATUS_FAILURE, count: int = 1, drop: bool = False):
+        """Fail the next commands with the given opcode
+
+        Args:
+            opcode (int): Command opcode
+            status (int, optional): Status returned in the Command Complete event. Defaults to STATUS_FAILURE.
+            count (int, optional): Number of commands to fail. Defaults to 1.
+            drop (bool, optional): Do not answer the command at all instead of returning status.
+                Defaults to False.
+        """
+        with self._lock:
+            self._injected[opcode] = [status, count, drop]
+
+    def read_memory(self, address: int, length: int) -> bytes:
+        """Read the simulated memory. Unwritten memory reads as erased flash (0xFF).
+
+        Args:
+            address (int): Start address
+            length (int): Number of bytes
+
+        Returns:
+            bytes: Memory contents
+        """
+        out = bytearray()
+        while length > 0:
+            page, offset = divmod(address, self.PAGE_SIZE)
+            n = min(length, self.PAGE_SIZE - offset)
+            data = self.memory.get(page)
+            if data is None:
+                out += bytes([HciSerialPort.FLASH_PAD]) * n
+            else:
+                out += data[offset:offset + n]
+            address += n
+            length -= n
+        return bytes(out)
+
+    def write_memory(self, address: int, data: bytes):
+        """Write to the simulated memory
+
+        Args:
+            address (int): Start address
+            data (bytes): Bytes to write
+        """
+        pos = 0
+        while pos < len(data):
+            page, offset = divmod(address + pos, self.PAGE_SIZE)
+            n = min(len(data) - pos, self.PAGE_SIZE - offset)
+            buf = self.memory.get(page)
+            if buf is None:
+                buf = self.memory[page] = bytearray([HciSerialPort.FLASH_PAD]) * self.PAGE_SIZE
+            buf[offset:offset + n] = data[pos:pos + n]
+            pos += n
+
+    def __rx_thread(self):
+        buf = b''
+        while not self._stop:
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                break
+            if not data:
+                break
+            buf += data
+            while len(buf) >= self.COMMAND_HEADER.size:
+                if buf[0] != self.H4_COMMAND:
+                    logging.debug(f'HCI sim: dropping unexpected byte 0x{buf[0]:02X}')
+                    buf = buf[1:]
+                    continue
+                _, opcode, length = self.COMMAND_HEADER.unpack_from(buf)
+                end = self.COMMAND_HEADER.size + length
+                if len(buf) < end:
+                    break
+                with self._lock:
+                    self._outstanding += 1
+                    if self._outstanding > self.credits:
+                        self.credit_violations += 1
+                self._commands.put((opcode, buf[self.COMMAND_HEADER.size:end]))
+                buf = buf[end:]
+
+    def __worker_thread(self):
+        while True:
+            cmd = self._commands.get()
+            if cmd is None or self._stop:
+                break
+            opcode, params = cmd
+            if self.command_latency:
+                time.sleep(self.command_latency)
+            with self._lock:
+                self.command_counts[opcode] = self.command_counts.get(opcode, 0) + 1
+                injected = self._injected.get(opcode)
+                if injected:
+                    injected[1] -= 1
+                    if injected[1] <= 0:
+                        del self._injected[opcode]
+            if injected:
+                status, _, drop = injected
+                response = None if drop else (status, b'')
+            elif self.error_rate and self._random.random() < self.error_rate:
+                response = (self.STATUS_FAILURE, b'')
+            else:
+                response = self.__handle_command(opcode, params)
+
+            with self._lock:
+                self._outstanding -= 1
+            if response is not None:
+                status, return_params = response
+                self.__send_command_complete(opcode, status, return_params)
+
+    def __send_command_complete(self, opcode: int, status: int, return_params: bytes = b''):
+        payload = struct.pack('<BHB', self.credits, opcode, status) + return_params
+        try:
+            os.write(self._master, bytes([self.H4_EVENT, self.EVENT_COMMAND_COMPLETE, len(payload)]) + payload)
+        except OSError:
+            pass
+
+    def __handle_command(self, opcode: int, params: bytes) -> tuple[int, bytes] | None:
+        if opcode == self.OPCODE_RESET:
+            return (self.STATUS_SUCCESS, b'')
+
+        if opcode == HciSerialPort.OPCODE_DOWNLOAD_MINIDRIVER:
+            self.minidriver_loaded = False
+            return (self.STATUS_SUCCESS, b'')
+
+        if opcode == HciSerialPort.OPCODE_WRITE_RAM:
+            if len(params) < 4:
+                return (self.STATUS_INVALID_PARAMS, b'')
+            address = int.from_bytes(params[:4], HciSerialPort.LITTLE_ENDIAN)
+            self.write_memory(address, params[4:])
+            self.bytes_written += len(params) - 4
+            return (self.STATUS_SUCCESS, b'')
+
+        if opcode == HciSerialPort.OPCODE_LAUNCH_RAM:
+            if len(params) != 4:
+                return (self.STATUS_INVALID_PARAMS, b'')
+            self.launched_address = int.from_bytes(params, HciSerialPort.LITTLE_ENDIAN)
+            self.minidriver_loaded = True
+            return (self.STATUS_SUCCESS, b'')
+
+        if opcode == HciSerialPort.OPCODE_CHIP_ERASE:
+            if params != HciSerialPort.ERASE_ALL_FLASH_MAGIC.to_bytes(4, HciSerialPort.LITTLE_ENDIAN):
+                return (self.STATUS_INVALID_PARAMS, b'')
+            if self.erase_time:
+                time.sleep(self.erase_time)
+            self.memory.clear()
+            return (self.STATUS_SUCCESS, b'')
+
+        if opcode == HciSerialPort.OPCODE_UPDATE_BAUDRATE:
+            if len(params) != 6:
+                return (self.STATUS_INVALID_PARAMS, b'')
+            self.baud_rate = int.from_bytes(params[2:], HciSerialPort.LITTLE_ENDIAN)
+            return (self.STATUS_SUCCESS, b'')
+
+        if opcode == HciSerialPort.OPCODE_VERIFY_CRC:
+            if len(params) != 8:
+                return (self.STATUS_INVALID_PARAMS, b'')
+            address, length = struct.unpack('<II', params)
+            crc = zlib.crc32(self.read_memory(address, length))
+            return (self.STATUS_SUCCESS, crc.to_bytes(4, HciSerialPort.LITTLE_ENDIAN))
+
+        if opcode == self.OPCODE_READ_BD_ADDR:
+            return (self.STATUS_SUCCESS, self.BD_ADDR)
+
+        if opcode == self.OPCODE_READ_LOCAL_VERSION:
+            return (self.STATUS_SUCCESS, struct.pack('<BHBHH', 0x0B, 0x0000, 0x0B, 0x0009, 0x0000))
+
+        logging.debug(f'HCI sim: unknown opcode 0x{opcode:04X}')
+        return (self.STATUS_UNKNOWN_COMMAND, b'')
+
+
+def write_random_hex_file(file_path: str, size: int, base_address: int = 0, seed: int = 0):
+    """Write an Intel HEX file with size bytes of random data (benchmark helper)
+
+    Args:
+        file_path (str): hex file path
+        size (int): number of data bytes
+        base_address (int, optional): start address. Defaults to 0.
+        seed (int, optional): random seed. Defaults to 0.
+    """
+    import intelhex
+    ih = intelhex.IntelHex()
+    ih.frombytes(random.Random(seed).randbytes(size), offset=base_address)
+    ih.write_hex_file(file_path)
+
+
+if __name__ == '__main__':
+    import tempfile
+    from HciProgrammer import HciProgrammer
+    from ifx_firmware_cfg import ifx_firmware_cfg
+
+    parser = argparse.ArgumentParser(description='Benchmark HciProgrammer against the simulated controller')
+    parser.add_argument('--size', type=int, default=256 * 1024, help='Firmware size in bytes')
+    parser.add_argument('--latency', type=float, default=0.0, help='Command latency in seconds')
+    parser.add_argument('--verify', action='store_true', help='Verify each write with CRC')
+    parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format='%(asctime)s %(message)s')
+
+    fw_cfg = ifx_firmware_cfg(minidriver_load_addr=0x00270400, launch_firmware_addr=0,
+                              hci_default_baudrate=115200, hci_flash_baudrate=3000000,
+                              load_addr_delay=0, chip_erase_delay=1.0)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        minidriver = os.path.join(tmp_dir, 'minidriver.hex')
+        firmware = os.path.join(tmp_dir, 'firmware.hex')
+        write_random_hex_file(minidriver, 4096, fw_cfg.minidriver_load_addr, seed=1)
+        write_random_hex_file(firmware, args.size, seed=2)
+
+        sim = HciControllerSimulator(command_latency=args.latency)
+        programmer = HciProgrammer(minidriver, sim.port_name, fw_cfg.hci_default_baudrate, True, fw_cfg)
+        start = time.monotonic()
+        programmer.program_firmware(fw_cfg.hci_flash_baudrate, firmware, True, fw_cfg, args.verify)
+        elapsed = time.monotonic() - start
+        sim.close()
+
+    timings = ', '.join(f'{k} {v:.3f}s' for k, v in programmer.timings.items())
+    print(f'Programmed {args.size} bytes in {elapsed:.3f}s ({args.size / elapsed / 1024:.1f} KiB/s) [{timings}]')
+    print(f'Commands: { {hex(k): v for k, v in sim.command_counts.items()} }')
@@ -0,0 +1,249 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+import intelhex
+
+
+class HciImage():
+    """Firmware image pre-split into Write RAM packets.
+    """
+
+    def __init__(self,
+                 packets: list[tuple[int, bytes]],
+                 segments: list[tuple[int, int, int]]):
+        self.packets = packets
+        self.segments = segments
+
+    @property
+    def total_bytes(self) -> int:
+        """Number of data bytes in the image"""
+        return sum(length for start, length, crc in self.segments)
+
+
+class HciImageCache():
+    """Content-addressed cache of parsed HCI firmware images.
+
+    Intel HEX files are parsed and chunked once, HCD files are split into their
+    HCI commands once. The result is stored in a compact binary file named after
+    the sha256 of the source file and the chunk size, so every process on the
+    host (and every board flashed from it) reuses the same pre-chunked image.
+    Images already loaded by this process are kept in memory.
+
+    The cache is kept in the per-user cache directory, and cache files not
+    owned by the current user are ignored, so no other user can plant the
+    image that gets flashed.
+
+    Cache file layout (little-endian):
+        header:   magic, version, kind, chunk size, segment count, record count, sha256
+        segments: (start address, length, crc32) per contiguous segment
+        records:  (address or opcode, data offset, length) per packet
+        data:     concatenated packet data
+    """
+
+    CACHE_DIR_ENV = 'HCI_IMAGE_CACHE_DIR'
+    DEFAULT_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                     'hci_image_cache')
+
+    FILE_MAGIC = b'HCIC'
+    FILE_VERSION = 1
+    KIND_HEX = 0
+    KIND_HCD = 1
+
+    HEADER = struct.Struct('<4sHBxIII32s')
+    SEGMENT = struct.Struct('<III')
+    RECORD = struct.Struct('<III')
+    # Each HCD command starts with a 2 byte opcode and a 1 byte payload length
+    HCD_HEADER = struct.Struct('<HB')
+
+    _memory_cache = {}
+    _memory_lock = threading.Lock()
+
+    def __init__(self, cache_dir: str | None = None):
+        if cache_dir is None:
+            cache_dir = os.environ.get(self.CACHE_DIR_ENV, self.DEFAULT_CACHE_DIR)
+        self.cache_dir = cache_dir
+
+    @staticmethod
+    def file_digest(file_path: str) -> bytes:
+        """Calculate the sha256 of a file
+
+        Args:
+            file_path (str): file path
+
+        Returns:
+            bytes: sha256 digest
+        """
+        with open(file_path, 'rb') as f:
+            return hashlib.sha256(f.read()).digest()
+
+    def load_hex(self, file_path: str, max_packet_size: int) -> HciImage:
+        """Load an Intel HEX file split into packets of up to max_packet_size bytes
+
+        Args:
+            file_path (str): hex file path
+            max_packet_size (int): Maximum size of each packet
+
+        Returns:
+            HciImage: packets and per-segment CRCs of the image
+        """
+        return self.__load(file_path, self.KIND_HEX, max_packet_size)
+
+    def load_hcd(self, file_path: str) -> list[tuple[int, bytes]]:
+        """Load an HCD file split into its HCI commands
+
+        Args:
+            file_path (str): hcd file path
+
+        Returns:
+            list[tuple[int, bytes]]: List of tuples containing opcode and command payload
+        """
+        return self.__load(file_path, self.KIND_HCD, 0).packets
+
+    def cache_file_path(self, digest: bytes, kind: int, chunk_size: int) -> str:
+        """Path of the cache file for an image
+
+        Args:
+            digest (bytes): sha256 of the source file
+            kind (int): KIND_HEX or KIND_HCD
+            chunk_size (int): packet size the image was split with
+
+        Returns:
+            str: cache file path
+        """
+        ext = 'hex' if kind == self.KIND_HEX else 'hcd'
+        return os.path.join(self.cache_dir, f'{digest.hex()}_{ext}_{chunk_size}.bin')
+
+    def __load(self, file_path: str, kind: int, chunk_size: int) -> HciImage:
+        digest = self.file_digest(file_path)
+        key = (digest, kind, chunk_size)
+        with self._memory_lock:
+            image = self._memory_cache.get(key)
+        if image is not None:
+            return image
+
+        cache_path = self.cache_file_path(digest, kind, chunk_size)
+        image = None
+        if os.path.isfile(cache_path) and self.__owned_by_user(cache_path):
+            try:
+                image = self.__read_cache_file(cache_path, digest, kind, chunk_size)
+                logging.debug(f'Loaded {file_path} from image cache {cache_path}')
+            except Exception as e:
+                logging.warning(f'Ignoring invalid image cache file {cache_path}: {e}')
+
+        if image is None:
+            if kind == self.KIND_HEX:
+                image = self.__parse_hex(file_path, chunk_size)
+            else:
+                image = self.__parse_hcd(file_path)
+            try:
+                self.__write_cache_file(cache_path, digest, kind, chunk_size, image)
+            except OSError as e:
+                logging.warning(f'Unable to write image cache file {cache_path}: {e}')
+
+        with self._memory_lock:
+            self._memory_cache[key] = image
+        return image
+
+    @staticmethod
+    def __parse_hex(file_path: str, max_packet_size: int) -> HciImage:
+        ih = intelhex.IntelHex(file_path)
+        packets = []  # list of (start_address, bytes)
+        segments = []  # list of (start_address, length, crc32)
+
+        # Each (start, end) defines a contiguous address segment
+        for seg_start, seg_end in ih.segments():  # seg_end is exclusive
+            buf = ih.tobinarray(start=seg_start, end=seg_end-1).tobytes()
+            segments.append((seg_start, len(buf), zlib.crc32(buf)))
+
+            # Slice into packets of up to max_packet_size bytes — no padding
+            for offset in range(0, len(buf), max_packet_size):
+                packets.append((seg_start + offset, buf[offset:offset + max_packet_size]))
+
+        return HciImage(packets, segments)
+
+    def __parse_hcd(self, file_path: str) -> HciImage:
+        with open(file_path, 'rb') as f:
+            firmware_bin = f.read()
+
+        commands = []
+        data_index = 0
+        while data_index < len(firmware_bin):
+            cmd_opcode, payload_len = self.HCD_HEADER.unpack_from(firmware_bin, data_index)
+            payload_start = data_index + self.HCD_HEADER.size
+            commands.append((cmd_opcode, firmware_bin[payload_start:payload_start + payload_len]))
+            data_index = payload_start + payload_len
+
+        return HciImage(commands, [(0, len(firmware_bin), zlib.crc32(firmware_bin))])
+
+    @staticmethod
+    def __owned_by_user(path: str) -> bool:
+        """Check that a cache file is owned by the current user
+
+        Args:
+            path (str): cache file path
+
+        Returns:
+            bool: True if the file can be trusted
+        """
+        if not hasattr(os, 'getuid'):
+            return True
+        try:
+            if os.stat(path).st_uid == os.getuid():
+                return True
+        except OSError:
+            return False
+        logging.warning(f'Ignoring image cache file {path} owned by another user')
+        return False
+
+    def __write_cache_file(self, cache_path: str, digest: bytes, kind: int, chunk_size: int, image: HciImage):
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        out = bytearray(self.HEADER.pack(self.FILE_MAGIC, self.FILE_VERSION, kind, chunk_size,
+                                         len(image.segments), len(image.packets), digest))
+        for segment in image.segments:
+            out += self.SEGMENT.pack(*segment)
+        data_offset = 0
+        for addr, data in image.packets:
+            out += self.RECORD.pack(addr, data_offset, len(data))
+            data_offset += len(data)
+        for addr, data in image.packets:
+            out += data
+
+        # Write to a temporary file and rename so other processes never see a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(out)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            os.unlink(tmp_path)
+            raise
+
+    def __read_cache_file(self, cache_path: str, digest: bytes, kind: int, chunk_size: int) -> HciImage:
+        with open(cache_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            magic, version, file_kind, file_chunk_size, n_segments, n_records, file_digest = \
+                self.HEADER.unpack_from(mm, 0)
+            if magic != self.FILE_MAGIC or version != self.FILE_VERSION:
+                raise ValueError('unknown file format')
+            if (file_kind, file_chunk_size, file_digest) != (kind, chunk_size, digest):
+                raise ValueError('header does not match image')
+
+            offset = self.HEADER.size
+            segments_end = offset + n_segments * self.SEGMENT.size
+            records_end = segments_end + n_records * self.RECORD.size
+            segments = [self.SEGMENT.unpack_from(mm, o)
+                        for o in range(offset, segments_end, self.SEGMENT.size)]
+            packets = []
+            for o in range(segments_end, records_end, self.RECORD.size):
+                addr, data_offset, length = self.RECORD.unpack_from(mm, o)
+                start = records_end + data_offset
+                if start + length > len(mm):
+                    raise ValueError('truncated file')
+                packets.append((addr, mm[start:start + length]))
+
+        return HciImage(packets, segments)
@@ -1,5 +1,6 @@
 import logging
 import time
+from typing import Callable
 from ifx_firmware_cfg import ifx_firmware_cfg
 from dvk_probe import DvkProbe
 from HciSerialPort import HciSerialPort
@@ -182,14 +183,17 @@ class IfxBoard(DvkProbe):
         board.hci_uart.close()
         return ERR_OK
 
-    def flash_firmware(self, minidriver: str, firmware: str, fw_cfg: ifx_firmware_cfg, chip_erase: bool = False, verify: bool = False) -> int:
+    def flash_firmware(self, minidriver: str, firmware: str, fw_cfg: ifx_firmware_cfg, chip_erase: bool = False, verify: bool = False,
+                       progress: Callable[[int, int], None] = None) -> int:
         """Flash firmware to the device over HCI.
+        Per-phase timings are available in hci_programmer.timings afterwards.
         Args:
             minidriver (str): minidriver file path
             firmware (str): firmware file path
             fw_cfg (ifx_firmware_cfg): firmware configuration
             chip_erase (bool, optional): whether to perform chip erase. Defaults to False.
             verify (bool, optional): verify firmware while flashing with CRC checks. Defaults to False.
+            progress (Callable[[int, int], None], optional): called with (bytes written, total bytes). Defaults to None.
         Returns:
             int: result code
         """
@@ -200,7 +204,7 @@ class IfxBoard(DvkProbe):
         self.hci_programmer = HciProgrammer(minidriver, self.hci_port_name,
                                             fw_cfg.hci_default_baudrate, chip_erase, fw_cfg)
         self.hci_programmer.program_firmware(
-            fw_cfg.hci_flash_baudrate, firmware, chip_erase, fw_cfg, verify)
+            fw_cfg.hci_flash_baudrate, firmware, chip_erase, fw_cfg, verify, progress)
         # Reset the device after flashing
         self.probe.open()
         self.probe.reset_target()
@@ -0,0 +1,189 @@
+import concurrent.futures
+import inspect
+import logging
+import threading
+import time
+from hci_image_cache import HciImageCache
+from HciSerialPort import HciSerialPort
+from ifx_board import IfxBoard, ERR_OK
+from ifx_firmware_cfg import ifx_firmware_cfg
+
+
+class IfxFlashResult():
+    """Result of flashing one board"""
+
+    def __init__(self, board: IfxBoard):
+        self.board = board
+        self.board_id = board.probe.id if board.probe else ''
+        self.port = board.hci_port_name
+        self.success = False
+        self.error = None
+        self.bytes_written = 0
+        self.total_bytes = 0
+        self.duration = 0.0
+        self.timings = {}
+
+    @property
+    def throughput(self) -> float:
+        """Average write throughput in bytes per second"""
+        if self.timings.get('write', 0) <= 0:
+            return 0.0
+        return self.bytes_written / self.timings['write']
+
+    def __str__(self):
+        timings = ', '.join(f'{k} {v:.2f}s' for k, v in self.timings.items())
+        status = 'OK' if self.success else f'FAILED ({self.error})'
+        return f'{self.board_id} ({self.port}): {status} in {self.duration:.2f}s [{timings}]'
+
+
+class IfxMultiFlasher():
+    """Flash the same firmware to several Infineon HCI boards concurrently.
+
+    Every board is flashed from its own thread (one per HCI port). The minidriver
+    and firmware images are parsed once up front and shared through the
+    HciImageCache, and aggregate progress and throughput are logged while the
+    boards are programmed.
+    """
+
+    PROGRESS_INTERVAL = 2.0
+
+    def __init__(self, boards: list[IfxBoard], progress_interval: float = PROGRESS_INTERVAL):
+        self.boards = boards
+        self.progress_interval = progress_interval
+        self.image_cache = HciImageCache()
+        self._results = []
+        self._done = threading.Event()
+
+    def __preload_image(self, file_path: str):
+        if not file_path:
+            return
+        if file_path.casefold().endswith('.hex'):
+            self.image_cache.load_hex(file_path, HciSerialPort.WRITE_RAM_MAX_SIZE)
+        elif file_path.casefold().endswith('.hcd'):
+            self.image_cache.load_hcd(file_path)
+
+    @staticmethod
+    def board_fw_cfg(board: IfxBoard) -> ifx_firmware_cfg:
+        """Get the default firmware configuration of a board
+
+        Args:
+            board (IfxBoard): board
+
+        Returns:
+            ifx_firmware_cfg: default of the board's flash_firmware(), None if it has none
+        """
+        default = inspect.signature(board.flash_firmware).parameters['fw_cfg'].default
+        return None if default is inspect.Parameter.empty else default
+
+    def __flash_board(self, result: IfxFlashResult, minidriver: str, firmware: str,
+                      fw_cfg: ifx_firmware_cfg, chip_erase: bool, verify: bool) -> IfxFlashResult:
+        def progress(bytes_written: int, total_bytes: int):
+            result.bytes_written = bytes_written
+            result.total_bytes = total_bytes
+
+        # A programmer left from a previous run must not report its timings
+        previous_programmer = getattr(result.board, 'hci_programmer', None)
+        start = time.monotonic()
+        try:
+            res = result.board.flash_firmware(minidriver, firmware, fw_cfg, chip_erase=chip_erase,
+                                              verify=verify, progress=progress)
+            result.success = res == ERR_OK
+            if not result.success:
+                result.error = f'error {res}'
+        except Exception as e:
+            result.error = str(e)
+            logging.error(f'Failed to flash board {result.board_id}: {e}')
+        result.duration = time.monotonic() - start
+        programmer = getattr(result.board, 'hci_programmer', None)
+        if programmer and programmer is not previous_programmer:
+            result.timings = dict(programmer.timings)
+        return result
+
+    def __progress_monitor(self, start: float):
+        while not self._done.wait(self.progress_interval):
+            written = sum(r.bytes_written for r in self._results)
+            total = sum(r.total_bytes for r in self._results)
+            elapsed = time.monotonic() - start
+            active = sum(1 for r in self._results if 0 < r.bytes_written < r.total_bytes)
+            if total > 0:
+                logging.info(f'Flashing {active}/{len(self._results)} boards: {written}/{total} bytes '
+                             f'({round(written/total*100, 1)}%), {written/elapsed/1024:.1f} KiB/s')
+
+    def flash_firmware(self, minidriver: str, firmware: str, fw_cfg: ifx_firmware_cfg = None,
+                       chip_erase: bool = False, verify: bool = False) -> list[IfxFlashResult]:
+        """Flash firmware to all boards concurrently.
+
+        Args:
+            minidriver (str): minidriver file path
+            firmware (str): firmware file path
+            fw_cfg (ifx_firmware_cfg, optional): firmware configuration. Defaults to the board default.
+            chip_erase (bool, optional): whether to perform chip erase. Defaults to False.
+            verify (bool, optional): verify firmware while flashing with CRC checks. Defaults to False.
+
+        Returns:
+            list[IfxFlashResult]: Per-board results in the same order as the boards
+
+        Raises:
+            ValueError: fw_cfg is not given and a board has no default
+        """
+        # Resolve the configuration of every board before flashing any of them
+        fw_cfgs = [fw_cfg if fw_cfg is not None else self.board_fw_cfg(board) for board in self.boards]
+        for board, board_fw_cfg in zip(self.boards, fw_cfgs):
+            if board_fw_cfg is None:
+                raise ValueError(f'No firmware configuration for board on {board.hci_port_name}')
+
+        self.__preload_image(minidriver)
+        self.__preload_image(firmware)
+
+        self._results = [IfxFlashResult(board) for board in self.boards]
+        if len(self._results) == 0:
+            return self._results
+
+        self._done.clear()
+        start = time.monotonic()
+        monitor = threading.Thread(target=self.__progress_monitor, args=(start,), daemon=True)
+        monitor.start()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(self._results)) as executor:
+                futures = [executor.submit(self.__flash_board, result, minidriver, firmware,
+                                           board_fw_cfg, chip_erase, verify)
+                           for result, board_fw_cfg in zip(self._results, fw_cfgs)]
+                concurrent.futures.wait(futures)
+        finally:
+            self._done.set()
+            monitor.join()
+
+        elapsed = time.monotonic() - start
+        written = sum(r.bytes_written for r in self._results)
+        passed = sum(1 for r in self._results if r.success)
+        logging.info(f'Flashed {passed}/{len(self._results)} boards in {elapsed:.2f}s '
+                     f'({written/elapsed/1024:.1f} KiB/s aggregate)')
+        for result in self._results:
+            logging.info(str(result))
+        return self._results
+
+    def cancel(self):
+        """Cancel flashing on all boards by closing their HCI ports."""
+        for board in self.boards:
+            board.cancel_flash_firmware()
+
+
+def flash_boards(boards: list[IfxBoard], minidriver: str, firmware: str, fw_cfg: ifx_firmware_cfg = None,
+                 chip_erase: bool = False, verify: bool = False) -> list[IfxFlashResult]:
+    """Flash firmware to a list of boards concurrently.
+
+    Args:
+        boards (list[IfxBoard]): boards to flash
+        minidriver (str): minidriver file path
+        firmware (str): firmware file path
+        fw_cfg (ifx_firmware_cfg, optional): firmware configuration. Defaults to the board default.
+        chip_erase (bool, optional): whether to perform chip erase. Defaults to False.
+        verify (bool, optional): verify firmware while flashing with CRC checks. Defaults to False.
+
+    Returns:
+        list[IfxFlashResult]: Per-board results in the same order as the boards
+
+    Raises:
+        ValueError: fw_cfg is not given and a board has no default
+    """
+    return IfxMultiFlasher(boards).flash_firmware(minidriver, firmware, fw_cfg, chip_erase, verify)
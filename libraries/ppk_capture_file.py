@@ -0,0 +1,314 @@
+import glob
+import os
+import queue
+import threading
+import time
+import numpy as np
+from ppk_stats import SAMPLE_RATE
+
+# Index record: host time of the first sample, absolute sample index since
+# the start of the capture, capture file number and byte offset in that file
+INDEX_DTYPE = np.dtype([('time', '<f8'), ('sample', '<u8'), ('file', '<u4'), ('offset', '<u8')])
+
+# npy header size, fixed so the shape can be updated in place
+NPY_HEADER_SIZE = 256
+
+def _write_npy_header(f, dtype: np.dtype, length: int):
+    """
+    Write a fixed size npy (version 1.0) header for a 1-D array.
+    """
+    header = f"{{'descr': {np.lib.format.dtype_to_descr(dtype)!r}, 'fortran_order': False, 'shape': ({length},), }}"
+    if len(header) > NPY_HEADER_SIZE - 10 - 1:
+        raise ValueError(f"npy header for {dtype} does not fit into {NPY_HEADER_SIZE} bytes")
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    f.seek(0)
+    f.write(b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin1'))
+
+def capture_file_name(base_path: str, number: int):
+    """
+    Name of a capture data file.
+
+    :param base_path: Capture path without extension
+    :param number: File number, starting at 0
+    """
+    return f"{base_path}.{number:04d}.npy"
+
+def index_file_name(base_path: str):
+    """
+    Name of the index file of a capture.
+    """
+    return f"{base_path}.idx.npy"
+
+class CaptureFileWriter:
+    """
+    Write a capture to disk as a series of npy files.
+
+    Samples are copied into a memory-mapped, preallocated data file by a
+    writer thread, so the measurement loop only queues blocks. Once a file
+    holds max_file_samples samples the next one is started. When a file is
+    closed its npy header is updated to the actual length, so every file
+    can be opened with numpy.load(mmap_mode='r'). An index file records the
+    host time of a sample every index_interval samples, and at the start of
+    each file and after dropped blocks.
+
+    :param base_path: Capture path without extension
+    :param dtype: Sample data type (float32 currents or uint32 raw words)
+    :param max_file_samples: Samples per data file
+    :param index_interval: Samples between index records
+    """
+    DEFAULT_MAX_FILE_SAMPLES = 1 << 27
+    MAX_QUEUED_BLOCKS = 1024
+
+    def __init__(self, base_path: str, dtype=np.float32, max_file_samples: int = DEFAULT_MAX_FILE_SAMPLES,
+                 index_interval: int = 100000):
+        self.base_path = base_path
+        self.dtype = np.dtype(dtype)
+        self.max_file_samples = max_file_samples
+        self.index_interval = index_interval
+        self.files = []
+        self.samples_written = 0
+        self.dropped_samples = 0
+        self._queue = queue.Queue(maxsize=self.MAX_QUEUED_BLOCKS)
+        self._next_index = None
+        self._map = None
+        self._file = None
+        self._fill = 0
+        self._next_index_record = 0
+
+        directory = os.path.dirname(base_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._index_file = open(index_file_name(base_path), 'w+b')
+        self._index_records = 0
+        _write_npy_header(self._index_file, INDEX_DTYPE, 0)
+        self._writer = threading.Thread(target=self.__writer_thread, daemon=True)
+        self._writer.start()
+
+    def write(self, samples: np.ndarray, first_index: int, timestamp: float = None):
+        """
+        Queue a block of samples for writing. Blocks are dropped (and counted
+        in dropped_samples) if the writer falls too far behind.
+
+        :param samples: numpy array of samples
+        :param first_index: Capture index of the first sample
+        :param timestamp: Host time of the first sample, defaults to now
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            self._queue.put_nowait((np.array(samples, dtype=self.dtype), first_index, timestamp))
+        except queue.Full:
+            self.dropped_samples += len(samples)
+
+    def close(self):
+        """
+        Write all queued samples and close the files.
+        """
+        if self._writer is None:
+            return
+        self._queue.put(None)
+        self._writer.join()
+        self._writer = None
+        self.__close_data_file()
+        _write_npy_header(self._index_file, INDEX_DTYPE, self._index_records)
+        self._index_file.close()
+
+    def info(self):
+        """
+        :return: Dictionary with the capture path, data files and sample counts
+        """
+        return {
+            'base_path': self.base_path,
+            'files': list(self.files),
+            'index_file': index_file_name(self.base_path),
+            'samples_written': self.samples_written,
+            'dropped_samples': self.dropped_samples,
+        }
+
+    def __open_data_file(self):
+        path = capture_file_name(self.base_path, len(self.files))
+        self._file = open(path, 'w+b')
+        _write_npy_header(self._file, self.dtype, self.max_file_samples)
+        # Preallocate (sparse where supported) so the whole file can be mapped
+        self._file.truncate(NPY_HEADER_SIZE + self.max_file_samples * self.dtype.itemsize)
+        self._file.flush()
+        self._map = np.memmap(self._file, dtype=self.dtype, mode='r+', offset=NPY_HEADER_SIZE,
+                              shape=(self.max_file_samples,))
+        self._fill = 0
+        self.files.append(path)
+
+    def __close_data_file(self):
+        if self._map is None:
+            return
+        self._map.flush()
+        # Drop the last reference to the mapping before truncating the file
+        self._map = None
+        _write_npy_header(self._file, self.dtype, self._fill)
+        self._file.truncate(NPY_HEADER_SIZE + self._fill * self.dtype.itemsize)
+        self._file.close()
+        self._file = None
+
+    def __add_index_record(self, sample: int, timestamp: float):
+        record = np.array([(timestamp, sample, len(self.files) - 1,
+                            NPY_HEADER_SIZE + self._fill * self.dtype.itemsize)], dtype=INDEX_DTYPE)
+        self._index_file.seek(0, os.SEEK_END)
+        self._index_file.write(record.tobytes())
+        self._index_records += 1
+        self._next_index_record = sample + self.index_interval
+
+    def __writer_thread(self):
+        while True:
+            block = self._queue.get()
+            if block is None:
+                break
+            samples, first_index, timestamp = block
+            resync = first_index != self._next_index
+            pos = 0
+            while pos < len(samples):
+                if self._map is None or self._fill == self.max_file_samples:
+                    self.__close_data_file()
+                    self.__open_data_file()
+                    resync = True
+                sample = first_index + pos
+                if resync or sample >= self._next_index_record:
+                    self.__add_index_record(sample, timestamp + pos / SAMPLE_RATE)
+                    resync = False
+                # Write up to the end of the file or the next index record
+                n = min(len(samples) - pos, self.max_file_samples - self._fill,
+                        max(1, self._next_index_record - sample))
+                self._map[self._fill:self._fill + n] = samples[pos:pos + n]
+                self._fill += n
+                pos += n
+            self._next_index = first_index + len(samples)
+            self.samples_written += len(samples)
+            if self._queue.empty():
+                # Keep the index readable while the capture is running
+                _write_npy_header(self._index_file, INDEX_DTYPE, self._index_records)
+                self._index_file.flush()
+
+class CaptureFileReader:
+    """
+    Read a capture written by CaptureFileWriter without loading it into RAM.
+
+    :param base_path: Capture path without extension
+    """
+    def __init__(self, base_path: str):
+        self.base_path = base_path
+        self.index = np.load(index_file_name(base_path), mmap_mode='r')
+        paths = sorted(glob.glob(glob.escape(base_path) + '.[0-9][0-9][0-9][0-9].npy'))
+        self.files = [np.load(path, mmap_mode='r') for path in paths]
+        self._runs = None
+
+    def __len__(self):
+        return sum(len(f) for f in self.files)
+
+    def __runs(self):
+        """
+        Contiguous runs of stored samples. An index record is written at the
+        start of each file and after every gap, so the samples from one
+        record up to the next one (or the end of its file) are contiguous.
+
+        :return: Tuple of arrays (first sample, sample count, file number,
+            sample offset in the file), one entry per index record
+        """
+        if self._runs is None:
+            n = len(self.index)
+            starts = self.index['sample'].astype(np.int64)
+            file_numbers = self.index['file'].astype(np.int64)
+            itemsizes = np.array([self.files[f].itemsize if f < len(self.files) else 1 for f in file_numbers])
+            offsets = (self.index['offset'].astype(np.int64) - NPY_HEADER_SIZE) // itemsizes
+            file_lengths = np.array([len(self.files[f]) if f < len(self.files) else 0 for f in file_numbers])
+            ends = file_lengths.copy()
+            if n > 1:
+                same_file = file_numbers[1:] == file_numbers[:-1]
+                ends[:-1] = np.where(same_file, offsets[1:], file_lengths[:-1])
+            counts = np.clip(np.minimum(ends, file_lengths) - offsets, 0, None)
+            self._runs = (starts, counts, file_numbers, offsets)
+        return self._runs
+
+    def locate(self, sample: int):
+        """
+        Find where a sample is stored.
+
+        :param sample: Absolute sample index since the start of the capture
+        :return: Tuple of (file number, sample offset in the file) of the
+            sample, or of the next stored sample if it was dropped
+        """
+        starts, counts, file_numbers, offsets = self.__runs()
+        i = int(np.searchsorted(starts + counts, sample, side='right'))
+        if i == len(starts):
+            if not self.files:
+                return 0, 0
+            return len(self.files) - 1, len(self.files[-1])
+        return int(file_numbers[i]), int(offsets[i] + max(0, sample - int(starts[i])))
+
+    def time_to_sample(self, timestamp: float):
+        """
+        Estimate the sample index at a host time from the nearest preceding index record.
+
+        :param timestamp: Host time (time.time())
+        :return: Absolute sample index
+        """
+        i = max(0, int(np.searchsorted(self.index['time'], timestamp, side='right')) - 1)
+        record = self.index[i]
+        return int(record['sample']) + max(0, round((timestamp - record['time']) * SAMPLE_RATE))
+
+    def get(self, start: int, stop: int):
+        """
+        Copy samples with absolute indexes in [start, stop). Samples that were
+        dropped during the capture are skipped, so the result is shorter than
+        stop - start across a gap (see runs()).
+
+        :return: numpy array of samples
+        """
+        starts, counts, file_numbers, offsets = self.__runs()
+        parts = []
+        i = int(np.searchsorted(starts + counts, start, side='right'))
+        while i < len(starts) and starts[i] < stop:
+            # Clip the read to the part of [start, stop) stored in this run
+            first = max(start, int(starts[i])) - int(starts[i])
+            last = min(stop, int(starts[i] + counts[i])) - int(starts[i])
+            if last > first:
+                parts.append(self.files[file_numbers[i]][offsets[i] + first:offsets[i] + last])
+            i += 1
+        if not parts:
+            return np.empty(0, dtype=self.files[0].dtype if self.files else np.float32)
+        return np.concatenate(parts)
+
+    def read(self, position: int, count: int):
+        """
+        Copy stored samples by position, ignoring gaps in the sample indexes,
+        e.g. to replay a capture.
+
+        :param position: Position of the first sample among all stored samples
+        :param count: Number of samples
+        :return: numpy array of up to count samples
+        """
+        parts = []
+        for data in self.files:
+            if count <= 0:
+                break
+            if position >= len(data):
+                position -= len(data)
+                continue
+            part = data[position:position + count]
+            parts.append(part)
+            count -= len(part)
+            position = 0
+        if not parts:
+            return np.empty(0, dtype=self.files[0].dtype if self.files else np.float32)
+        return np.concatenate(parts)
+
+    def runs(self):
+        """
+        :return: List of (first sample, stop sample) tuples of the contiguous
+            ranges of stored samples; the samples between them were dropped
+        """
+        starts, counts, _, _ = self.__runs()
+        result = []
+        for first, count in zip(starts.tolist(), counts.tolist()):
+            if result and result[-1][1] == first:
+                result[-1] = (result[-1][0], first + count)
+            elif count:
+                result.append((first, first + count))
+        return result
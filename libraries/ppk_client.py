@@ -1,50 +1,154 @@
 import socket
 import json
 import argparse
+import threading
 import time
+import numpy as np
+import ppk_protocol
+
+class ControlLostError(ConnectionError):
+    """
+    The connection was lost while the client controlled the power profiler,
+    so the daemon stopped any measurement it had started.
+    """
+    pass
 
 class PPKClient:
     """
     TCP Client to interface with PPK2 Daemon
 
+    When the connection is lost (e.g. the daemon was restarted), the client
+    reconnects on the next request, retrying with an increasing delay, and
+    sends the requests that did not get a response again. Control commands
+    (ppk_protocol.CONTROL_COMMANDS) are not sent again, as they may already
+    have been executed. The daemon stops a measurement when its controlling
+    client disconnects, so losing the connection while this client has
+    control raises ControlLostError.
+
     :param host: Host to connect to
     :param port: Port to connect to
     :param verbose: Enable verbose output
+    :param timeout: Socket timeout in seconds
+    :param retries: Reconnection attempts per request
+    :param backoff: Delay before the second reconnection attempt, doubled for each further attempt
+    :param max_backoff: Maximum delay between reconnection attempts
     """
-    def __init__(self, host, port, verbose=False):
+    def __init__(self, host, port, verbose=False, timeout: float = 5.0, retries: int = 3, backoff: float = 0.5,
+                 max_backoff: float = 5.0):
         self.host = host
         self.port = port
         self.verbose = verbose
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.settimeout(5)
-        self.client.connect((self.host, self.port))
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reconnects = 0
+        # True after a control command until control is released
+        self.has_control = False
+        self.client = None
+        self._next_id = 0
+        self._lock = threading.RLock()
+        self._connect()
 
     def close(self):
         """
-        Close the TCP connection.
+        Close the TCP connection. The next request opens a new one.
+        """
+        with self._lock:
+            self._disconnect()
+            self.has_control = False
+
+    @property
+    def connected(self):
+        return self.client is not None
+
+    def _connect(self):
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.settimeout(self.timeout)
+        try:
+            client.connect((self.host, self.port))
+        except OSError:
+            client.close()
+            raise
+        self.client = client
+        self._reader = ppk_protocol.MessageReader(ppk_protocol.MAX_RESPONSE_SIZE, legacy=False)
+        self._responses = {}
+
+    def _disconnect(self):
+        if self.client is not None:
+            self.client.close()
+            self.client = None
+
+    def _reconnect(self):
+        """
+        Connect again, retrying with an increasing delay.
+
+        :return: True if connected
+        """
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+            try:
+                self._connect()
+            except OSError as e:
+                if self.verbose:
+                    print(f"Connecting to {self.host}:{self.port} failed: {e}")
+                continue
+            self.reconnects += 1
+            if self.verbose:
+                print(f"Reconnected to {self.host}:{self.port}")
+            return True
+        return False
+
+    def _receive(self, max_messages: int = None):
         """
-        self.client.close()
+        Receive data and store the responses completed by it.
 
-    def _get_response(self):
+        :return: False on timeout, socket error or disconnect
+        """
+        if self.client is None:
+            return False
         try:
-            response = self.client.recv(1024)
+            data = self.client.recv(65536)
         except socket.timeout as e:
             if self.verbose:
                 print(f"Socket timeout: {e}")
-            return None
+            return False
         except socket.error as e:
             if self.verbose:
                 print(f"Socket error: {e}")
-            return None
+            self._disconnect()
+            return False
+        if not data:
+            if self.verbose:
+                print("Connection closed")
+            self._disconnect()
+            return False
 
-        if self.verbose:
-            print(f"Received: {response.decode('utf-8')}")
-        try:
-            json_resp = json.loads(response.decode('utf-8'))
-        except json.JSONDecodeError as e:
+        for json_resp, error in self._reader.feed(data, max_messages):
+            if error is not None:
+                if self.verbose:
+                    print(f"JSON decode error: {error}")
+                continue
             if self.verbose:
-                print(f"JSON decode error: {e}")
-            return None
+                print(f"Received: {json_resp}")
+            if isinstance(json_resp, dict):
+                self._responses[json_resp.get('id')] = json_resp
+        return True
+
+    def _get_response(self, request_id, max_messages: int = None):
+        while request_id not in self._responses:
+            if None in self._responses:
+                # The server could not decode a request, no response will match
+                json_resp = self._responses.pop(None)
+                if self.verbose:
+                    print(f"Server error: {json_resp.get('error')}")
+                return None
+            if not self._receive(max_messages):
+                return None
+        json_resp = self._responses.pop(request_id)
         if 'error' in json_resp:
             if self.verbose:
                 print(f"Server error: {json_resp['error']}")
@@ -52,6 +156,21 @@ class PPKClient:
 
         return json_resp
 
+    def _send_requests(self, requests):
+        if self.client is None and not self._reconnect():
+            raise ConnectionError(f"Cannot connect to {self.host}:{self.port}")
+        ids = []
+        data = b''
+        for request in requests:
+            request = dict(request, id=self._next_id)
+            self._next_id += 1
+            ids.append(request['id'])
+            if self.verbose:
+                print(f"Sending: {json.dumps(request)}")
+            data += ppk_protocol.encode_message(request)
+        self.client.sendall(data)
+        return ids
+
     def send(self, request):
         """
         Send a request to the server and get the response.
@@ -59,11 +178,75 @@ class PPKClient:
         :param request: Dictionary representing the request
         :return: Response from the server as a dictionary
         """
-        jr = json.dumps(request)
-        if self.verbose:
-            print(f"Sending: {jr}")
-        self.client.send(jr.encode('utf-8'))
-        return self._get_response()
+        return self.send_many([request])[0]
+
+    def send_many(self, requests):
+        """
+        Send several requests in a single write and get their responses.
+        The server executes the requests in order. Requests that did not get
+        a response because the connection was lost are sent again after
+        reconnecting, except control commands.
+
+        :param requests: List of dictionaries representing the requests
+        :return: List of responses in the same order as the requests, None
+            for requests that failed
+        :raises ControlLostError: If the connection was lost while this
+            client controlled the power profiler
+        """
+        responses = [None] * len(requests)
+        pending = list(range(len(requests)))
+        with self._lock:
+            for attempt in range(self.retries + 1):
+                try:
+                    ids = self._send_requests([requests[i] for i in pending])
+                except ConnectionError:
+                    break
+                except OSError as e:
+                    if self.verbose:
+                        print(f"Socket error: {e}")
+                    self._disconnect()
+                    self.__check_control()
+                    continue
+                lost = []
+                for i, request_id in zip(pending, ids):
+                    responses[i] = self._get_response(request_id)
+                    if responses[i] is not None:
+                        self.__track_control(requests[i])
+                    elif self.client is None and requests[i].get('command') not in ppk_protocol.CONTROL_COMMANDS:
+                        lost.append(i)
+                if self.client is None:
+                    self.__check_control()
+                pending = lost
+                if not pending:
+                    break
+        return responses
+
+    def __track_control(self, request: dict):
+        command = request.get('command')
+        if command in ppk_protocol.CONTROL_COMMANDS:
+            self.has_control = True
+        elif command == 'release_control':
+            self.has_control = False
+
+    def __check_control(self):
+        """
+        Called after the connection was lost.
+        """
+        if self.has_control:
+            self.has_control = False
+            raise ControlLostError(f"Connection to {self.host}:{self.port} lost while controlling the power "
+                                   "profiler, the measurement was stopped")
+
+    def query(self, *commands):
+        """
+        Run several commands without parameters in one round trip, e.g.
+        query('get_stats', 'get_health').
+
+        :return: List of results in the same order as the commands, None for
+            commands that failed
+        """
+        responses = self.send_many([{'command': command} for command in commands])
+        return [response.get('result') if response is not None else None for response in responses]
 
     def set_output_voltage(self, voltage_mv: int):
         """
@@ -91,13 +274,23 @@ class PPKClient:
                 return
         raise Exception("Failed to set output state")
 
-    def start_measuring(self):
+    def start_measuring(self, stats_only: bool = None, capture_file: str = None):
         """
         Start measuring current.
 
+        :param stats_only: Only keep running statistics and discard the raw
+            samples. None to use the daemon default.
+        :param capture_file: Also write the samples to disk on the daemon
+            host, to this file name without extension in the daemon's
+            capture directory
         :raises Exception: If starting measurement fails
         """
-        response = self.send({'command': 'start'})
+        request = {'command': 'start'}
+        if stats_only is not None:
+            request['stats_only'] = stats_only
+        if capture_file is not None:
+            request['capture_file'] = capture_file
+        response = self.send(request)
         if response is not None and 'result' in response:
             if response['result'] == 0:
                 return
@@ -151,6 +344,397 @@ class PPKClient:
             return response['result']
         raise Exception("Failed to get average current")
 
+    def get_stats(self):
+        """
+        Get the running statistics of the current capture.
+
+        :return: Dictionary with count, min/max/mean/std (in uA), variance,
+            duration_s and elapsed_s
+        :raises Exception: If getting the statistics fails
+        """
+        response = self.send({'command': 'get_stats'})
+        if response is not None and 'result' in response:
+            return response['result']
+        raise Exception("Failed to get statistics")
+
+    def get_memory_usage(self):
+        """
+        Get the memory used by the daemon to store samples.
+
+        :return: Dictionary with sample counts and allocated/used bytes
+        :raises Exception: If getting the memory usage fails
+        """
+        response = self.send({'command': 'get_memory_usage'})
+        if response is not None and 'result' in response:
+            return response['result']
+        raise Exception("Failed to get memory usage")
+
+    def get_range(self, t0: float, t1: float, max_points: int = 1000):
+        """
+        Get min/max/mean current between two times of the current capture,
+        reduced to at most max_points points (e.g. for plotting).
+
+        :param t0: Start time in seconds since the start of the capture
+        :param t1: End time in seconds since the start of the capture
+        :param max_points: Maximum number of points
+        :return: Dictionary with bin_s (bin duration) and lists t, min, max, mean (uA) and count
+        :raises Exception: If getting the range fails
+        """
+        response = self.send({'command': 'get_range', 't0': t0, 't1': t1, 'max_points': max_points})
+        if response is not None and isinstance(response.get('result'), dict):
+            return response['result']
+        raise Exception("Failed to get range")
+
+    def get_percentiles(self, percentiles=(50, 90, 99)):
+        """
+        Get percentiles of the current over the whole capture.
+
+        :param percentiles: Percentiles (0-100)
+        :return: Dictionary of current (uA) by percentile (as string, e.g. '99')
+        :raises Exception: If getting the percentiles fails
+        """
+        response = self.send({'command': 'get_percentiles', 'percentiles': list(percentiles)})
+        if response is not None and isinstance(response.get('result'), dict):
+            return response['result']
+        raise Exception("Failed to get percentiles")
+
+    def get_histogram(self, bins: int = 50, log_scale: bool = True):
+        """
+        Get the distribution of the current over the whole capture.
+
+        :param bins: Number of bins between the minimum and maximum current
+        :param log_scale: Logarithmically spaced bins, otherwise linear
+        :return: Dictionary with lists edges (uA, bins + 1 values), counts
+            and time_s (time spent in each bin)
+        :raises Exception: If getting the histogram fails
+        """
+        response = self.send({'command': 'get_histogram', 'bins': bins, 'log_scale': log_scale})
+        if response is not None and isinstance(response.get('result'), dict):
+            return response['result']
+        raise Exception("Failed to get histogram")
+
+    def get_health(self):
+        """
+        Get the acquisition health counters of the daemon.
+
+        :return: Dictionary with bytes_read, reads, read_errors, samples_decoded,
+            counter_gaps, dropped_samples, max_loop_latency_s and max_backlog_bytes
+        :raises Exception: If the request fails
+        """
+        response = self.send({'command': 'get_health'})
+        if response is not None and isinstance(response.get('result'), dict):
+            return response['result']
+        raise Exception("Failed to get health")
+
+    def get_capture_info(self):
+        """
+        Get the files of the current or last capture written to disk.
+
+        :return: Dictionary with base_path, files, index_file, samples_written
+            and dropped_samples, or None if no capture was written to disk
+        :raises Exception: If the request fails
+        """
+        response = self.send({'command': 'get_capture_info'})
+        if response is not None and 'result' in response:
+            return response['result']
+        raise Exception("Failed to get capture info")
+
+    def mark(self, label: str):
+        """
+        Mark the start of a new segment of the current capture.
+
+        :param label: Name of the segment
+        :return: Dictionary with the label, sample index and host time of the marker
+        :raises Exception: If marking fails
+        """
+        response = self.send({'command': 'mark', 'label': label})
+        if response is not None and isinstance(response.get('result'), dict):
+            return response['result']
+        raise Exception("Failed to mark segment")
+
+    def get_segment_stats(self, percentiles=None, voltage_mv: int = None):
+        """
+        Get statistics for each marked segment of the current capture.
+
+        :param percentiles: Percentiles (0-100) to report, None for the daemon default
+        :param voltage_mv: Supply voltage for the energy calculation, None for the source voltage
+        :return: List of dictionaries with label, count, min/max/mean (uA),
+            percentiles (uA), charge_uAh and energy_uWh per segment
+        :raises Exception: If getting the statistics fails
+        """
+        request = {'command': 'segment_stats'}
+        if percentiles is not None:
+            request['percentiles'] = list(percentiles)
+        if voltage_mv is not None:
+            request['voltage_mv'] = voltage_mv
+        response = self.send(request)
+        if response is not None and isinstance(response.get('result'), list):
+            return response['result']
+        raise Exception("Failed to get segment statistics")
+
+    def add_threshold(self, condition: str = None, above: bool = True, threshold_ua: float = None,
+                      min_duration_s: float = 0.0, label: str = None):
+        """
+        Detect events where the current crosses a threshold for a minimum time.
+
+        :param condition: Condition such as "> 5 mA for > 2 ms" or "< 10 uA for 1 s",
+            instead of above, threshold_ua and min_duration_s
+        :param above: True to detect currents above the threshold, False for below
+        :param threshold_ua: Threshold in microamperes
+        :param min_duration_s: Minimum event duration in seconds
+        :param label: Name reported with the events
+        :return: Threshold id
+        :raises Exception: If adding the threshold fails
+        """
+        request = {'command': 'add_threshold', 'label': label}
+        if condition is not None:
+            request['condition'] = condition
+        else:
+            request.update(above=above, threshold_ua=threshold_ua, min_duration_s=min_duration_s)
+        response = self.send(request)
+        if response is not None and isinstance(response.get('result'), int) and response['result'] > 0:
+            return response['result']
+        raise Exception("Failed to add threshold")
+
+    def remove_threshold(self, threshold_id: int):
+        """
+        Remove a threshold added with add_threshold().
+
+        :return: True if the threshold existed
+        :raises Exception: If the request fails
+        """
+        response = self.send({'command': 'remove_threshold', 'threshold_id': threshold_id})
+        if response is not None and 'result' in response:
+            return response['result']
+        raise Exception("Failed to remove threshold")
+
+    def get_events(self, since: int = 0, threshold_id: int = None):
+        """
+        Get the threshold events of the current capture.
+
+        :param since: Only return events with a sequence number ('seq') above this
+        :param threshold_id: Only return events of this threshold
+        :return: List of dictionaries with threshold_id, label, start/end
+            sample index, start_s, duration_s, peak_ua, mean_ua and charge_uAh
+        :raises Exception: If getting the events fails
+        """
+        response = self.send({'command': 'get_events', 'since': since, 'threshold_id': threshold_id})
+        if response is not None and isinstance(response.get('result'), list):
+            return response['result']
+        raise Exception("Failed to get events")
+
+    def watch_events(self):
+        """
+        Receive threshold events as they are detected. The connection is
+        dedicated to events afterwards and cannot be used for other commands.
+
+        :return: Generator yielding event dictionaries (see get_events())
+        :raises Exception: If watching fails
+        """
+        # Events carry no request id, keep them out of the responses
+        request_id, = self._send_requests([{'command': 'watch'}])
+        if self._get_response(request_id, max_messages=1) is None:
+            raise Exception("Failed to watch events")
+        self.client.settimeout(None)
+        data = b''
+        try:
+            while True:
+                for message, error in self._reader.feed(data):
+                    if error is None and isinstance(message, dict) and 'event' in message:
+                        yield message['event']
+                data = self.client.recv(65536)
+                if not data:
+                    return
+        finally:
+            if self.client is not None and self.client.fileno() != -1:
+                self.client.settimeout(self.timeout)
+
+    def group_start(self, members=None, stats_only: bool = None, capture_file: str = None):
+        """
+        Start a capture on several power profilers of the daemon process together.
+
+        :param members: Names (serial numbers) of the power profilers, None for all
+        :param stats_only: Only keep running statistics, None for the daemon default
+        :param capture_file: Capture file name prefix, the profiler name is appended
+        :return: Dictionary with the member names and the host time.monotonic()
+            at which the captures were started
+        :raises Exception: If starting fails
+        """
+        request = {'command': 'group_start'}
+        if members is not None:
+            request['members'] = list(members)
+        if stats_only is not None:
+            request['stats_only'] = stats_only
+        if capture_file is not None:
+            request['capture_file'] = capture_file
+        response = self.send(request)
+        if response is not None and isinstance(response.get('result'), dict):
+            return response['result']
+        raise Exception("Failed to start group capture")
+
+    def group_stop(self, members=None):
+        """
+        Stop measuring on several power profilers of the daemon process.
+
+        :param members: Names (serial numbers) of the power profilers, None for all
+        :return: List of member names
+        :raises Exception: If stopping fails
+        """
+        request = {'command': 'group_stop'}
+        if members is not None:
+            request['members'] = list(members)
+        response = self.send(request)
+        if response is not None and isinstance(response.get('result'), list):
+            return response['result']
+        raise Exception("Failed to stop group capture")
+
+    def list_profilers(self):
+        """
+        :return: Names of the power profilers of the daemon process
+        :raises Exception: If the request fails
+        """
+        response = self.send({'command': 'list_profilers'})
+        if response is not None and isinstance(response.get('result'), list):
+            return response['result']
+        raise Exception("Failed to list power profilers")
+
+    def get_timebase(self):
+        """
+        Get the estimated relation between the capture and the host clock.
+
+        :return: Dictionary with t0 (host time.monotonic() of the first
+            sample), sample_rate, jitter_s and records, or None before the
+            first samples
+        :raises Exception: If the request fails
+        """
+        response = self.send({'command': 'get_timebase'})
+        if response is not None and 'result' in response:
+            return response['result']
+        raise Exception("Failed to get timebase")
+
+    def get_window(self, t0: float, t1: float, members=None, max_points: int = 1000):
+        """
+        Get min/max/mean current of one or more power profilers between two
+        host times. The daemon runs on this host, so time.monotonic() values
+        of the client can be used.
+
+        :param t0: Start time as host time.monotonic()
+        :param t1: End time as host time.monotonic()
+        :param members: Names (serial numbers) of the power profilers, None
+            for the one served on this connection
+        :param max_points: Maximum number of points per power profiler
+        :return: Dictionary by name of dictionaries with bin_s, lists t (host
+            time.monotonic()), min, max, mean (uA) and count, and the timebase
+        :raises Exception: If the request fails
+        """
+        request = {'command': 'get_window', 't0': t0, 't1': t1, 'max_points': max_points}
+        if members is not None:
+            request['members'] = list(members)
+        response = self.send(request)
+        if response is not None and isinstance(response.get('result'), dict):
+            return response['result']
+        raise Exception("Failed to get window")
+
+    def release_control(self):
+        """
+        Give up control of the power profiler so another client can
+        start/stop measuring and change the output.
+
+        :return: True if this client was the controlling client
+        :raises Exception: If the request fails
+        """
+        response = self.send({'command': 'release_control'})
+        if response is not None and 'result' in response:
+            return response['result']
+        raise Exception("Failed to release control")
+
+    def _recv_exact(self, buf: bytearray, size: int):
+        """
+        Receive until buf holds at least size bytes.
+
+        :return: False if the connection was closed
+        """
+        while len(buf) < size:
+            data = self.client.recv(max(65536, size - len(buf)))
+            if not data:
+                return False
+            buf += data
+        return True
+
+    def stream(self, fmt: str = ppk_protocol.STREAM_FORMAT_FLOAT32, decimate: int = 1):
+        """
+        Subscribe to the sample stream. The connection is dedicated to the
+        stream afterwards and cannot be used for other commands.
+
+        Frames dropped by the daemon because the client did not keep up are
+        counted in self.stream_dropped_frames.
+
+        :param fmt: 'float32' for currents in microamperes, 'raw' for raw PPK2 sample words
+        :param decimate: Number of samples averaged (float32) or skipped (raw) per streamed sample
+        :return: Generator yielding (first_sample_index, numpy array of samples) tuples
+        :raises Exception: If the subscription fails
+        """
+        # The response is followed directly by binary frames, so stop
+        # parsing messages once it has arrived
+        request_id, = self._send_requests([{'command': 'subscribe', 'format': fmt, 'decimate': decimate}])
+        if self._get_response(request_id, max_messages=1) is None:
+            raise Exception("Failed to subscribe")
+        buf = bytearray(self._reader.take_buffer())
+
+        dtype = np.dtype(ppk_protocol.STREAM_FORMATS[fmt])
+        header_size = ppk_protocol.STREAM_HEADER.size
+        self.stream_dropped_frames = 0
+        self.client.settimeout(None)
+        expected_sequence = None
+        try:
+            while True:
+                if not self._recv_exact(buf, header_size):
+                    return
+                payload_bytes, sequence, first_index = ppk_protocol.STREAM_HEADER.unpack_from(buf)
+                if not self._recv_exact(buf, header_size + payload_bytes):
+                    return
+                samples = np.frombuffer(bytes(buf[header_size:header_size + payload_bytes]), dtype=dtype)
+                del buf[:header_size + payload_bytes]
+                if expected_sequence is not None and sequence != expected_sequence:
+                    self.stream_dropped_frames += (sequence - expected_sequence) & 0xFFFFFFFF
+                expected_sequence = (sequence + 1) & 0xFFFFFFFF
+                yield first_index, samples
+        finally:
+            if self.client is not None and self.client.fileno() != -1:
+                self.client.settimeout(self.timeout)
+
+# Clients shared by all users in this process, by (host, port)
+_pool = {}
+_pool_lock = threading.Lock()
+
+def get_client(host: str = 'localhost', port: int = 5678, **kwargs):
+    """
+    Get the shared client for a daemon, connecting on first use. Test
+    keywords should use this instead of creating a client (and connection)
+    each time. Shared clients must not be used for stream() or
+    watch_events(), which take over the connection.
+
+    :param host: Host to connect to
+    :param port: Port to connect to
+    :param kwargs: PPKClient parameters used when the client is created
+    :return: PPKClient instance
+    """
+    with _pool_lock:
+        client = _pool.get((host, port))
+        if client is None:
+            client = PPKClient(host, port, **kwargs)
+            _pool[(host, port)] = client
+        return client
+
+def close_clients():
+    """
+    Close and forget all shared clients.
+    """
+    with _pool_lock:
+        for client in _pool.values():
+            client.close()
+        _pool.clear()
+
 if __name__ == '__main__':
     # Parse command line arguments
     parser = argparse.ArgumentParser()
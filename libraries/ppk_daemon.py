@@ -1,12 +1,91 @@
 import sys
+import os
 import argparse
 import time
 import threading
-import json
+import queue
+import select
 import port_helpers
 import read_board_config
+import socket
 import socketserver
-from ppk2_api.ppk2_api import PPK2_MP as PPK2_API
+import numpy as np
+from ppk2_api.ppk2_api import PPK2_API
+from ppk_sample_store import SampleStore
+from ppk_stats import RunningStats, LogHistogram, SAMPLE_RATE
+from ppk_pyramid import DecimationPyramid
+from ppk_capture_file import CaptureFileWriter
+from ppk_decoder import PPK2Decoder
+from ppk_events import EventDetector, parse_condition
+from ppk_timebase import SampleClock
+import ppk_protocol
+
+class SampleSubscriber:
+    """
+    Queue of encoded sample frames for one stream subscriber.
+
+    Samples are decimated by averaging (float32) or by taking every n-th
+    sample word (raw). When the subscriber falls more than MAX_QUEUED_FRAMES
+    behind, new frames are dropped and counted, leaving a gap in the frame
+    sequence numbers.
+
+    :param fmt: One of ppk_protocol.STREAM_FORMATS
+    :param decimate: Number of samples combined into each streamed sample
+    """
+    MAX_QUEUED_FRAMES = 256
+
+    def __init__(self, fmt: str = ppk_protocol.STREAM_FORMAT_FLOAT32, decimate: int = 1):
+        if fmt not in ppk_protocol.STREAM_FORMATS:
+            raise ValueError(f"Unknown stream format {fmt}")
+        if decimate < 1:
+            raise ValueError("Decimation must be at least 1")
+        self.format = fmt
+        self.decimate = decimate
+        self.frames = queue.Queue(maxsize=self.MAX_QUEUED_FRAMES)
+        self.sequence = 0
+        self.dropped_frames = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new capture.
+        """
+        self._carry = np.empty(0, dtype=ppk_protocol.STREAM_FORMATS[self.format])
+        self._next_index = 0
+
+    def push(self, samples: np.ndarray, words: np.ndarray, first_index: int):
+        """
+        Queue a block of new samples.
+
+        :param samples: Currents in microamperes
+        :param words: Raw PPK2 sample words
+        :param first_index: Capture index of the first sample in the block
+        """
+        data = samples if self.format == ppk_protocol.STREAM_FORMAT_FLOAT32 else words
+        if len(self._carry) == 0:
+            self._next_index = first_index
+            data = np.asarray(data, dtype=ppk_protocol.STREAM_FORMATS[self.format])
+        else:
+            data = np.concatenate((self._carry, data))
+        usable = len(data) - len(data) % self.decimate
+        self._carry = data[usable:]
+        if usable == 0:
+            return
+        out = data[:usable]
+        if self.decimate > 1:
+            out = out.reshape(-1, self.decimate)
+            if self.format == ppk_protocol.STREAM_FORMAT_FLOAT32:
+                out = out.mean(axis=1, dtype=np.float64).astype(ppk_protocol.STREAM_FORMATS[self.format])
+            else:
+                out = out[:, 0]
+        payload = np.ascontiguousarray(out).tobytes()
+        frame = ppk_protocol.STREAM_HEADER.pack(len(payload), self.sequence & 0xFFFFFFFF, self._next_index) + payload
+        self.sequence += 1
+        self._next_index += usable
+        try:
+            self.frames.put_nowait(frame)
+        except queue.Full:
+            self.dropped_frames += 1
 
 class PowerProfiler:
     """
@@ -16,8 +95,18 @@ class PowerProfiler:
     over relatively short periods of time (seconds to minutes).
 
     :param serial_port: Serial port of the PPK2 device with which to connect
+    :param is_source_mode: True to supply power to the DUT, False to use ampere meter mode
+    :param max_samples: Maximum number of samples to retain, None for unbounded
+    :param stats_only: Only keep running statistics by default, discarding raw samples
     """
-    def __init__(self, serial_port: str, is_source_mode: bool = False):
+    # Serial reads block until READ_CHUNK bytes (about 10 ms of samples) arrive
+    # or READ_TIMEOUT expires, and read the whole backlog if it is larger
+    READ_CHUNK = 4096
+    READ_TIMEOUT = 0.05
+
+    def __init__(self, serial_port: str, is_source_mode: bool = False, max_samples: int = None,
+                 stats_only: bool = False, capture_dir: str = None,
+                 capture_format: str = ppk_protocol.STREAM_FORMAT_FLOAT32):
         self.measuring = False
         self.measurement_thread = None
         self.ppk2 = None
@@ -29,9 +118,35 @@ class PowerProfiler:
         except Exception as e:
             print(f"Error initializing power profiler: {e}")
             raise e
+        self.ppk2.ser.timeout = self.READ_TIMEOUT
 
         self.stop = False
-        self.current_measurements = []
+        self.samples = SampleStore(max_samples=max_samples)
+        self.stats = RunningStats()
+        self.histogram = LogHistogram()
+        self.pyramid = DecimationPyramid(self.samples)
+        self.stats_only = stats_only
+        self.store_samples = not stats_only
+        self.decoder = PPK2Decoder(self.ppk2)
+        self._dropped_at_start = 0
+        self._measuring_event = threading.Event()
+        self._acquisition_lock = threading.Lock()
+        self.health = {'bytes_read': 0, 'reads': 0, 'read_errors': 0,
+                       'max_loop_latency_s': 0.0, 'max_backlog_bytes': 0}
+        self._subscribers = []
+        self._subscribers_lock = threading.Lock()
+        self.markers = []
+        self.events = EventDetector()
+        self.clock = SampleClock()
+        self.name = None
+        # PowerProfilerTCPServer of this profiler, for control of group captures
+        self.server = None
+        self.voltage_mv = None
+        self.capture_dir = capture_dir
+        self.capture_format = capture_format
+        self.capture = None
+        self.capture_info = None
+        self.simulator = None
         self.measurement_thread = threading.Thread(target=self._measurement_loop)
         self.measurement_thread.start()
 
@@ -51,15 +166,30 @@ class PowerProfiler:
         # Stop measurement thread
         self.measuring = False
         self.stop = True
+        self._measuring_event.set()
         if self.measurement_thread:
             self.measurement_thread.join()
             self.measurement_thread = None
+        self.close_capture()
 
-        # Clean up the PPK2 state
-        if self.ppk2:
-            self.set_output_voltage(0)
-            self.set_output(False)
-            del self.ppk2
+        # Clean up the PPK2 state (fails if the PPK2 was unplugged)
+        try:
+            if self.ppk2 and self.source_mode:
+                self.set_output_voltage(0)
+                self.set_output(False)
+        finally:
+            # Release the serial port now, rather than when PPK2_API is garbage collected
+            if self.ppk2:
+                try:
+                    self.ppk2.ser.close()
+                except Exception as e:
+                    print(f"Error closing power profiler serial port: {e}")
+                self.ppk2 = None
+                self.decoder.ppk2 = None
+            if self.simulator:
+                self.simulator.close()
+                self.simulator = None
+            unregister_profiler(self)
 
     def set_output_voltage(self, voltage_mv: int):
         """
@@ -74,6 +204,7 @@ class PowerProfiler:
         if voltage_mv < 0 or voltage_mv > self.ppk2.vdd_high:
             raise ValueError(f"Voltage must be between 0 and {self.ppk2.vdd_high} mV")
         self.ppk2.set_source_voltage(voltage_mv)
+        self.voltage_mv = voltage_mv
         return voltage_mv
 
     def set_output(self, state: bool):
@@ -95,173 +226,907 @@ class PowerProfiler:
         return False
 
     def _measurement_loop(self):
+        ser = self.ppk2.ser
+        last_read = None
         while not self.stop:
-            read_data = self.ppk2.get_data()
-            if read_data != b'':
-                samples, _ = self.ppk2.get_samples(read_data)
-                if self.measuring:
-                    self.current_measurements += samples
-            time.sleep(0.010)
+            if not self.measuring:
+                # Nothing to read until a measurement is started
+                last_read = None
+                self._measuring_event.wait(0.5)
+                continue
+
+            with self._acquisition_lock:
+                try:
+                    backlog = ser.in_waiting
+                    if last_read is not None:
+                        # Time spent away from the serial port since the last read
+                        latency = time.monotonic() - last_read
+                        self.health['max_loop_latency_s'] = max(self.health['max_loop_latency_s'], latency)
+                    self.health['max_backlog_bytes'] = max(self.health['max_backlog_bytes'], backlog)
+                    read_data = ser.read(max(self.READ_CHUNK, backlog))
+                    last_read = time.monotonic()
+                except Exception as e:
+                    print(f"Error reading from power profiler: {e}")
+                    self.health['read_errors'] += 1
+                    last_read = None
+                    time.sleep(0.1)
+                    continue
+                self.health['reads'] += 1
+                self.health['bytes_read'] += len(read_data)
+                if read_data != b'' and self.measuring:
+                    samples, words, _ = self.decoder.decode(read_data)
+                    self._process_samples(samples.astype(np.float32), words, last_read)
+
+    def _process_samples(self, samples: np.ndarray, words: np.ndarray, timestamp: float = None):
+        """
+        Add a block of new samples to the capture.
+
+        :param samples: Currents in microamperes
+        :param words: Raw PPK2 sample words the currents were decoded from
+        :param timestamp: Host time.monotonic() when the block was read
+        """
+        first_index = self.stats.count
+        if timestamp is not None and len(samples):
+            self.clock.add(first_index + len(samples), timestamp)
+        self.stats.update(samples)
+        self.histogram.update(samples)
+        if self.store_samples:
+            self.samples.append(samples)
+        self.pyramid.update(samples)
+        capture = self.capture
+        if capture is not None:
+            capture.write(samples if self.capture_format == ppk_protocol.STREAM_FORMAT_FLOAT32 else words,
+                          first_index)
+        self.events.update(samples, first_index)
+        with self._subscribers_lock:
+            for subscriber in self._subscribers:
+                subscriber.push(samples, words, first_index)
+
+    def add_subscriber(self, subscriber: SampleSubscriber):
+        """
+        Start passing new samples to a stream subscriber.
+        """
+        with self._subscribers_lock:
+            self._subscribers.append(subscriber)
+
+    def remove_subscriber(self, subscriber: SampleSubscriber):
+        """
+        Stop passing samples to a stream subscriber.
+        """
+        with self._subscribers_lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
 
-    def start_measuring(self):
+    def start_measuring(self, stats_only: bool = None, capture_file: str = None):
         """
         Start measuring current.
 
-        Will reset the array of current measurements.
+        Will reset the array of current measurements and the statistics.
+
+        :param stats_only: Only keep running statistics for this capture and
+            discard the raw samples. None to use the profiler default.
+        :param capture_file: Also write the samples to disk, to this file
+            name without extension in capture_dir. When capture_dir is set,
+            captures are always written to disk, to a time stamped file by
+            default.
+        :raises ValueError: If capture_file is not a plain file name or
+            capture_dir is not set
         """
-        if not self.measuring:
-            self.current_measurements = []
-            self.measuring = True
+        if self.measuring:
+            return
+        with self._acquisition_lock:
+            self._arm(stats_only, capture_file)
             self.ppk2.start_measuring()
+        self._measuring_event.set()
+
+    def capture_path(self, capture_file: str = None):
+        """
+        Get the path a capture is written to. Capture file names come from
+        clients, so they must not name a file outside capture_dir.
+
+        :param capture_file: File name without extension, None for a time
+            stamped name (or no capture file without capture_dir)
+        :return: Path without extension, None for no capture file
+        :raises ValueError: If capture_file is not a plain file name or
+            capture_dir is not set
+        """
+        if capture_file is None:
+            if not self.capture_dir:
+                return None
+            capture_file = time.strftime('ppk_%Y%m%d_%H%M%S')
+        if not self.capture_dir:
+            raise ValueError("Capture files require a capture directory (capture_dir)")
+        capture_file = str(capture_file)
+        if (capture_file in ('', '.', '..') or os.path.basename(capture_file) != capture_file
+                or '/' in capture_file or (os.altsep and os.altsep in capture_file)):
+            raise ValueError(f"Invalid capture file name '{capture_file}'")
+        return os.path.join(self.capture_dir, capture_file)
+
+    def _arm(self, stats_only: bool = None, capture_file: str = None):
+        """
+        Prepare a new capture, so that only PPK2_API.start_measuring() is
+        left to start it. Called with the acquisition lock held.
+        """
+        capture_file = self.capture_path(capture_file)
+        if capture_file is not None:
+            dtype = ppk_protocol.STREAM_FORMATS[self.capture_format]
+            self.capture = CaptureFileWriter(capture_file, dtype)
+            self.capture_info = None
+        self.store_samples = not (self.stats_only if stats_only is None else stats_only)
+        self.samples.clear()
+        self.stats.reset()
+        self.histogram.reset()
+        self.pyramid.reset()
+        self.markers = []
+        self.events.reset()
+        self.clock.reset()
+        self._dropped_at_start = self.decoder.dropped_samples
+        with self._subscribers_lock:
+            for subscriber in self._subscribers:
+                subscriber.reset()
+        # Samples of a previous measurement must not mix with the new one
+        self.ppk2.ser.reset_input_buffer()
+        self.decoder.reset()
+        self.measuring = True
 
     def stop_measuring(self):
         """
-        Stop measuring current.
+        Stop measuring current. Threshold events still in progress are
+        reported if they already lasted their minimum duration.
         """
         if self.measuring:
             self.measuring = False
+            self._measuring_event.clear()
             self.ppk2.stop_measuring()
+            # Wait for the block being processed, then end the threshold
+            # events still in progress
+            with self._acquisition_lock:
+                self.events.flush()
+            self.close_capture()
+
+    def get_health(self):
+        """
+        Get acquisition health counters since the profiler was created.
+        :return: Dictionary with measuring, bytes_read, reads, read_errors,
+            samples_decoded, counter_gaps, dropped_samples, max_loop_latency_s
+            (longest time between serial reads) and max_backlog_bytes (largest
+            serial input backlog seen before a read)
+        """
+        health = dict(self.health)
+        health.update({
+            'measuring': self.measuring,
+            'samples_decoded': self.decoder.samples_decoded,
+            'counter_gaps': self.decoder.counter_gaps,
+            'dropped_samples': self.decoder.dropped_samples,
+        })
+        return health
+
+    def close_capture(self):
+        """
+        Finish writing the capture file, if any.
+        """
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+            self.capture_info = capture.info()
+
+    def get_capture_info(self):
+        """
+        Get the files of the current or last capture written to disk.
+        :return: Dictionary with the capture path, data files and sample
+            counts, or None if no capture was written to disk
+        """
+        capture = self.capture
+        return capture.info() if capture is not None else self.capture_info
 
     def get_min_current_mA(self):
         """
         Get the minimum current measured in milliamperes.
         :return: Minimum current in mA
         """
-        if len(self.current_measurements) == 0:
-            return 0
-
-        return min(self.current_measurements) / 1000
+        return self.stats.to_dict()['min'] / 1000
 
     def get_max_current_mA(self):
         """
         Get the maximum current measured in milliamperes.
         :return: Maximum current in mA
         """
-        if len(self.current_measurements) == 0:
-            return 0
-
-        return max(self.current_measurements) / 1000
+        return self.stats.to_dict()['max'] / 1000
 
     def get_average_current_mA(self):
         """
         Get the average current measured in milliamperes.
         :return: Average current in mA
         """
-        if len(self.current_measurements) == 0:
-            return 0
+        return self.stats.to_dict()['mean'] / 1000 # measurements are in microamperes, divide by 1000
+
+    def get_stats(self):
+        """
+        Get the running statistics of the current capture.
+        :return: Dictionary with count, min/max/mean/std (in uA), variance (in uA^2),
+            duration_s, elapsed_s and dropped_samples (missing sample counter values)
+        """
+        stats = self.stats.to_dict()
+        stats['dropped_samples'] = self.decoder.dropped_samples - self._dropped_at_start
+        return stats
+
+    def get_memory_usage(self):
+        """
+        Get the memory used by the stored samples.
+        :return: Dictionary with sample counts and allocated/used bytes
+        """
+        info = self.samples.memory_info()
+        info['pyramid_bytes'] = self.pyramid.nbytes
+        info['histogram_bytes'] = self.histogram.nbytes
+        return info
+
+    def get_percentiles(self, percentiles=(50, 90, 99)):
+        """
+        Get percentiles of the current over the whole capture, from the
+        streaming histogram (also for stats_only captures).
+        :param percentiles: Percentiles (0-100)
+        :return: Dictionary of current (uA) by percentile, None values before the first samples
+        """
+        values = self.histogram.get_percentiles(percentiles)
+        return dict(zip((str(p) for p in percentiles), values))
+
+    def get_histogram(self, bins: int = 50, log_scale: bool = True):
+        """
+        Get the distribution of the current over the whole capture, from the
+        streaming histogram (also for stats_only captures).
+        :param bins: Number of bins between the minimum and maximum current
+        :param log_scale: Logarithmically spaced bins, otherwise linear
+        :return: Dictionary with lists edges (uA, bins + 1 values), counts and time_s
+        """
+        return self.histogram.get_histogram(bins, log_scale)
+
+    def get_range(self, t0: float, t1: float, max_points: int = 1000):
+        """
+        Get min/max/mean current between two times of the current capture,
+        reduced to at most max_points points.
+        :param t0: Start time in seconds since the start of the capture
+        :param t1: End time in seconds since the start of the capture
+        :param max_points: Maximum number of points
+        :return: Dictionary with bin_s and lists t, min, max, mean (uA) and count
+        """
+        return self.pyramid.get_range(t0, t1, max_points)
+
+    def get_timebase(self):
+        """
+        Get the estimated relation between the capture and the host clock.
+        :return: Dictionary with t0 (host time.monotonic() of the first
+            sample), sample_rate, jitter_s and records, or None before the
+            first samples
+        """
+        return self.clock.fit()
+
+    def get_window(self, t0: float, t1: float, max_points: int = 1000):
+        """
+        Get min/max/mean current between two host times, for comparing
+        captures of several power profilers on a common timebase.
+        :param t0: Start time as host time.monotonic()
+        :param t1: End time as host time.monotonic()
+        :param max_points: Maximum number of points
+        :return: Like get_range(), with t as host time.monotonic() values
+            and the timebase used, or None before the first samples
+        """
+        timebase = self.clock.fit()
+        if timebase is None:
+            return None
+        s0, s1 = self.clock.time_to_sample([t0, t1]) / SAMPLE_RATE
+        result = self.get_range(float(s0), float(s1), max_points)
+        result['t'] = self.clock.sample_to_time(np.asarray(result['t']) * SAMPLE_RATE).tolist()
+        result['timebase'] = timebase
+        return result
+
+    def mark(self, label: str):
+        """
+        Mark the start of a new segment of the current capture.
+        :param label: Name of the segment
+        :return: Dictionary with the label, sample index and host time of the marker
+        """
+        if not self.measuring:
+            raise Exception("Not measuring")
+        marker = {'label': label, 'index': self.stats.count, 'time': time.time()}
+        self.markers.append(marker)
+        return marker
+
+    def add_threshold(self, condition: str = None, above: bool = True, threshold_ua: float = None,
+                      min_duration_s: float = 0.0, label: str = None):
+        """
+        Detect events where the current crosses a threshold for a minimum time.
+        Thresholds are kept across captures.
+
+        :param condition: Condition such as "> 5 mA for > 2 ms", instead of
+            above, threshold_ua and min_duration_s
+        :param above: True to detect currents above the threshold, False for below
+        :param threshold_ua: Threshold in microamperes
+        :param min_duration_s: Minimum event duration in seconds
+        :param label: Name reported with the events
+        :return: Threshold id
+        """
+        if condition is not None:
+            above, threshold_ua, min_duration_s = parse_condition(condition)
+        if threshold_ua is None:
+            raise ValueError("No threshold given")
+        return self.events.add_threshold(bool(above), float(threshold_ua), float(min_duration_s), label)
+
+    def get_events(self, since: int = 0, threshold_id: int = None):
+        """
+        Get the threshold events of the current capture.
+
+        :param since: Only return events with a sequence number ('seq') above this
+        :param threshold_id: Only return events of this threshold
+        :return: List of events with start/end sample index, start_s,
+            duration_s, peak_ua (the minimum for thresholds below), mean_ua and charge_uAh
+        """
+        return self.events.get_events(since, threshold_id)
+
+    def get_segment_stats(self, percentiles=(50, 90, 99), voltage_mv: int = None):
+        """
+        Get statistics for each marked segment of the current capture.
+
+        A segment runs from its marker to the next marker, or to the newest
+        sample for the last one. Samples before the first marker form a
+        segment with label None.
+
+        :param percentiles: Percentiles (0-100) of the current to report
+        :param voltage_mv: Supply voltage for the energy calculation, defaults
+            to the source voltage (energy is None if neither is known)
+        :return: List of dictionaries with label, start/stop sample index,
+            count, min/max/mean (uA), percentiles (uA), charge_uAh and energy_uWh
+        """
+        if not self.store_samples:
+            raise Exception("Samples are not stored (stats_only)")
+        if voltage_mv is None:
+            voltage_mv = self.voltage_mv if self.source_mode else None
+        markers = list(self.markers)
+        with self.samples.lock:
+            end = self.samples.total
+            bounds = [(None, 0)] if not markers or markers[0]['index'] > 0 else []
+            bounds += [(m['label'], m['index']) for m in markers]
+            segments = []
+            for i, (label, start) in enumerate(bounds):
+                stop = bounds[i + 1][1] if i + 1 < len(bounds) else end
+                data = self.samples.get(start, stop)
+                segment = {'label': label, 'start': start, 'stop': stop, 'count': len(data),
+                           'truncated': start < self.samples.start_index}
+                if len(data):
+                    total = float(data.sum(dtype=np.float64))
+                    charge_uAh = total / SAMPLE_RATE / 3600
+                    segment.update({
+                        'min': float(data.min()),
+                        'max': float(data.max()),
+                        'mean': total / len(data),
+                        'percentiles': dict(zip((str(p) for p in percentiles),
+                                                np.percentile(data, percentiles).tolist())),
+                        'duration_s': len(data) / SAMPLE_RATE,
+                        'charge_uAh': charge_uAh,
+                        'energy_uWh': charge_uAh * voltage_mv / 1000 if voltage_mv is not None else None,
+                    })
+                segments.append(segment)
+        return segments
+
+# Power profilers running in this process by name (serial number), for group captures
+profilers = {}
+profilers_lock = threading.Lock()
+
+def register_profiler(name: str, profiler: PowerProfiler):
+    """
+    Make a power profiler available for group captures under a name.
+    """
+    with profilers_lock:
+        profiler.name = name
+        profilers[name] = profiler
+
+def unregister_profiler(profiler: PowerProfiler):
+    """
+    Remove a power profiler from the group capture registry.
+    """
+    with profilers_lock:
+        if profilers.get(profiler.name) is profiler:
+            del profilers[profiler.name]
+
+def _group_members(names: list = None):
+    """
+    :return: List of (name, profiler) tuples sorted by name
+    :raises KeyError: If a name is not registered
+    """
+    with profilers_lock:
+        if names is None:
+            names = list(profilers)
+        missing = [name for name in names if name not in profilers]
+        if missing:
+            raise KeyError(f"Unknown power profilers: {', '.join(map(str, missing))}")
+        return sorted((name, profilers[name]) for name in set(names))
+
+def start_group(names: list = None, stats_only: bool = None, capture_file: str = None):
+    """
+    Start a capture on several power profilers together.
+
+    Measurements that are running are stopped first. Every profiler is
+    armed (buffers reset, serial input flushed) while all their acquisition
+    loops are held, then the start commands are sent back to back, so the
+    captures start within a few milliseconds of each other. The remaining
+    offset is measured by each profiler's sample clock, see get_window().
+
+    :param names: Names of the power profilers, None for all in this process
+    :param stats_only: As for PowerProfiler.start_measuring()
+    :param capture_file: Capture file name prefix, the profiler name is appended
+    :return: Dictionary with the member names and the host time.monotonic()
+        at which the start commands were sent
+    :raises KeyError: If a name is not registered
+    :raises ValueError: If a capture file name is invalid (see PowerProfiler.capture_path())
+    :raises Exception: If a member fails to start, all members are stopped
+    """
+    members = _group_members(names)
+    # Check the capture file names before anything is stopped
+    for name, profiler in members:
+        profiler.capture_path(f"{capture_file}_{name}" if capture_file else None)
+    for _, profiler in members:
+        profiler.stop_measuring()
+    # Always locked in name order, so concurrent group starts cannot deadlock
+    for _, profiler in members:
+        profiler._acquisition_lock.acquire()
+    armed = []
+    try:
+        try:
+            for name, profiler in members:
+                profiler._arm(stats_only, f"{capture_file}_{name}" if capture_file else None)
+                armed.append(profiler)
+            start_time = time.monotonic()
+            for _, profiler in members:
+                profiler.ppk2.start_measuring()
+        finally:
+            for _, profiler in members:
+                profiler._acquisition_lock.release()
+    except Exception:
+        # Do not leave members armed (or started) when the group failed to start
+        for profiler in armed:
+            try:
+                profiler.stop_measuring()
+            except Exception as e:
+                print(f"{profiler.name}: Error stopping measurement: {e}")
+        raise
+    for _, profiler in members:
+        profiler._measuring_event.set()
+    return {'members': [name for name, _ in members], 'start_time': start_time}
+
+def stop_group(names: list = None):
+    """
+    Stop measuring on several power profilers.
+
+    :param names: Names of the power profilers, None for all in this process
+    :return: List of member names
+    :raises KeyError: If a name is not registered
+    """
+    members = _group_members(names)
+    for _, profiler in members:
+        profiler.stop_measuring()
+    return [name for name, _ in members]
+
+def get_group_window(t0: float, t1: float, names: list = None, max_points: int = 1000):
+    """
+    Get the same host time window from several power profilers.
 
-        average_current_mA = (sum(self.current_measurements) / len(self.current_measurements)) / 1000 # measurements are in microamperes, divide by 1000
-        return average_current_mA
+    :param t0: Start time as host time.monotonic()
+    :param t1: End time as host time.monotonic()
+    :param names: Names of the power profilers, None for all in this process
+    :param max_points: Maximum number of points per profiler
+    :return: Dictionary of PowerProfiler.get_window() results by name
+    :raises KeyError: If a name is not registered
+    """
+    return {name: profiler.get_window(t0, t1, max_points) for name, profiler in _group_members(names)}
 
-class PowerProfilerTCPServer(socketserver.TCPServer):
+class PowerProfilerTCPServer(socketserver.ThreadingTCPServer):
     """
-    TCP Server to handle power profiler commands. Since this
-    class inherits from socketserver.TCPServer, it will handle
-    connections serially. It will block and not accept new
-    connections until the current connection is closed.
+    TCP Server to handle power profiler commands. Each connection
+    is handled in its own thread, so several clients can share the
+    power profiler (e.g. a test and a monitoring dashboard).
+
+    Only one client at a time controls the power profiler (start,
+    stop and output commands). The first client to send a control
+    command becomes the controller until it disconnects or sends
+    'release_control'. Other clients can still read statistics and
+    subscribe to the sample stream. Group commands make the client the
+    controller of every member's server, and are refused if another client
+    controls one of them.
     """
+    daemon_threads = True
+    # Allow a restarted server to listen on the same port right away
+    allow_reuse_address = True
+    CONTROL_COMMANDS = ppk_protocol.CONTROL_COMMANDS
+
     def __init__(self, server_address, RequestHandlerClass, profiler):
         self.profiler = profiler
+        profiler.server = self
+        self.controller = None
+        self.control_lock = threading.Lock()
+        self.connections = set()
         super().__init__(server_address, RequestHandlerClass)
 
+    def close_connections(self):
+        """
+        Disconnect all clients, e.g. after shutdown() when the power profiler
+        is going away. Clients see the connection close and can reconnect.
+        """
+        with self.control_lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def claim_control(self, handler):
+        """
+        Make handler the controlling client if there is none.
+        :return: True if handler is the controlling client
+        """
+        with self.control_lock:
+            if self.controller is None:
+                self.controller = handler
+            return self.controller is handler
+
+    def release_control(self, handler):
+        """
+        Give up control if handler is the controlling client.
+        :return: True if handler was the controlling client
+        """
+        with self.control_lock:
+            if self.controller is handler:
+                self.controller = None
+                return True
+            return False
+
 class PowerProfilerCommandHandler(socketserver.BaseRequestHandler):
     """
     Request handler for power profiler commands.
     """
-    def handle(self):
-        # Access our dedicated Power Profiler instance via self.server.profiler
+    STREAM_POLL_INTERVAL = 1.0
+
+    def stream_samples(self, subscriber: SampleSubscriber):
+        """
+        Send sample frames to the client until it disconnects.
+        """
         profiler = self.server.profiler
-        
+        profiler.add_subscriber(subscriber)
+        try:
+            while True:
+                try:
+                    frame = subscriber.frames.get(timeout=self.STREAM_POLL_INTERVAL)
+                except queue.Empty:
+                    # Check for a closed connection while no samples are arriving
+                    readable, _, _ = select.select([self.request], [], [], 0)
+                    if readable and not self.request.recv(1024):
+                        break
+                    continue
+                self.request.sendall(frame)
+        except OSError:
+            pass
+        finally:
+            profiler.remove_subscriber(subscriber)
+
+    def stream_events(self):
+        """
+        Send threshold events to the client as JSON messages until it disconnects.
+        """
+        events = self.server.profiler.events
+        watcher = events.add_watcher()
+        try:
+            while True:
+                try:
+                    event = watcher.get(timeout=self.STREAM_POLL_INTERVAL)
+                except queue.Empty:
+                    readable, _, _ = select.select([self.request], [], [], 0)
+                    if readable and not self.request.recv(1024):
+                        break
+                    continue
+                self.send_message({'event': event})
+        except OSError:
+            pass
+        finally:
+            events.remove_watcher(watcher)
+
+    def setup(self):
+        # Servers of other power profilers this client controls through group commands
+        self.group_servers = set()
+        with self.server.control_lock:
+            self.server.connections.add(self.request)
+
+    def finish(self):
+        with self.server.control_lock:
+            self.server.connections.discard(self.request)
+        # Stop measuring when the controlling client disconnects
+        for server in [self.server] + list(self.group_servers):
+            if server.release_control(self):
+                server.profiler.stop_measuring()
+
+    def claim_group_control(self, members: list):
+        """
+        Make this client the controller of the servers of all group members,
+        or of none of them if another client controls one.
+
+        :param members: List of (name, profiler) tuples
+        :return: True if this client controls all members
+        """
+        claimed = []
+        for _, profiler in members:
+            server = profiler.server
+            if server is None or server is self.server or server in self.group_servers:
+                continue
+            if not server.claim_control(self):
+                for claimed_server in claimed:
+                    claimed_server.release_control(self)
+                return False
+            claimed.append(server)
+        self.group_servers.update(claimed)
+        return True
+
+    def release_group_control(self):
+        """
+        Give up control of the servers claimed by group commands.
+        """
+        for server in self.group_servers:
+            server.release_control(self)
+        self.group_servers.clear()
+
+    def send_message(self, message: dict, request=None):
+        """
+        Send a newline terminated JSON message, echoing the request id.
+        """
+        if isinstance(request, dict) and 'id' in request:
+            message['id'] = request['id']
+        self.request.sendall(ppk_protocol.encode_message(message))
+
+    def handle(self):
+        reader = ppk_protocol.MessageReader()
         while True:
-            # Receive a request
-            request = self.request.recv(1024)
+            # Receive requests, a segment may hold several or part of one
+            request = self.request.recv(65536)
             if not request:
-                # Stop measuring on disconnect
-                profiler.stop_measuring()
                 break
 
-            # Parse the request
-            try:
-                json_request = json.loads(request.decode('utf-8'))
-            except json.JSONDecodeError as e:
-                print(f"JSON decode error: {e}")
-                error_response = json.dumps({'error': 'Malformed JSON'})
-                self.request.send(error_response.encode('utf-8'))
-                continue
+            for json_request, error in reader.feed(request):
+                if error is not None:
+                    print(f"JSON decode error: {error}")
+                    self.send_message({'error': 'Malformed JSON'})
+                    continue
+                if not self.handle_request(json_request):
+                    return
+
+    def handle_request(self, json_request):
+        """
+        Execute a single request and send its response.
+
+        :param json_request: Decoded request
+        :return: False if the connection no longer accepts requests
+        """
+        # Access our dedicated Power Profiler instance via self.server.profiler
+        profiler = self.server.profiler
+
+        if not isinstance(json_request, dict):
+            self.send_message({'error': 'Request must be a JSON object'})
+            return True
+
+        if json_request.get('command') in self.server.CONTROL_COMMANDS and not self.server.claim_control(self):
+            self.send_message({'error': 'Another client controls the power profiler'}, json_request)
+            return True
 
+        response = 0
+        if 'command' not in json_request:
+            response = -1
+        elif json_request['command'] == 'release_control':
+            self.release_group_control()
+            response = self.server.release_control(self)
+        elif json_request['command'] == 'start':
+            try:
+                profiler.start_measuring(json_request.get('stats_only', None), json_request.get('capture_file', None))
+                response = 0
+            except (OSError, ValueError) as e:
+                print(f"Error opening capture file: {e}")
+                response = -1
+        elif json_request['command'] == 'stop':
+            profiler.stop_measuring()
             response = 0
-            if 'command' not in json_request:
+        elif json_request['command'] == 'get_min_current':
+            response = profiler.get_min_current_mA()
+        elif json_request['command'] == 'get_max_current':
+            response = profiler.get_max_current_mA()
+        elif json_request['command'] == 'get_average_current':
+            response = profiler.get_average_current_mA()
+        elif json_request['command'] == 'subscribe':
+            try:
+                subscriber = SampleSubscriber(json_request.get('format', ppk_protocol.STREAM_FORMAT_FLOAT32),
+                                              int(json_request.get('decimate', 1)))
+            except (TypeError, ValueError) as e:
+                self.send_message({'error': str(e)}, json_request)
+                return True
+            # The connection carries only sample frames after this response
+            self.send_message({'result': {'format': subscriber.format,
+                                          'decimate': subscriber.decimate,
+                                          'sample_rate': SAMPLE_RATE / subscriber.decimate}}, json_request)
+            self.stream_samples(subscriber)
+            return False
+        elif json_request['command'] == 'watch':
+            # The connection carries only event messages after this response
+            self.send_message({'result': 0}, json_request)
+            self.stream_events()
+            return False
+        elif json_request['command'] == 'add_threshold':
+            try:
+                response = profiler.add_threshold(json_request.get('condition', None),
+                                                  json_request.get('above', True),
+                                                  json_request.get('threshold_ua', None),
+                                                  json_request.get('min_duration_s', 0.0),
+                                                  json_request.get('label', None))
+            except (TypeError, ValueError) as e:
+                print(f"Error adding threshold: {e}")
                 response = -1
-            elif json_request['command'] == 'start':
-                profiler.start_measuring()
-                response = 0
-            elif json_request['command'] == 'stop':
-                profiler.stop_measuring()
-                response = 0
-            elif json_request['command'] == 'get_min_current':
-                response = profiler.get_min_current_mA()
-            elif json_request['command'] == 'get_max_current':
-                response = profiler.get_max_current_mA()
-            elif json_request['command'] == 'get_average_current':
-                response = profiler.get_average_current_mA()
-            elif json_request['command'] == 'set_output':
-                if 'value' not in json_request:
-                    response = False
-                else:
-                    try:
-                        response = profiler.set_output(bool(json_request['value']))
-                    except Exception as e:
-                        print(f"Error setting output: {e}")
-                        response = False
-            elif json_request['command'] == 'set_output_voltage':
-                if 'value' not in json_request:
+        elif json_request['command'] == 'remove_threshold':
+            response = profiler.events.remove_threshold(json_request.get('threshold_id', None))
+        elif json_request['command'] == 'get_thresholds':
+            response = profiler.events.get_thresholds()
+        elif json_request['command'] == 'get_events':
+            try:
+                response = profiler.get_events(int(json_request.get('since', 0)), json_request.get('threshold_id', None))
+            except (TypeError, ValueError) as e:
+                print(f"Error getting events: {e}")
+                response = -1
+        elif json_request['command'] == 'get_stats':
+            response = profiler.get_stats()
+        elif json_request['command'] == 'get_memory_usage':
+            response = profiler.get_memory_usage()
+        elif json_request['command'] == 'get_range':
+            try:
+                response = profiler.get_range(float(json_request['t0']), float(json_request['t1']),
+                                              int(json_request.get('max_points', 1000)))
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Error getting range: {e}")
+                response = -1
+        elif json_request['command'] in ('group_start', 'group_stop'):
+            try:
+                members = _group_members(json_request.get('members', None))
+            except KeyError as e:
+                print(f"Error in group command: {e}")
+                members = None
+                response = -1
+            if members is not None:
+                if not self.claim_group_control(members):
+                    self.send_message({'error': 'Another client controls a power profiler of the group'},
+                                      json_request)
+                    return True
+                names = [name for name, _ in members]
+                try:
+                    if json_request['command'] == 'group_start':
+                        response = start_group(names, json_request.get('stats_only', None),
+                                               json_request.get('capture_file', None))
+                    else:
+                        response = stop_group(names)
+                except Exception as e:
+                    print(f"Error in group command: {e}")
                     response = -1
-                else:
-                    try:
-                        response = profiler.set_output_voltage(json_request['value'])
-                    except Exception as e:
-                        print(f"Error setting output voltage: {e}")
-                        response = -1
+        elif json_request['command'] == 'list_profilers':
+            with profilers_lock:
+                response = sorted(profilers)
+        elif json_request['command'] == 'get_timebase':
+            response = profiler.get_timebase()
+        elif json_request['command'] == 'get_window':
+            try:
+                response = get_group_window(float(json_request['t0']), float(json_request['t1']),
+                                            json_request.get('members', [profiler.name]),
+                                            int(json_request.get('max_points', 1000)))
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Error getting window: {e}")
+                response = -1
+        elif json_request['command'] == 'get_percentiles':
+            try:
+                response = profiler.get_percentiles(list(json_request.get('percentiles', (50, 90, 99))))
+            except (TypeError, ValueError) as e:
+                print(f"Error getting percentiles: {e}")
+                response = -1
+        elif json_request['command'] == 'get_histogram':
+            try:
+                response = profiler.get_histogram(int(json_request.get('bins', 50)),
+                                                  bool(json_request.get('log_scale', True)))
+            except (TypeError, ValueError) as e:
+                print(f"Error getting histogram: {e}")
+                response = -1
+        elif json_request['command'] == 'get_health':
+            response = profiler.get_health()
+        elif json_request['command'] == 'get_capture_info':
+            response = profiler.get_capture_info()
+        elif json_request['command'] == 'mark':
+            try:
+                response = profiler.mark(str(json_request.get('label', '')))
+            except Exception as e:
+                print(f"Error marking segment: {e}")
+                response = -1
+        elif json_request['command'] == 'segment_stats':
+            try:
+                response = profiler.get_segment_stats(json_request.get('percentiles', (50, 90, 99)),
+                                                      json_request.get('voltage_mv', None))
+            except Exception as e:
+                print(f"Error getting segment statistics: {e}")
+                response = -1
+        elif json_request['command'] == 'set_output':
+            if 'value' not in json_request:
+                response = False
             else:
+                try:
+                    response = profiler.set_output(bool(json_request['value']))
+                except Exception as e:
+                    print(f"Error setting output: {e}")
+                    response = False
+        elif json_request['command'] == 'set_output_voltage':
+            if 'value' not in json_request:
                 response = -1
+            else:
+                try:
+                    response = profiler.set_output_voltage(json_request['value'])
+                except Exception as e:
+                    print(f"Error setting output voltage: {e}")
+                    response = -1
+        else:
+            response = -1
 
-            # Send a response
-            r = json.dumps({'result': response})
-            self.request.send(r.encode('utf-8'))
+        # Send a response
+        self.send_message({'result': response}, json_request)
+        return True
 
 def start_server(config):
     """
     Start a Power Profiler TCP server based on the provided configuration.
 
-    :param config: Dictionary containing 'port' and 'serial_number' keys
+    :param config: Dictionary containing 'tcp_port' and 'sn' keys, and optionally
+        'voltage_mv', 'max_samples', 'stats_only', 'capture_dir' and 'capture_format'.
+        With a 'simulator' key (a ppk_simulator.PPK2Waveform config, or true for
+        the default waveform), a simulated PPK2 is used instead of 'sn'.
 
     :return: Tuple of (server instance, PowerProfiler instance) or (None, None)
     """
     port = config.get('tcp_port', 5678)
     serial_number = config.get('sn', None)
     voltage = config.get('voltage_mv', None)
+    max_samples = config.get('max_samples', None)
+    stats_only = config.get('stats_only', False)
+    capture_dir = config.get('capture_dir', None)
+    capture_format = config.get('capture_format', ppk_protocol.STREAM_FORMAT_FLOAT32)
+    simulator_config = config.get('simulator', None)
 
+    simulator = None
+    pp = None
     try:
-        # Handle serial number
-        ports = port_helpers.get_ports_with_serial_number(serial_number)
-        if len(ports) == 0:
-            raise Exception(f"No PPK2 device found with serial number {serial_number}")
+        if simulator_config:
+            import ppk_simulator
+            waveform_config = simulator_config if isinstance(simulator_config, dict) else {}
+            simulator = ppk_simulator.PPK2Simulator(ppk_simulator.PPK2Waveform.from_config(waveform_config))
+            serial_port = simulator.port_name
+            serial_number = serial_number or f'simulator-{port}'
+        else:
+            # Handle serial number
+            ports = port_helpers.get_ports_with_serial_number(serial_number)
+            if len(ports) == 0:
+                raise Exception(f"No PPK2 device found with serial number {serial_number}")
 
-        if len(ports) > 1:
-            raise Exception(f"Multiple PPK2 devices found with serial number {serial_number}")
-        serial_port = ports[0].device
+            if len(ports) > 1:
+                raise Exception(f"Multiple PPK2 devices found with serial number {serial_number}")
+            serial_port = ports[0].device
 
         # If voltage is specified, initialize in source mode with that voltage
         if voltage:
             print(f"{serial_number}: Initializing in source mode with {voltage} mV")
-            pp = PowerProfiler(serial_port, True)
+            pp = PowerProfiler(serial_port, True, max_samples, stats_only, capture_dir, capture_format)
+            pp.simulator = simulator
             pp.set_output_voltage(voltage)
             pp.set_output(True)
         
         # Else, initialize in ampere measurement mode
         else:
             print(f"{serial_number}: Initializing in ampere measurement mode")
-            pp = PowerProfiler(serial_port, False)
+            pp = PowerProfiler(serial_port, False, max_samples, stats_only, capture_dir, capture_format)
+            pp.simulator = simulator
+        register_profiler(serial_number, pp)
 
         # Run the TCP server
         server = PowerProfilerTCPServer(('localhost', port), PowerProfilerCommandHandler, pp)
@@ -272,12 +1137,25 @@ def start_server(config):
         return server, pp
     except Exception as e:
         print(f"Error starting server for {serial_number}: {e}")
+        if pp is not None:
+            # Stops the measurement thread, releases the serial port (and
+            # simulator) and unregisters the profiler
+            try:
+                pp.close()
+            except Exception as close_error:
+                print(f"Error closing power profiler for {serial_number}: {close_error}")
+        elif simulator:
+            simulator.close()
         return None, None
 
 if __name__ == "__main__":
     # Parse command line arguments
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', type=str, default=None, help='Path to board configuration file')
+    parser.add_argument('--processes', action='store_true', help='Run each power profiler in its own process')
+    parser.add_argument('--fleet', action='store_true',
+                        help='Start and restart power profilers as they are plugged in and out')
+    parser.add_argument('--status-port', type=int, default=None, help='TCP port for fleet or supervisor status requests')
     args = parser.parse_args()
 
     # Need the board config to continue
@@ -288,9 +1166,43 @@ if __name__ == "__main__":
     # Read board configuration
     board_config = read_board_config.read_board_config(args.config)
 
+    # Run each power profiler in a supervised worker process
+    if args.processes:
+        import ppk_supervisor
+        configs = [ppk for board in board_config for ppk in board.get('ppk', [])]
+        if len(configs) == 0:
+            print("No power profilers in the configuration. Exiting.")
+            exit(1)
+        supervisor = ppk_supervisor.PPKSupervisor(configs, status_port=args.status_port)
+        supervisor.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("Shutting down workers...")
+            supervisor.stop()
+            sys.exit(0)
+
+    # Keep a server running for each power profiler that is plugged in
+    if args.fleet:
+        import ppk_fleet
+        configs = [ppk for board in board_config for ppk in board.get('ppk', [])]
+        if len(configs) == 0:
+            print("No power profilers in the configuration. Exiting.")
+            exit(1)
+        fleet = ppk_fleet.PPKFleet(configs, status_port=args.status_port)
+        fleet.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            print("Shutting down servers...")
+            fleet.stop()
+            sys.exit(0)
+
     # Start servers for each power profiler in the configuration
     servers = []
-    profilers = []
+    running_profilers = []
     for board in board_config:
         if 'ppk' in board:
             for ppk in board['ppk']:
@@ -299,7 +1211,7 @@ if __name__ == "__main__":
                     print(f"Failed to start server for board {board.get('name', 'unknown')}")
                 else:
                     servers.append(server)
-                    profilers.append(pp)
+                    running_profilers.append(pp)
 
     # If we didn't start anything, just exit
     if len(servers) == 0:
@@ -316,7 +1228,7 @@ if __name__ == "__main__":
             server.shutdown()
             server.server_close()
 
-        for pp in profilers:
+        for pp in running_profilers:
             pp.close()
 
         sys.exit(0)
@@ -0,0 +1,142 @@
+import numpy as np
+
+class PPK2Decoder:
+    """
+    Vectorized decoder for PPK2 sample words.
+
+    Produces the same currents as PPK2_API.get_samples(), including its spike
+    filter, but with numpy array operations instead of per-sample Python. The
+    calibration modifiers (from get_modifiers()) are applied as lookup tables
+    indexed by the measurement range. The spike filter is a pair of
+    exponential moving averages; they are computed in short blocks with
+    cumulative products, as their coefficients vary per sample (the average is
+    not updated for the first samples after switching to range 4).
+
+    The 6-bit sample counter is checked for gaps, which are counted in
+    dropped_samples.
+
+    :param ppk2: PPK2_API instance providing the modifiers and source voltage
+    """
+    ADC_MASK = 0x3FFF
+    RANGE_SHIFT = 14
+    RANGE_MASK = 0x7
+    MAX_RANGE = 4
+    COUNTER_SHIFT = 18
+    COUNTER_MASK = 0x3F
+    LOGIC_SHIFT = 24
+    # Samples per cumulative product block, short enough to avoid underflow
+    EMA_BLOCK = 512
+
+    def __init__(self, ppk2):
+        self.ppk2 = ppk2
+        self.samples_decoded = 0
+        self.dropped_samples = 0
+        self.counter_gaps = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the decoding state, e.g. when a new measurement starts. The
+        metrics are kept.
+        """
+        self._remainder = b''
+        self.rolling_avg = None
+        self.rolling_avg4 = None
+        self.prev_range = None
+        self.after_spike = 0
+        self._prev_counter = None
+
+    def _lookup_tables(self):
+        modifiers = self.ppk2.modifiers
+        return {key: np.array([float(modifiers[key][str(r)]) for r in range(self.MAX_RANGE + 1)])
+                for key in ('O', 'R', 'UG', 'GS', 'GI', 'S', 'I')}
+
+    def decode(self, buf: bytes):
+        """
+        Decode raw bytes read from the PPK2. Bytes of an incomplete sample word
+        are kept for the next call.
+
+        :param buf: Bytes from PPK2_API.get_data()
+        :return: Tuple of (currents in microamperes as float64 array,
+            sample words as uint32 array, logic bits as uint8 array)
+        """
+        data = self._remainder + buf
+        aligned = len(data) - len(data) % 4
+        self._remainder = data[aligned:]
+        words = np.frombuffer(data, dtype='<u4', count=aligned // 4)
+        logic = (words >> self.LOGIC_SHIFT).astype(np.uint8)
+        if len(words) == 0:
+            return np.empty(0), words, logic
+        self.__check_counter(words)
+
+        vdd = self.ppk2.current_vdd
+        if not vdd:
+            # PPK2_API cannot convert samples before the source voltage is known
+            return np.empty(0), words, logic
+
+        ranges = np.minimum((words >> self.RANGE_SHIFT) & self.RANGE_MASK, self.MAX_RANGE).astype(np.intp)
+        adc_raw = (words & self.ADC_MASK).astype(np.float64) * 4
+        lut = self._lookup_tables()
+        result_without_gain = (adc_raw - lut['O'][ranges]) * (self.ppk2.adc_mult / lut['R'][ranges])
+        adc = lut['UG'][ranges] * (result_without_gain * (lut['GS'][ranges] * result_without_gain + lut['GI'][ranges])
+                                   + (lut['S'][ranges] * (vdd / 1000) + lut['I'][ranges]))
+
+        samples = self.__spike_filter(adc, ranges)
+        self.samples_decoded += len(samples)
+        return samples * 10**6, words, logic
+
+    def __check_counter(self, words: np.ndarray):
+        counters = ((words >> self.COUNTER_SHIFT) & self.COUNTER_MASK).astype(np.int64)
+        if self._prev_counter is not None:
+            counters_prev = np.concatenate(([self._prev_counter], counters[:-1]))
+        else:
+            counters_prev = np.concatenate(([counters[0] - 1], counters[:-1]))
+        missing = (counters - counters_prev - 1) & self.COUNTER_MASK
+        self.counter_gaps += int(np.count_nonzero(missing))
+        self.dropped_samples += int(missing.sum())
+        self._prev_counter = int(counters[-1])
+
+    def __spike_filter(self, adc: np.ndarray, ranges: np.ndarray):
+        n = len(adc)
+        window_len = self.ppk2.spike_filter_samples
+        idx = np.arange(n)
+
+        # Position of each sample in the spike filter window that starts at a range change
+        prev_ranges = np.concatenate(([ranges[0] if self.prev_range is None else self.prev_range], ranges[:-1]))
+        changes = np.where(ranges != prev_ranges, idx, np.iinfo(np.int64).min)
+        if self.after_spike > 0:
+            # Window still open from the previous block
+            changes[0] = max(changes[0], -(window_len - self.after_spike))
+        last_change = np.maximum.accumulate(changes)
+        pos = idx - last_change
+        in_window = (last_change > np.iinfo(np.int64).min) & (pos < window_len)
+        range4 = ranges == self.MAX_RANGE
+        # The averages are not updated at the first two window samples in range 4
+        frozen = in_window & range4 & (pos < 2)
+
+        if self.rolling_avg is None:
+            self.rolling_avg = adc[0]
+            self.rolling_avg4 = adc[0]
+        avg = self.__ema(adc, np.where(frozen, 0.0, self.ppk2.spike_filter_alpha), self.rolling_avg)
+        avg4 = self.__ema(adc, np.where(frozen, 0.0, self.ppk2.spike_filter_alpha5), self.rolling_avg4)
+        self.rolling_avg = avg[-1]
+        self.rolling_avg4 = avg4[-1]
+
+        self.prev_range = int(ranges[-1])
+        remaining = window_len - pos[-1] - 1
+        self.after_spike = int(remaining) if in_window[-1] else 0
+
+        return np.where(in_window, np.where(range4, avg4, avg), adc)
+
+    def __ema(self, x: np.ndarray, alpha: np.ndarray, initial: float):
+        """
+        y[i] = alpha[i] * x[i] + (1 - alpha[i]) * y[i - 1], with y[-1] = initial
+        """
+        y = np.empty_like(x)
+        prev = initial
+        for start in range(0, len(x), self.EMA_BLOCK):
+            stop = min(start + self.EMA_BLOCK, len(x))
+            decay = np.cumprod(1 - alpha[start:stop])
+            y[start:stop] = decay * (prev + np.cumsum(alpha[start:stop] * x[start:stop] / decay))
+            prev = y[stop - 1]
+        return y
@@ -0,0 +1,262 @@
+import collections
+import queue
+import re
+import threading
+import numpy as np
+from ppk_stats import SAMPLE_RATE
+
+CURRENT_UNITS = {'a': 1e6, 'ma': 1e3, 'ua': 1.0, 'µa': 1.0, 'na': 1e-3}
+TIME_UNITS = {'s': 1.0, 'ms': 1e-3, 'us': 1e-6, 'µs': 1e-6}
+CONDITION_RE = re.compile(r'^\s*([<>])\s*([0-9.eE+-]+)\s*([a-zA-Zµ]+)\s*(?:for\s*>?\s*([0-9.eE+-]+)\s*([a-zA-Zµ]+))?\s*$')
+
+def parse_condition(condition: str):
+    """
+    Parse a threshold condition such as "> 5 mA for > 2 ms" or "< 10 uA for 1 s".
+
+    :return: Tuple of (above, threshold_ua, min_duration_s)
+    :raises ValueError: If the condition cannot be parsed
+    """
+    match = CONDITION_RE.match(condition)
+    if not match:
+        raise ValueError(f"Invalid condition '{condition}'")
+    direction, value, unit, duration, duration_unit = match.groups()
+    if unit.lower() not in CURRENT_UNITS:
+        raise ValueError(f"Unknown current unit '{unit}'")
+    min_duration_s = 0.0
+    if duration is not None:
+        if duration_unit.lower() not in TIME_UNITS:
+            raise ValueError(f"Unknown time unit '{duration_unit}'")
+        min_duration_s = float(duration) * TIME_UNITS[duration_unit.lower()]
+    return direction == '>', float(value) * CURRENT_UNITS[unit.lower()], min_duration_s
+
+class ThresholdDetector:
+    """
+    Detect periods where the current stays above (or below) a threshold for
+    at least a minimum duration.
+
+    Runs of samples beyond the threshold are found with array operations on
+    each block; a run still open at the end of a block is carried over to
+    the next one, and ended by flush() when the capture stops.
+
+    :param threshold_id: Identifier reported with each event
+    :param above: True to detect currents above the threshold, False for below
+    :param threshold_ua: Threshold in microamperes
+    :param min_duration_s: Minimum duration of an event in seconds
+    :param label: Optional name reported with each event
+    """
+    def __init__(self, threshold_id: int, above: bool, threshold_ua: float, min_duration_s: float = 0.0,
+                 label: str = None):
+        self.id = threshold_id
+        self.above = above
+        self.threshold_ua = threshold_ua
+        self.min_duration_s = min_duration_s
+        self.label = label
+        self.min_samples = max(1, int(round(min_duration_s * SAMPLE_RATE)))
+        self.reset()
+
+    def reset(self):
+        """
+        Forget a run in progress.
+        """
+        # [start index, sample count, peak, sum] of the run in progress
+        self._open = None
+
+    def describe(self):
+        """
+        :return: Dictionary describing the threshold
+        """
+        return {'id': self.id, 'label': self.label, 'above': self.above,
+                'threshold_ua': self.threshold_ua, 'min_duration_s': self.min_duration_s}
+
+    def update(self, samples: np.ndarray, first_index: int):
+        """
+        Process a block of samples.
+
+        :param samples: Currents in microamperes
+        :param first_index: Capture index of the first sample
+        :return: List of events completed in this block
+        """
+        n = len(samples)
+        if n == 0:
+            return []
+        beyond = samples > self.threshold_ua if self.above else samples < self.threshold_ua
+        carried = self._open is not None
+        edges = np.diff(np.concatenate(([carried], beyond, [False])).astype(np.int8))
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        if carried:
+            starts = np.concatenate(([0], starts))
+
+        lengths = ends - starts
+        peaks = np.full(len(starts), np.nan)
+        sums = np.zeros(len(starts))
+        nonempty = lengths > 0
+        if nonempty.any():
+            bounds = np.empty(2 * np.count_nonzero(nonempty), dtype=np.intp)
+            bounds[0::2] = starts[nonempty]
+            bounds[1::2] = ends[nonempty]
+            padded = np.concatenate((samples, [0])).astype(np.float64)
+            reduce = np.maximum if self.above else np.minimum
+            peaks[nonempty] = reduce.reduceat(padded, bounds)[0::2]
+            sums[nonempty] = np.add.reduceat(padded, bounds)[0::2]
+
+        run_starts = first_index + starts
+        counts = lengths.astype(np.int64)
+        if carried:
+            open_start, open_count, open_peak, open_sum = self._open
+            run_starts[0] = open_start
+            counts[0] += open_count
+            peaks[0] = open_peak if np.isnan(peaks[0]) else (max if self.above else min)(open_peak, peaks[0])
+            sums[0] += open_sum
+
+        # A run reaching the end of the block continues in the next block
+        still_open = len(ends) > 0 and ends[-1] == n
+        if still_open:
+            self._open = [int(run_starts[-1]), int(counts[-1]), float(peaks[-1]), float(sums[-1])]
+            run_starts, counts, peaks, sums = run_starts[:-1], counts[:-1], peaks[:-1], sums[:-1]
+        else:
+            self._open = None
+
+        events = []
+        for i in np.flatnonzero(counts >= self.min_samples):
+            events.append(self.__event(int(run_starts[i]), int(counts[i]), float(peaks[i]), float(sums[i])))
+        return events
+
+    def flush(self):
+        """
+        End the run in progress, e.g. when the capture stops.
+
+        :return: List with the event of the run if it lasted long enough
+        """
+        if self._open is None:
+            return []
+        start, count, peak, total = self._open
+        self._open = None
+        if count < self.min_samples:
+            return []
+        return [self.__event(start, count, peak, total)]
+
+    def __event(self, start: int, count: int, peak: float, total: float):
+        return {
+            'threshold_id': self.id,
+            'label': self.label,
+            'start': start,
+            'end': start + count,
+            'start_s': start / SAMPLE_RATE,
+            'duration_s': count / SAMPLE_RATE,
+            'peak_ua': peak,
+            'mean_ua': total / count,
+            'charge_uAh': total / SAMPLE_RATE / 3600,
+        }
+
+class EventDetector:
+    """
+    Set of threshold detectors run over the sample stream.
+
+    Completed events are kept in a bounded history, numbered with a sequence
+    number so clients can poll for new events, and pushed to watchers.
+
+    :param max_events: Number of events kept in the history
+    """
+    MAX_QUEUED_EVENTS = 1024
+
+    def __init__(self, max_events: int = 10000):
+        self.lock = threading.Lock()
+        self.detectors = {}
+        self.events = collections.deque(maxlen=max_events)
+        self._next_id = 1
+        self._sequence = 0
+        self._watchers = []
+
+    def add_threshold(self, above: bool, threshold_ua: float, min_duration_s: float = 0.0, label: str = None):
+        """
+        Add a threshold.
+
+        :return: Threshold id
+        """
+        with self.lock:
+            threshold_id = self._next_id
+            self._next_id += 1
+            self.detectors[threshold_id] = ThresholdDetector(threshold_id, above, threshold_ua, min_duration_s, label)
+            return threshold_id
+
+    def remove_threshold(self, threshold_id: int):
+        """
+        Remove a threshold.
+
+        :return: True if the threshold existed
+        """
+        with self.lock:
+            return self.detectors.pop(threshold_id, None) is not None
+
+    def get_thresholds(self):
+        """
+        :return: List of threshold descriptions
+        """
+        with self.lock:
+            return [detector.describe() for detector in self.detectors.values()]
+
+    def reset(self):
+        """
+        Clear the event history and runs in progress, e.g. for a new capture.
+        The thresholds are kept.
+        """
+        with self.lock:
+            self.events.clear()
+            for detector in self.detectors.values():
+                detector.reset()
+
+    def update(self, samples: np.ndarray, first_index: int):
+        """
+        Run all detectors over a block of samples.
+        """
+        with self.lock:
+            for detector in self.detectors.values():
+                self.__publish(detector.update(samples, first_index))
+
+    def flush(self):
+        """
+        End the runs in progress when the capture stops, reporting those that
+        already lasted long enough.
+        """
+        with self.lock:
+            for detector in self.detectors.values():
+                self.__publish(detector.flush())
+
+    def __publish(self, events: list):
+        # Called with self.lock held
+        for event in events:
+            self._sequence += 1
+            event['seq'] = self._sequence
+            self.events.append(event)
+            for watcher in self._watchers:
+                try:
+                    watcher.put_nowait(event)
+                except queue.Full:
+                    pass
+
+    def get_events(self, since: int = 0, threshold_id: int = None):
+        """
+        Get events from the history.
+
+        :param since: Only return events with a sequence number above this
+        :param threshold_id: Only return events of this threshold
+        :return: List of event dictionaries
+        """
+        with self.lock:
+            return [event for event in self.events
+                    if event['seq'] > since and (threshold_id is None or event['threshold_id'] == threshold_id)]
+
+    def add_watcher(self):
+        """
+        :return: Queue receiving every new event
+        """
+        watcher = queue.Queue(maxsize=self.MAX_QUEUED_EVENTS)
+        with self.lock:
+            self._watchers.append(watcher)
+        return watcher
+
+    def remove_watcher(self, watcher: queue.Queue):
+        with self.lock:
+            if watcher in self._watchers:
+                self._watchers.remove(watcher)
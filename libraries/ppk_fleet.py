@@ -0,0 +1,267 @@
+import socketserver
+import threading
+import time
+import port_helpers
+import ppk_daemon
+import ppk_protocol
+
+class _Member:
+    def __init__(self, config: dict):
+        self.config = config
+        self.name = config.get('sn') or f"simulator-{config.get('tcp_port', 5678)}"
+        self.server = None
+        self.profiler = None
+        self.device = None
+        self.state = 'absent'
+        self.since = time.time()
+        self.started = 0
+        self.starts = 0
+        self.last_error = None
+        self.retry_at = 0
+        self.backoff = 0
+        self.sample_rate = 0.0
+        self.last_count = None
+        self.last_bytes = None
+        self.last_progress = 0
+
+    def set_state(self, state: str, error: str = None):
+        if state != self.state:
+            self.state = state
+            self.since = time.time()
+        if error is not None:
+            self.last_error = error
+
+class StatusHandler(socketserver.BaseRequestHandler):
+    """
+    Answers {"command": "status"} with the status of the server's source
+    (a PPKFleet or ppk_supervisor.PPKSupervisor), using the same newline
+    delimited JSON messages as the power profiler servers.
+    """
+    def handle(self):
+        reader = ppk_protocol.MessageReader()
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                break
+            for request, error in reader.feed(data):
+                if error is not None or not isinstance(request, dict):
+                    response = {'error': 'Malformed JSON'}
+                elif request.get('command') == 'status':
+                    response = {'result': self.server.source.status()}
+                else:
+                    response = {'result': -1}
+                if isinstance(request, dict) and 'id' in request:
+                    response['id'] = request['id']
+                self.request.sendall(ppk_protocol.encode_message(response))
+
+class StatusServer(socketserver.ThreadingTCPServer):
+    """
+    :param server_address: (host, port) to listen on
+    :param source: Object whose status() is served
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, server_address, source):
+        self.source = source
+        super().__init__(server_address, StatusHandler)
+
+class PPKFleet:
+    """
+    Keep a power profiler server running for every configured PPK2.
+
+    The configured serial numbers are polled with
+    port_helpers.get_ports_with_serial_number(). A PPK2 that appears gets a
+    server on its configured TCP port (see ppk_daemon.start_server). When it
+    disappears or re-enumerates on another device, or stops delivering data
+    while measuring, its server is stopped and its clients are disconnected;
+    it is started again on the same TCP port once the PPK2 is back. Failed
+    starts are retried with an increasing delay.
+
+    :param configs: List of power profiler configurations (see ppk_daemon.start_server)
+    :param poll_interval: Seconds between device polls
+    :param stall_timeout: Seconds without data while measuring before a PPK2 is restarted
+    :param restart_delay: Delay in seconds before retrying a failed start
+    :param max_restart_delay: Maximum delay between retries
+    :param status_port: TCP port for status requests, None for no status server
+    """
+    STABLE_TIME = 60.0
+
+    def __init__(self, configs: list, poll_interval: float = 2.0, stall_timeout: float = 5.0,
+                 restart_delay: float = 2.0, max_restart_delay: float = 60.0, status_port: int = None):
+        self.poll_interval = poll_interval
+        self.stall_timeout = stall_timeout
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.status_port = status_port
+        self._members = [_Member(config) for config in configs]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._monitor = None
+        self._status_server = None
+
+    def start(self):
+        """
+        Start the PPK2s that are present, the monitor thread and the status server.
+        """
+        self.poll()
+        self._monitor = threading.Thread(target=self.__monitor_thread, daemon=True)
+        self._monitor.start()
+        if self.status_port is not None:
+            self._status_server = StatusServer(('localhost', self.status_port), self)
+            threading.Thread(target=self._status_server.serve_forever, daemon=True).start()
+            print(f"Fleet status server on localhost:{self.status_port}")
+
+    def stop(self):
+        """
+        Stop the monitor, the status server and all power profiler servers.
+        """
+        self._stop.set()
+        if self._monitor:
+            self._monitor.join()
+        if self._status_server:
+            self._status_server.shutdown()
+            self._status_server.server_close()
+        with self._lock:
+            for member in self._members:
+                self.__stop_member(member, 'Fleet stopped')
+                member.set_state('stopped')
+
+    def status(self):
+        """
+        Get the state of every configured PPK2.
+
+        :return: List of dictionaries with sn, tcp_port, state ('absent',
+            'running', 'failed' or 'stopped'), device, starts, last_error, state_s
+            (time in this state), and while running measuring, sample_rate
+            (samples per second since the last poll), samples, dropped_samples,
+            counter_gaps and read_errors
+        """
+        with self._lock:
+            result = []
+            now = time.time()
+            for member in self._members:
+                entry = {
+                    'sn': member.name,
+                    'tcp_port': member.config.get('tcp_port', 5678),
+                    'state': member.state,
+                    'device': member.device,
+                    'starts': member.starts,
+                    'last_error': member.last_error,
+                    'state_s': now - member.since,
+                }
+                if member.profiler is not None:
+                    health = member.profiler.get_health()
+                    entry.update({
+                        'measuring': health['measuring'],
+                        'sample_rate': member.sample_rate,
+                        'samples': member.profiler.stats.count,
+                        'dropped_samples': health['dropped_samples'],
+                        'counter_gaps': health['counter_gaps'],
+                        'read_errors': health['read_errors'],
+                    })
+                result.append(entry)
+            return result
+
+    def poll(self):
+        """
+        Check every PPK2 once and start or stop its server as needed.
+        """
+        with self._lock:
+            for member in self._members:
+                self.__poll_member(member)
+
+    def __find_device(self, member: _Member):
+        """
+        :return: Serial device of the PPK2, None if it is not present (or
+            ambiguous), the member name for simulated PPK2s
+        """
+        if member.config.get('simulator'):
+            return member.name
+        try:
+            ports = port_helpers.get_ports_with_serial_number(member.config.get('sn'))
+        except Exception as e:
+            print(f"{member.name}: Error listing serial ports: {e}")
+            return None
+        return ports[0].device if len(ports) == 1 else None
+
+    def __poll_member(self, member: _Member):
+        now = time.time()
+        device = self.__find_device(member)
+        if member.state == 'running':
+            reason = None
+            if device != member.device:
+                reason = 'PPK2 disconnected'
+            elif self.__stalled(member, now):
+                reason = 'No data from PPK2'
+            if reason is None:
+                if now - member.started > self.STABLE_TIME:
+                    member.backoff = 0
+                return
+            print(f"{member.name}: {reason}, stopping server")
+            self.__stop_member(member, reason)
+            member.set_state('absent')
+        if device is None:
+            if member.state != 'failed':
+                member.set_state('absent')
+            return
+        if now < member.retry_at:
+            return
+
+        server, profiler = ppk_daemon.start_server(member.config)
+        member.starts += 1
+        if server is None:
+            member.backoff = min(self.max_restart_delay,
+                                 member.backoff * 2 if member.backoff else self.restart_delay)
+            member.retry_at = now + member.backoff
+            member.set_state('failed', 'Server failed to start')
+            print(f"{member.name}: Retrying in {member.backoff:.1f} s")
+            return
+        member.server, member.profiler, member.device = server, profiler, device
+        member.started = now
+        member.retry_at = 0
+        member.last_count = None
+        member.last_bytes = None
+        member.last_progress = now
+        member.sample_rate = 0.0
+        member.set_state('running')
+
+    def __stalled(self, member: _Member, now: float):
+        """
+        Update the sample rate and check whether a measuring PPK2 stopped
+        delivering data.
+        """
+        profiler = member.profiler
+        count = profiler.stats.count
+        bytes_read = profiler.health['bytes_read']
+        if member.last_count is not None and count >= member.last_count:
+            member.sample_rate = (count - member.last_count) / max(now - member.last_poll, 1e-6)
+        else:
+            member.sample_rate = 0.0
+        member.last_count = count
+        member.last_poll = now
+        if not profiler.measuring or bytes_read != member.last_bytes:
+            member.last_bytes = bytes_read
+            member.last_progress = now
+            return False
+        return now - member.last_progress > self.stall_timeout
+
+    def __stop_member(self, member: _Member, reason: str):
+        server, profiler = member.server, member.profiler
+        member.server = member.profiler = member.device = None
+        member.sample_rate = 0.0
+        member.last_error = reason
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            server.close_connections()
+        if profiler is not None:
+            try:
+                profiler.close()
+            except Exception as e:
+                # Expected when the PPK2 is gone
+                print(f"{member.name}: Error closing power profiler: {e}")
+
+    def __monitor_thread(self):
+        while not self._stop.wait(self.poll_interval):
+            self.poll()
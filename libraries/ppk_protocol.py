@@ -0,0 +1,170 @@
+"""
+Wire formats shared by ppk_daemon and ppk_client.
+"""
+import json
+import re
+import struct
+
+# Sample stream formats
+STREAM_FORMAT_FLOAT32 = 'float32'   # current in microamperes, little-endian float32
+STREAM_FORMAT_RAW = 'raw'           # raw PPK2 sample words, little-endian uint32
+STREAM_FORMATS = {
+    STREAM_FORMAT_FLOAT32: '<f4',
+    STREAM_FORMAT_RAW: '<u4',
+}
+
+# Each stream frame is a header followed by payload_bytes of samples.
+# Header: payload_bytes (uint32), sequence (uint32), first_sample_index (uint64)
+# sequence increments by one per frame, so a gap means frames were dropped
+# because the subscriber did not keep up. first_sample_index is the capture
+# index of the first (undecimated) sample in the frame.
+STREAM_HEADER = struct.Struct('<IIQ')
+
+# Requests and responses are JSON objects terminated by a newline. A request
+# may carry an 'id', which is copied into its response so that pipelined
+# requests can be matched to their responses.
+MESSAGE_DELIMITER = b'\n'
+MAX_MESSAGE_SIZE = 64 * 1024
+# Responses such as get_range() with many points are much larger than requests
+MAX_RESPONSE_SIZE = 64 * 1024 * 1024
+
+# Commands that need control of the power profiler. Only one client at a
+# time controls it, and the daemon stops measuring when that client
+# disconnects.
+CONTROL_COMMANDS = ('start', 'stop', 'set_output', 'set_output_voltage', 'mark', 'group_start', 'group_stop')
+
+def encode_message(message: dict) -> bytes:
+    """
+    Encode a message as a newline terminated JSON line.
+    """
+    return json.dumps(message).encode('utf-8') + MESSAGE_DELIMITER
+
+class MessageReader:
+    """
+    Split a TCP byte stream into JSON messages.
+
+    Messages are normally newline delimited. For compatibility with older
+    peers, JSON objects sent back to back without a newline are also
+    accepted while the peer has not sent any newline. Such input is decoded
+    after each received segment and answered with an error as soon as it
+    cannot be the start of a valid message. Bytes are buffered until a
+    complete message has been received, so messages split across or
+    coalesced within TCP segments are handled.
+
+    :param max_message_size: Maximum size of a buffered message in bytes
+    :param legacy: Accept messages without a newline, False when the peer
+        always sends newlines (e.g. responses from ppk_daemon)
+    """
+    # Characters a number split across segments may end with
+    PARTIAL_NUMBER_RE = re.compile(r'[0-9.eE+-]+')
+    LITERALS = ('true', 'false', 'null', 'NaN', 'Infinity', '-Infinity')
+
+    def __init__(self, max_message_size: int = MAX_MESSAGE_SIZE, legacy: bool = True):
+        self.max_message_size = max_message_size
+        self.legacy = legacy
+        self._buffer = bytearray()
+        self._decoder = json.JSONDecoder()
+        # Bytes of the buffer already searched for a delimiter
+        self._scan_pos = 0
+        # Set when the peer sent a delimiter, so it does not need legacy decoding
+        self._delimited = False
+
+    def feed(self, data: bytes, max_messages: int = None):
+        """
+        Add received bytes and return the messages completed by them.
+
+        :param data: Bytes received from the socket
+        :param max_messages: Stop after this many messages and keep the
+            remaining bytes buffered, e.g. when a binary stream follows
+        :return: List of (message, error) tuples. error is None for a valid
+            message, otherwise message is None and error describes the
+            malformed input, which is discarded.
+        """
+        self._buffer += data
+        messages = []
+        while max_messages is None or len(messages) < max_messages:
+            end = self._buffer.find(MESSAGE_DELIMITER, self._scan_pos)
+            if end < 0:
+                self._scan_pos = len(self._buffer)
+                # Legacy peers send JSON objects without a delimiter
+                if self.legacy and not self._delimited and self.__decode_legacy(messages):
+                    continue
+                break
+            self._delimited = True
+            line = bytes(self._buffer[:end])
+            del self._buffer[:end + 1]
+            self._scan_pos = 0
+            messages.extend(self.__decode_line(line))
+        if max_messages is None and len(self._buffer) > self.max_message_size:
+            self._buffer.clear()
+            self._scan_pos = 0
+            messages.append((None, 'Message too long'))
+        return messages
+
+    def take_buffer(self) -> bytes:
+        """
+        Remove and return bytes received after the last complete message.
+        """
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        self._scan_pos = 0
+        return data
+
+    def __decode_line(self, line: bytes):
+        try:
+            text = line.decode('utf-8')
+        except UnicodeDecodeError as e:
+            return [(None, f'Malformed message: {e}')]
+        messages = []
+        pos = 0
+        while True:
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+            if pos == len(text):
+                return messages
+            try:
+                message, pos = self._decoder.raw_decode(text, pos)
+            except json.JSONDecodeError as e:
+                messages.append((None, f'Malformed JSON: {e}'))
+                return messages
+            messages.append((message, None))
+
+    def __decode_legacy(self, messages: list):
+        try:
+            text = self._buffer.decode('utf-8')
+        except UnicodeDecodeError:
+            # Possibly a multi-byte character split across segments
+            return False
+        text = text.lstrip()
+        if not text:
+            self._buffer.clear()
+            self._scan_pos = 0
+            return False
+        try:
+            message, end = self._decoder.raw_decode(text)
+        except json.JSONDecodeError as e:
+            if not self.__incomplete(text, e):
+                self._buffer.clear()
+                self._scan_pos = 0
+                messages.append((None, f'Malformed JSON: {e}'))
+            return False
+        self._buffer[:] = text[end:].encode('utf-8')
+        self._scan_pos = 0
+        messages.append((message, None))
+        return True
+
+    def __incomplete(self, text: str, error: json.JSONDecodeError):
+        """
+        :return: True if more data can still make text a valid message, i.e.
+            the error is at the end of the input, inside a string or in a
+            number or literal cut off by the end of a segment
+        """
+        rest = text[error.pos:]
+        if not rest.strip() or error.msg.startswith('Unterminated string'):
+            return True
+        partial_number = bool(self.PARTIAL_NUMBER_RE.fullmatch(rest))
+        if error.msg.startswith('Expecting value'):
+            # A value cut off at its start
+            return partial_number or any(literal.startswith(rest) for literal in self.LITERALS)
+        # A number cut off after its first characters, e.g. '1.'
+        return partial_number and not text[error.pos - 1].isspace()
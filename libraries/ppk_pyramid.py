@@ -0,0 +1,185 @@
+import threading
+import numpy as np
+from ppk_stats import SAMPLE_RATE
+
+class _PyramidLevel:
+    """
+    Ring buffer of min/max/sum/count bins for one pyramid level.
+    """
+    def __init__(self, samples_per_bin: int, capacity: int):
+        self.samples_per_bin = samples_per_bin
+        self.capacity = capacity
+        self.min = np.empty(capacity, dtype=np.float32)
+        self.max = np.empty(capacity, dtype=np.float32)
+        self.sum = np.empty(capacity, dtype=np.float64)
+        self.count = np.empty(capacity, dtype=np.int32)
+        self.total = 0
+
+    @property
+    def first(self):
+        """
+        Index of the oldest retained bin.
+        """
+        return max(0, self.total - self.capacity)
+
+    @property
+    def nbytes(self):
+        return self.min.nbytes + self.max.nbytes + self.sum.nbytes + self.count.nbytes
+
+    def append(self, bins):
+        bins_min, bins_max, bins_sum, bins_count = bins
+        n = len(bins_min)
+        if n > self.capacity:
+            # Only the newest bins fit
+            skip = n - self.capacity
+            self.total += skip
+            bins_min, bins_max, bins_sum, bins_count = (a[skip:] for a in bins)
+            n = self.capacity
+        pos = self.total % self.capacity
+        first = min(n, self.capacity - pos)
+        for dst, src in ((self.min, bins_min), (self.max, bins_max), (self.sum, bins_sum), (self.count, bins_count)):
+            dst[pos:pos + first] = src[:first]
+            dst[:n - first] = src[first:]
+        self.total += n
+
+    def get(self, start: int, stop: int):
+        """
+        Bins with indexes in [start, stop), which must be retained.
+        """
+        idx = np.arange(start, stop) % self.capacity
+        return self.min[idx], self.max[idx], self.sum[idx], self.count[idx]
+
+class DecimationPyramid:
+    """
+    Min/max/mean pyramid of a PPK2 capture for plotting long captures.
+
+    Each level holds bins combining a fixed number of samples and is updated
+    incrementally as samples arrive, so a query never has to scan the raw
+    samples. Levels are ring buffers, so memory stays bounded; the finest
+    levels cover the most recent part of the capture only. If a sample store
+    is given, its retained samples serve as the finest (10 us) level.
+
+    :param store: SampleStore with the raw samples, or None
+    :param levels: Sequence of (samples per bin, capacity in bins), each a
+        multiple of the previous one
+    """
+    # 1 ms (last 17 minutes), 100 ms (last 14 hours) and 10 s (last 7 days) bins at 100 kS/s
+    DEFAULT_LEVELS = ((100, 1 << 20), (10000, 1 << 19), (1000000, 1 << 16))
+    # Maximum number of bins combined into one returned point
+    MAX_COMBINE = 100
+
+    def __init__(self, store=None, levels=DEFAULT_LEVELS):
+        self.store = store
+        self.lock = threading.Lock()
+        self.levels = [_PyramidLevel(samples_per_bin, capacity) for samples_per_bin, capacity in levels]
+        self.reset()
+
+    def reset(self):
+        """
+        Remove all bins.
+        """
+        with self.lock:
+            for level in self.levels:
+                level.total = 0
+            self._pending = [None] * len(self.levels)
+            self.samples = 0
+
+    def update(self, samples: np.ndarray):
+        """
+        Add a block of samples.
+
+        :param samples: numpy array of currents in microamperes
+        """
+        samples = np.asarray(samples, dtype=np.float32)
+        items = (samples, samples, samples.astype(np.float64), np.ones(len(samples), dtype=np.int32))
+        prev_size = 1
+        with self.lock:
+            self.samples += len(samples)
+            for i, level in enumerate(self.levels):
+                ratio = level.samples_per_bin // prev_size
+                prev_size = level.samples_per_bin
+                if self._pending[i] is not None:
+                    items = tuple(np.concatenate((p, a)) for p, a in zip(self._pending[i], items))
+                complete = len(items[0]) - len(items[0]) % ratio
+                self._pending[i] = tuple(a[complete:] for a in items)
+                if complete == 0:
+                    break
+                items_min, items_max, items_sum, items_count = (a[:complete].reshape(-1, ratio) for a in items)
+                items = (items_min.min(axis=1), items_max.max(axis=1), items_sum.sum(axis=1), items_count.sum(axis=1))
+                level.append(items)
+
+    @property
+    def nbytes(self):
+        """
+        Memory allocated by the pyramid levels.
+        """
+        return sum(level.nbytes for level in self.levels)
+
+    def get_range(self, t0: float, t1: float, max_points: int = 1000):
+        """
+        Get min/max/mean of the capture between two times.
+
+        The finest level that covers t0 and needs at most MAX_COMBINE times
+        max_points bins is used, with its bins combined to fit max_points.
+        The coarsest level is used if no finer level qualifies.
+
+        :param t0: Start time in seconds since the start of the capture
+        :param t1: End time in seconds since the start of the capture
+        :param max_points: Maximum number of points to return
+        :return: Dictionary with the bin duration (bin_s) and lists of bin
+            start times (t), min, max, mean and sample count
+        """
+        max_points = max(1, int(max_points))
+        max_bins = max_points * self.MAX_COMBINE
+        start = max(0, int(t0 * SAMPLE_RATE))
+        with self.lock:
+            stop = min(self.samples, int(np.ceil(t1 * SAMPLE_RATE)))
+            if stop <= start:
+                return self.__result(1, 0, (np.empty(0),) * 4)
+
+            # Raw samples from the store
+            bins = None
+            size = 1
+            first = start
+            if self.store is not None and stop - start <= max_bins:
+                with self.store.lock:
+                    if start >= self.store.start_index:
+                        data = self.store.get(start, stop)
+                        bins = (data, data, data.astype(np.float64), np.ones(len(data), dtype=np.int32))
+
+            for i, level in enumerate(self.levels):
+                if bins is not None:
+                    break
+                size = level.samples_per_bin
+                first = max(start // size, level.first)
+                last = min(-(-stop // size), level.total)
+                coarsest = i == len(self.levels) - 1
+                if last <= first or (start // size < level.first and not coarsest):
+                    continue
+                if last - first <= max_bins or coarsest:
+                    bins = level.get(first, last)
+                    first *= size
+            if bins is None:
+                return self.__result(1, 0, (np.empty(0),) * 4)
+
+        # Combine bins until they fit into max_points
+        factor = -(-len(bins[0]) // max_points)
+        if factor > 1:
+            pad = -len(bins[0]) % factor
+            bins_min, bins_max, bins_sum, bins_count = (np.concatenate((b, np.full(pad, v, dtype=b.dtype)))
+                                                       for b, v in zip(bins, (np.inf, -np.inf, 0, 0)))
+            bins = (bins_min.reshape(-1, factor).min(axis=1), bins_max.reshape(-1, factor).max(axis=1),
+                    bins_sum.reshape(-1, factor).sum(axis=1), bins_count.reshape(-1, factor).sum(axis=1))
+        return self.__result(size * factor, first, bins)
+
+    @staticmethod
+    def __result(bin_samples, first_sample, bins):
+        bins_min, bins_max, bins_sum, bins_count = bins
+        return {
+            'bin_s': bin_samples / SAMPLE_RATE,
+            't': ((first_sample + np.arange(len(bins_min)) * bin_samples) / SAMPLE_RATE).tolist(),
+            'min': bins_min.astype(np.float64).tolist(),
+            'max': bins_max.astype(np.float64).tolist(),
+            'mean': (bins_sum / np.maximum(bins_count, 1)).astype(np.float64).tolist(),
+            'count': bins_count.tolist(),
+        }
@@ -0,0 +1,152 @@
+import threading
+import numpy as np
+
+class SampleStore:
+    """
+    Store for PPK2 current samples (in microamperes) backed by preallocated
+    numpy chunks.
+
+    Samples are copied into fixed size chunks, so appending never copies
+    previously stored data and growth is amortized. When max_samples is set,
+    the oldest chunks are dropped (or recycled) once the limit is exceeded, so
+    memory stays bounded. Samples are addressed by their absolute index since
+    the store was last cleared.
+
+    :param chunk_samples: Number of samples per chunk
+    :param max_samples: Maximum number of samples to retain, None for unbounded
+    :param dtype: Sample data type
+    """
+    DEFAULT_CHUNK_SAMPLES = 1 << 20
+
+    def __init__(self, chunk_samples: int = DEFAULT_CHUNK_SAMPLES, max_samples: int = None, dtype=np.float32):
+        self.chunk_samples = chunk_samples
+        self.max_samples = max_samples
+        self.dtype = np.dtype(dtype)
+        self.lock = threading.RLock()
+        self._chunks = []
+        self._fill = 0
+        self.total = 0
+        self.dropped = 0
+
+    def clear(self):
+        """
+        Remove all samples. The first chunk is kept allocated for reuse.
+        """
+        with self.lock:
+            del self._chunks[1:]
+            self._fill = 0
+            self.total = 0
+            self.dropped = 0
+
+    def __len__(self):
+        return self.total - self.dropped
+
+    @property
+    def start_index(self):
+        """
+        Absolute index of the oldest retained sample.
+        """
+        return self.dropped
+
+    def append(self, samples):
+        """
+        Append samples to the store.
+
+        :param samples: Sequence or numpy array of samples
+        """
+        samples = np.asarray(samples, dtype=self.dtype)
+        with self.lock:
+            pos = 0
+            while pos < len(samples):
+                if not self._chunks or self._fill == self.chunk_samples:
+                    self._chunks.append(self.__new_chunk())
+                    self._fill = 0
+                n = min(len(samples) - pos, self.chunk_samples - self._fill)
+                self._chunks[-1][self._fill:self._fill + n] = samples[pos:pos + n]
+                self._fill += n
+                pos += n
+            self.total += len(samples)
+
+    def __new_chunk(self):
+        # Reuse the oldest chunk if dropping it keeps at least max_samples
+        if self.max_samples is not None and len(self._chunks) > 1:
+            if len(self) - self.chunk_samples >= self.max_samples:
+                self.dropped += self.chunk_samples
+                return self._chunks.pop(0)
+        return np.empty(self.chunk_samples, dtype=self.dtype)
+
+    def _views(self, start: int = None, stop: int = None):
+        """
+        Views of the retained chunks covering [start, stop). Must be called
+        with the lock held.
+        """
+        first = self.start_index
+        start = first if start is None else max(start, first)
+        stop = self.total if stop is None else min(stop, self.total)
+        views = []
+        for i, chunk in enumerate(self._chunks):
+            chunk_start = first + i * self.chunk_samples
+            chunk_len = self._fill if i == len(self._chunks) - 1 else self.chunk_samples
+            lo = max(start, chunk_start)
+            hi = min(stop, chunk_start + chunk_len)
+            if lo < hi:
+                views.append(chunk[lo - chunk_start:hi - chunk_start])
+        return views
+
+    def get(self, start: int = None, stop: int = None):
+        """
+        Copy of the retained samples with absolute indexes in [start, stop).
+
+        :param start: First sample index, None for the oldest retained sample
+        :param stop: Index after the last sample, None for the newest sample
+        :return: numpy array of samples
+        """
+        with self.lock:
+            views = self._views(start, stop)
+            if not views:
+                return np.empty(0, dtype=self.dtype)
+            return np.concatenate(views)
+
+    def min(self):
+        """
+        :return: Minimum retained sample, or 0 if empty
+        """
+        with self.lock:
+            views = self._views()
+            return float(min(v.min() for v in views)) if views else 0
+
+    def max(self):
+        """
+        :return: Maximum retained sample, or 0 if empty
+        """
+        with self.lock:
+            views = self._views()
+            return float(max(v.max() for v in views)) if views else 0
+
+    def mean(self):
+        """
+        :return: Mean of the retained samples, or 0 if empty
+        """
+        with self.lock:
+            views = self._views()
+            count = sum(len(v) for v in views)
+            if count == 0:
+                return 0
+            return float(sum(v.sum(dtype=np.float64) for v in views) / count)
+
+    def memory_info(self):
+        """
+        Report the memory used by the store.
+
+        :return: Dictionary with sample counts and allocated/used bytes
+        """
+        with self.lock:
+            return {
+                'samples': len(self),
+                'total_samples': self.total,
+                'dropped_samples': self.dropped,
+                'max_samples': self.max_samples,
+                'chunks': len(self._chunks),
+                'allocated_bytes': len(self._chunks) * self.chunk_samples * self.dtype.itemsize,
+                'used_bytes': len(self) * self.dtype.itemsize,
+            }
@@ -0,0 +1,278 @@
+import argparse
+import os
+import pty
+import select
+import threading
+import time
+import tty
+import numpy as np
+from ppk_stats import SAMPLE_RATE
+
+
+class PPK2Waveform:
+    """
+    Current waveform for the PPK2 simulator.
+
+    The waveform repeats a sequence of (current_ua, duration_s) steps, e.g. a
+    sleep floor followed by an active period. Periodic bursts (such as radio
+    TX) are added on top, followed by Gaussian noise. Alternatively a capture
+    written by ppk_capture_file (float32 currents) is replayed in a loop.
+
+    :param steps: List of (current_ua, duration_s) tuples
+    :param bursts: List of (current_ua, duration_s, interval_s) tuples
+    :param noise_ua: Standard deviation of the noise in microamperes
+    :param replay: Base path of a capture file to replay instead of steps
+    :param seed: Random seed for the noise
+    """
+    def __init__(self, steps=((5.0, 1.0),), bursts=(), noise_ua: float = 0.0, replay: str = None,
+                 seed: int = None):
+        self.steps = [(float(current), float(duration)) for current, duration in steps]
+        self.bursts = [(float(current), float(duration), float(interval)) for current, duration, interval in bursts]
+        self.noise_ua = noise_ua
+        self._random = np.random.default_rng(seed)
+        self._step_ends = np.cumsum([int(round(duration * SAMPLE_RATE)) for _, duration in self.steps])
+        self._step_currents = np.array([current for current, _ in self.steps])
+        self._replay = None
+        if replay:
+            from ppk_capture_file import CaptureFileReader
+            self._replay = CaptureFileReader(replay)
+            if len(self._replay) == 0:
+                raise ValueError(f"Capture {replay} is empty")
+
+    @classmethod
+    def from_config(cls, config: dict):
+        """
+        Create a waveform from the 'simulator' section of a PPK board config,
+        e.g. {"steps": [[5, 0.9], [3000, 0.1]], "bursts": [[8000, 0.002, 0.1]],
+        "noise_ua": 1.0, "seed": 1} or {"replay": "/path/to/capture"}.
+        """
+        return cls(config.get('steps', ((5.0, 1.0),)), config.get('bursts', ()), config.get('noise_ua', 0.0),
+                   config.get('replay', None), config.get('seed', None))
+
+    def generate(self, start: int, count: int):
+        """
+        Currents of samples [start, start + count).
+
+        :return: numpy float64 array of currents in microamperes
+        """
+        index = np.arange(start, start + count)
+        if self._replay is not None:
+            total = len(self._replay)
+            pos = start % total
+            parts = []
+            while count > 0:
+                n = min(count, total - pos)
+                parts.append(self._replay.read(pos, n))
+                count -= n
+                pos = 0
+            current = np.concatenate(parts).astype(np.float64)
+        else:
+            step = np.searchsorted(self._step_ends, index % self._step_ends[-1], side='right')
+            current = self._step_currents[step]
+        for burst_current, duration, interval in self.bursts:
+            period = max(1, int(round(interval * SAMPLE_RATE)))
+            active = (index % period) < int(round(duration * SAMPLE_RATE))
+            current = np.where(active, burst_current, current)
+        if self.noise_ua:
+            current = current + self._random.normal(0.0, self.noise_ua, count)
+        return np.maximum(current, 0.0)
+
+
+class PPK2Simulator:
+    """
+    Simulated PPK2 on a pseudo terminal (Linux/macOS only).
+
+    Answers the serial commands used by PPK2_API (metadata, source voltage,
+    DUT power, start/stop measuring) and, while measuring, streams sample
+    words for the waveform at the real PPK2 sample rate. Each current picks
+    the most sensitive measurement range that holds it, like the PPK2 does,
+    and the 6-bit sample counter increments per sample.
+
+    Open port_name with PowerProfiler like a real PPK2.
+
+    :param waveform: PPK2Waveform generating the currents
+    """
+    AVERAGE_START = 0x06
+    AVERAGE_STOP = 0x07
+    DEVICE_RUNNING_SET = 0x0c
+    REGULATOR_SET = 0x0d
+    GET_META_DATA = 0x19
+    # Length of each command including the opcode, commands not listed are one byte
+    COMMAND_LENGTHS = {0x01: 2, 0x02: 2, 0x03: 2, 0x04: 2, 0x05: 2, 0x08: 2, 0x09: 2, 0x0c: 2, 0x0d: 3,
+                       0x0e: 2, 0x0f: 2, 0x11: 2, 0x12: 2, 0x25: 6}
+
+    # Identity calibration, so the decoded current equals the simulated one
+    # apart from ADC quantization
+    RESISTORS = (1031.64, 101.65, 10.15, 0.94, 0.043)
+    ADC_MULT = 1.8 / 163840
+    ADC_MAX = 0x3FFF
+    COUNTER_SHIFT = 18
+    STREAM_INTERVAL = 0.005
+
+    def __init__(self, waveform: PPK2Waveform = None):
+        self.waveform = waveform or PPK2Waveform()
+        self.voltage_mv = None
+        self.dut_power = False
+        self.measuring = False
+        self.samples_sent = 0
+        self.current_sum = 0.0
+        self._lock = threading.Lock()
+        self._measure_start = None
+        self._stop = False
+
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        # Non-blocking, so the threads notice close() even if nobody reads the port
+        os.set_blocking(self._master, False)
+        self.port_name = os.ttyname(self._slave)
+        # Full scale current of each range, in microamperes
+        self._range_limits = np.array([self.ADC_MAX * 4 * self.ADC_MULT / r * 1e6 for r in self.RESISTORS])
+        self._rx_thread = threading.Thread(target=self.__rx_thread, daemon=True)
+        self._stream_thread = threading.Thread(target=self.__stream_thread, daemon=True)
+        self._rx_thread.start()
+        self._stream_thread.start()
+
+    def close(self):
+        """Stop the simulator and close the pseudo terminal"""
+        self._stop = True
+        self._stream_thread.join()
+        self._rx_thread.join()
+        for fd in (self._master, self._slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    @property
+    def mean_current_ua(self):
+        """Mean of all currents streamed so far, in microamperes"""
+        return self.current_sum / self.samples_sent if self.samples_sent else 0.0
+
+    def metadata(self):
+        """Metadata text returned for GET_META_DATA"""
+        lines = ['Calibrated: 0']
+        for i, r in enumerate(self.RESISTORS):
+            lines += [f'R{i}: {r}', f'GS{i}: 1', f'GI{i}: 1', f'O{i}: 0', f'S{i}: 0', f'I{i}: 0', f'UG{i}: 1']
+        lines += ['HW: 9173', 'IA: 56', 'END', '']
+        return '\n'.join(lines).encode('utf-8')
+
+    def encode(self, currents_ua: np.ndarray, first_counter: int):
+        """
+        Encode currents as PPK2 sample words.
+
+        :param currents_ua: Currents in microamperes
+        :param first_counter: Sample counter of the first sample
+        :return: numpy uint32 array of sample words
+        """
+        ranges = np.minimum(np.searchsorted(self._range_limits, currents_ua), len(self.RESISTORS) - 1)
+        resistors = np.array(self.RESISTORS)[ranges]
+        codes = np.clip(np.rint(currents_ua * 1e-6 * resistors / (4 * self.ADC_MULT)), 0, self.ADC_MAX)
+        counters = (first_counter + np.arange(len(currents_ua))) & 0x3F
+        return (codes.astype(np.uint32) | (ranges.astype(np.uint32) << 14)
+                | (counters.astype(np.uint32) << self.COUNTER_SHIFT))
+
+    def __write(self, data: bytes):
+        view = memoryview(data)
+        while view and not self._stop:
+            try:
+                _, writable, _ = select.select([], [self._master], [], 0.1)
+                if writable:
+                    view = view[os.write(self._master, view):]
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError):
+                return
+
+    def __handle_command(self, opcode: int, params: bytes):
+        if opcode == self.GET_META_DATA:
+            self.__write(self.metadata())
+        elif opcode == self.AVERAGE_START:
+            with self._lock:
+                if not self.measuring:
+                    self.measuring = True
+                    self._measure_start = time.monotonic()
+                    self._measure_sent = 0
+        elif opcode == self.AVERAGE_STOP:
+            with self._lock:
+                self.measuring = False
+        elif opcode == self.REGULATOR_SET:
+            # Inverse of PPK2_API._convert_source_voltage()
+            self.voltage_mv = (params[0] - 3) * 256 + params[1] + 800 - 32
+        elif opcode == self.DEVICE_RUNNING_SET:
+            self.dut_power = params[0] == 1
+
+    def __rx_thread(self):
+        buf = b''
+        while not self._stop:
+            try:
+                readable, _, _ = select.select([self._master], [], [], 0.1)
+                if not readable:
+                    continue
+                data = os.read(self._master, 1024)
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError):
+                break
+            if not data:
+                break
+            buf += data
+            while buf:
+                length = self.COMMAND_LENGTHS.get(buf[0], 1)
+                if len(buf) < length:
+                    break
+                self.__handle_command(buf[0], buf[1:length])
+                buf = buf[length:]
+
+    def __stream_thread(self):
+        while not self._stop:
+            time.sleep(self.STREAM_INTERVAL)
+            with self._lock:
+                if not self.measuring:
+                    continue
+                due = int((time.monotonic() - self._measure_start) * SAMPLE_RATE) - self._measure_sent
+                if due <= 0:
+                    continue
+                currents = self.waveform.generate(self.samples_sent, due)
+                words = self.encode(currents, self.samples_sent)
+                self._measure_sent += due
+                self.samples_sent += due
+                self.current_sum += float(currents.sum())
+            # Blocks if the reader falls behind, like a full USB buffer
+            self.__write(words.astype('<u4').tobytes())
+
+
+if __name__ == '__main__':
+    import json
+    import resource
+    import ppk_daemon
+    from ppk_client import PPKClient
+
+    parser = argparse.ArgumentParser(description='Benchmark ppk_daemon against the simulated PPK2')
+    parser.add_argument('--duration', type=float, default=10.0, help='Capture duration in seconds')
+    parser.add_argument('--waveform', type=str, default=None, help='Simulator config as JSON')
+    parser.add_argument('--port', type=int, default=5799, help='TCP port of the daemon')
+    args = parser.parse_args()
+
+    sim_config = json.loads(args.waveform) if args.waveform else {
+        'steps': [[5, 0.9], [3000, 0.1]], 'bursts': [[8000, 0.002, 0.25]], 'noise_ua': 2.0, 'seed': 1}
+    server, pp = ppk_daemon.start_server({'tcp_port': args.port, 'voltage_mv': 3300, 'simulator': sim_config})
+    if server is None:
+        exit(1)
+    client = PPKClient('localhost', args.port)
+    client.start_measuring()
+    time.sleep(args.duration)
+    client.stop_measuring()
+    stats = client.get_stats()
+    health = client.get_health()
+    memory = client.get_memory_usage()
+    client.close()
+    sim = pp.simulator
+    print(f"Samples: {stats['count']} in {stats['elapsed_s']:.2f}s ({stats['count'] / stats['elapsed_s']:.0f} S/s), "
+          f"dropped {health['dropped_samples']}, max loop latency {health['max_loop_latency_s'] * 1000:.1f} ms")
+    print(f"Mean: {stats['mean']:.2f} uA (simulated {sim.mean_current_ua:.2f} uA), "
+          f"min {stats['min']:.2f} uA, max {stats['max']:.2f} uA")
+    print(f"Sample memory: {memory['allocated_bytes'] / 1e6:.1f} MB, pyramid {memory['pyramid_bytes'] / 1e6:.1f} MB, "
+          f"max RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    server.shutdown()
+    server.server_close()
+    pp.close()
@@ -0,0 +1,215 @@
+import math
+import threading
+import time
+import numpy as np
+
+# PPK2 sample rate in samples per second
+SAMPLE_RATE = 100000
+
+class RunningStats:
+    """
+    Running statistics over a stream of samples.
+
+    Count, min, max, mean and variance are updated incrementally with each
+    block of samples (Welford's algorithm, combined per block), so queries
+    take constant time regardless of how many samples have been seen.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Reset all statistics and restart the elapsed time.
+        """
+        with self._lock:
+            self.count = 0
+            self.min = math.inf
+            self.max = -math.inf
+            self.mean = 0.0
+            self._m2 = 0.0
+            self.start_time = time.monotonic()
+
+    def update(self, samples: np.ndarray):
+        """
+        Add a block of samples to the statistics.
+
+        :param samples: numpy array of samples
+        """
+        n = len(samples)
+        if n == 0:
+            return
+        block_mean = float(samples.mean(dtype=np.float64))
+        block_m2 = float(np.square(samples - block_mean, dtype=np.float64).sum())
+        block_min = float(samples.min())
+        block_max = float(samples.max())
+        with self._lock:
+            total = self.count + n
+            delta = block_mean - self.mean
+            self.mean += delta * n / total
+            self._m2 += block_m2 + delta * delta * self.count * n / total
+            self.count = total
+            self.min = min(self.min, block_min)
+            self.max = max(self.max, block_max)
+
+    @property
+    def variance(self):
+        """
+        Population variance of the samples, 0 if there are none.
+        """
+        return self._m2 / self.count if self.count else 0.0
+
+    def to_dict(self):
+        """
+        Snapshot of the statistics.
+
+        :return: Dictionary with count, min, max, mean, variance, std,
+            duration_s (count at the PPK2 sample rate) and elapsed_s (host time)
+        """
+        with self._lock:
+            if self.count == 0:
+                return {'count': 0, 'min': 0, 'max': 0, 'mean': 0, 'variance': 0, 'std': 0,
+                        'duration_s': 0, 'elapsed_s': time.monotonic() - self.start_time}
+            variance = self.variance
+            return {
+                'count': self.count,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.mean,
+                'variance': variance,
+                'std': math.sqrt(variance),
+                'duration_s': self.count / SAMPLE_RATE,
+                'elapsed_s': time.monotonic() - self.start_time,
+            }
+
+class LogHistogram:
+    """
+    Streaming histogram of currents with logarithmically spaced buckets.
+
+    Each block of samples is counted into fixed buckets, buckets_per_decade
+    per decade between min_value and max_value, so percentiles and
+    histograms of a capture of any length are available without keeping the
+    samples. A percentile is accurate to half a bucket, about 1.2 % of the
+    value with the default 100 buckets per decade. Values below min_value
+    (including zero and negative currents) and above max_value are counted
+    in an underflow and an overflow bucket.
+
+    :param min_value: Lower edge of the first bucket, in microamperes
+    :param max_value: Upper edge of the last bucket, in microamperes
+    :param buckets_per_decade: Number of buckets per factor of ten
+    """
+    def __init__(self, min_value: float = 0.01, max_value: float = 1e6, buckets_per_decade: int = 100):
+        self.min_value = min_value
+        self.max_value = max_value
+        self.buckets_per_decade = buckets_per_decade
+        self.buckets = int(math.ceil(math.log10(max_value / min_value) * buckets_per_decade))
+        # Bucket i + 1 holds [edges[i], edges[i + 1]), 0 and buckets + 1 are under- and overflow
+        self.edges = min_value * 10 ** (np.arange(self.buckets + 1) / buckets_per_decade)
+        self._log_min = math.log10(min_value)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Clear all counts.
+        """
+        with self._lock:
+            self.counts = np.zeros(self.buckets + 2, dtype=np.int64)
+            self.min = math.inf
+            self.max = -math.inf
+
+    @property
+    def count(self):
+        return int(self.counts.sum())
+
+    @property
+    def nbytes(self):
+        return self.counts.nbytes + self.edges.nbytes
+
+    def update(self, samples: np.ndarray):
+        """
+        Add a block of samples to the histogram.
+
+        :param samples: numpy array of currents in microamperes
+        """
+        if len(samples) == 0:
+            return
+        with np.errstate(divide='ignore', invalid='ignore'):
+            position = (np.log10(samples.astype(np.float64)) - self._log_min) * self.buckets_per_decade
+        # NaN (log of a negative current) and -inf land in the underflow bucket
+        index = np.clip(np.nan_to_num(np.floor(position), nan=-1.0), -1, self.buckets).astype(np.intp) + 1
+        block_counts = np.bincount(index, minlength=self.buckets + 2)
+        block_min = float(samples.min())
+        block_max = float(samples.max())
+        with self._lock:
+            self.counts += block_counts
+            self.min = min(self.min, block_min)
+            self.max = max(self.max, block_max)
+
+    def __bucket_bounds(self):
+        """
+        Lower and upper value of each bucket including under- and overflow,
+        limited to the observed range.
+        """
+        lower = np.concatenate(([self.min], self.edges))
+        upper = np.concatenate((self.edges, [self.max]))
+        return np.clip(lower, self.min, self.max), np.clip(upper, self.min, self.max)
+
+    def get_percentiles(self, percentiles=(50, 90, 99)):
+        """
+        Estimate percentiles of the samples counted so far.
+
+        :param percentiles: Percentiles (0-100)
+        :return: List of currents in microamperes, None for each if there are no samples
+        """
+        with self._lock:
+            counts = self.counts.copy()
+            total = int(counts.sum())
+            if total == 0:
+                return [None] * len(percentiles)
+            lower, upper = self.__bucket_bounds()
+        cumulative = np.cumsum(counts)
+        result = []
+        for p in percentiles:
+            rank = min(max(float(p), 0.0), 100.0) / 100 * total
+            i = min(int(np.searchsorted(cumulative, rank, side='left')), len(counts) - 1)
+            # Interpolate within the bucket, geometrically where the bucket is logarithmic
+            fraction = (rank - (cumulative[i] - counts[i])) / counts[i] if counts[i] else 0.0
+            lo, hi = lower[i], upper[i]
+            if 0 < i <= self.buckets and lo > 0:
+                value = lo * (hi / lo) ** fraction
+            else:
+                value = lo + (hi - lo) * fraction
+            result.append(float(value))
+        return result
+
+    def get_histogram(self, bins: int = 50, log_scale: bool = True):
+        """
+        Histogram of the samples counted so far between the observed minimum
+        and maximum, built from the buckets (each bucket is assigned to the
+        bin holding its center).
+
+        :param bins: Number of bins
+        :param log_scale: Logarithmically spaced bins (for currents spanning
+            several decades), otherwise linear
+        :return: Dictionary with the bin edges (bins + 1 values, uA), counts
+            and time_s (time spent in each bin at the PPK2 sample rate)
+        """
+        bins = max(1, int(bins))
+        with self._lock:
+            counts = self.counts.copy()
+            if int(counts.sum()) == 0:
+                return {'edges': [], 'counts': [], 'time_s': []}
+            lower, upper = self.__bucket_bounds()
+            low, high = self.min, self.max
+        if log_scale:
+            low = max(low, self.min_value)
+            high = max(high, low)
+            edges = np.geomspace(low, high, bins + 1) if high > low else np.full(bins + 1, low)
+            centers = np.sqrt(np.maximum(lower, self.min_value) * np.maximum(upper, self.min_value))
+        else:
+            edges = np.linspace(low, high, bins + 1)
+            centers = (lower + upper) / 2
+        index = np.clip(np.searchsorted(edges, centers, side='right') - 1, 0, bins - 1)
+        binned = np.bincount(index, weights=counts, minlength=bins).astype(np.int64)
+        return {'edges': edges.tolist(), 'counts': binned.tolist(), 'time_s': (binned / SAMPLE_RATE).tolist()}
@@ -0,0 +1,234 @@
+import multiprocessing
+import signal
+import threading
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import ppk_daemon
+import ppk_fleet
+
+# Layout of the shared statistics block of each worker (float64 values).
+# 'sequence' is odd while the worker is updating the block.
+STATS_FIELDS = ('sequence', 'heartbeat', 'pid', 'measuring', 'count', 'min', 'max', 'mean', 'std', 'duration_s')
+STATS_SIZE = len(STATS_FIELDS) * 8
+
+class SharedStats:
+    """
+    Statistics of one power profiler in shared memory, written by the worker
+    process and read by the supervisor without any IPC round trip.
+
+    :param name: Shared memory block name, None to create a new block
+    """
+    def __init__(self, name: str = None):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=STATS_SIZE)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.owner = False
+        self.values = np.ndarray((len(STATS_FIELDS),), dtype=np.float64, buffer=self.shm.buf)
+        if self.owner:
+            self.values[:] = 0
+        self._last = None
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def write(self, **fields):
+        """
+        Update fields, e.g. write(count=10, mean=1.5).
+        """
+        self.values[0] += 1
+        for key, value in fields.items():
+            self.values[STATS_FIELDS.index(key)] = value
+        self.values[0] += 1
+
+    def read(self, retries: int = 100):
+        """
+        :param retries: Attempts while the block is being updated. A worker
+            killed in the middle of an update leaves it that way forever.
+        :return: Consistent snapshot of the fields as a dictionary, the last
+            consistent snapshot (or None) if none could be read
+        """
+        for _ in range(retries):
+            sequence = self.values[0]
+            snapshot = self.values.copy()
+            if sequence % 2 == 0 and self.values[0] == sequence:
+                self._last = dict(zip(STATS_FIELDS[1:], snapshot[1:].tolist()))
+                return self._last
+            time.sleep(0.001)
+        return self._last
+
+    def clear(self):
+        """
+        Reset all fields, e.g. after the worker writing them was killed.
+        """
+        self.values[:] = 0
+        self._last = None
+
+    def close(self):
+        """
+        Detach from (and remove, if created here) the shared memory block.
+        """
+        self.values = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+def _worker_main(config: dict, stats_name: str, stats_interval: float):
+    """
+    Worker process: run one power profiler server and publish its statistics.
+    """
+    def terminate(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, terminate)
+
+    server, pp = ppk_daemon.start_server(config)
+    if server is None:
+        raise SystemExit(1)
+    stats = SharedStats(stats_name)
+    try:
+        while True:
+            s = pp.get_stats()
+            stats.write(heartbeat=time.time(), pid=multiprocessing.current_process().pid,
+                        measuring=pp.measuring, count=s['count'], min=s['min'], max=s['max'],
+                        mean=s['mean'], std=s['std'], duration_s=s['duration_s'])
+            time.sleep(stats_interval)
+    finally:
+        server.shutdown()
+        server.server_close()
+        pp.close()
+        stats.close()
+
+class _Worker:
+    def __init__(self, config: dict):
+        self.config = config
+        self.stats = SharedStats()
+        self.process = None
+        self.started = 0
+        self.restarts = 0
+        self.restart_at = 0
+        self.backoff = 0
+
+class PPKSupervisor:
+    """
+    Run each power profiler server in its own process.
+
+    Decoding PPK2 samples is CPU bound, so running all power profilers in one
+    process lets them starve each other. Each worker process serves its own
+    TCP port exactly like start_server() and publishes its statistics to a
+    shared memory block. Workers that exit or stop updating their heartbeat
+    are restarted, with an increasing delay if they keep failing.
+
+    :param configs: List of power profiler configurations (see ppk_daemon.start_server)
+    :param restart_delay: Delay in seconds before the first restart of a failed worker
+    :param max_restart_delay: Maximum delay between restarts
+    :param heartbeat_timeout: Seconds without a statistics update before a worker is restarted
+    :param status_port: TCP port for status requests (see status()), None for no status server
+    """
+    STATS_INTERVAL = 0.5
+    STABLE_TIME = 60.0
+
+    def __init__(self, configs: list, restart_delay: float = 2.0, max_restart_delay: float = 60.0,
+                 heartbeat_timeout: float = 10.0, status_port: int = None):
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.heartbeat_timeout = heartbeat_timeout
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = [_Worker(config) for config in configs]
+        self._stop = threading.Event()
+        self.status_port = status_port
+        self._monitor = None
+        self._status_server = None
+
+    def start(self):
+        """
+        Start all workers, the monitor thread and the status server.
+        """
+        for worker in self._workers:
+            self.__start_worker(worker)
+        self._monitor = threading.Thread(target=self.__monitor_thread, daemon=True)
+        self._monitor.start()
+        if self.status_port is not None:
+            self._status_server = ppk_fleet.StatusServer(('localhost', self.status_port), self)
+            threading.Thread(target=self._status_server.serve_forever, daemon=True).start()
+            print(f"Supervisor status server on localhost:{self.status_port}")
+
+    def stop(self, timeout: float = 5.0):
+        """
+        Stop the status server and all workers.
+        """
+        self._stop.set()
+        if self._monitor:
+            self._monitor.join()
+        if self._status_server:
+            self._status_server.shutdown()
+            self._status_server.server_close()
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.kill()
+                    worker.process.join()
+            worker.stats.close()
+
+    def status(self):
+        """
+        Get the state and statistics of every worker.
+
+        :return: List of dictionaries with sn, tcp_port, alive, restarts and
+            the latest shared statistics (count, min, max, mean, std in uA)
+        """
+        result = []
+        for worker in self._workers:
+            entry = {
+                'sn': worker.config.get('sn'),
+                'tcp_port': worker.config.get('tcp_port', 5678),
+                'alive': worker.process is not None and worker.process.is_alive(),
+                'restarts': worker.restarts,
+            }
+            entry.update(worker.stats.read() or {})
+            result.append(entry)
+        return result
+
+    def __start_worker(self, worker: _Worker):
+        # A killed worker may have left the block mid-update
+        worker.stats.clear()
+        worker.process = self._context.Process(target=_worker_main,
+                                               args=(worker.config, worker.stats.name, self.STATS_INTERVAL),
+                                               daemon=True)
+        worker.process.start()
+        worker.started = time.time()
+
+    def __monitor_thread(self):
+        while not self._stop.wait(self.STATS_INTERVAL):
+            now = time.time()
+            for worker in self._workers:
+                process = worker.process
+                if process.is_alive():
+                    # A worker that never reported gets the timeout from its start
+                    snapshot = worker.stats.read()
+                    heartbeat = snapshot['heartbeat'] if snapshot else 0
+                    last = heartbeat if heartbeat else worker.started
+                    if now - last < self.heartbeat_timeout:
+                        if now - worker.started > self.STABLE_TIME:
+                            worker.backoff = 0
+                        continue
+                    print(f"{worker.config.get('sn')}: PPK worker not responding, restarting")
+                    process.kill()
+                    process.join()
+                if worker.restart_at == 0:
+                    worker.stats.clear()
+                    worker.backoff = min(self.max_restart_delay,
+                                         worker.backoff * 2 if worker.backoff else self.restart_delay)
+                    worker.restart_at = now + worker.backoff
+                    print(f"{worker.config.get('sn')}: PPK worker exited ({process.exitcode}), "
+                          f"restarting in {worker.backoff:.1f} s")
+                elif now >= worker.restart_at:
+                    worker.restart_at = 0
+                    worker.restarts += 1
+                    self.__start_worker(worker)
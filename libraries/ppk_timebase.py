@@ -0,0 +1,113 @@
+import threading
+import numpy as np
+from ppk_stats import SAMPLE_RATE
+
+class SampleClock:
+    """
+    Relation between sample indexes of a capture and the host monotonic clock.
+
+    Each block of samples read from the PPK2 is recorded with the host time
+    (time.monotonic()) at which it was read. USB transfers and scheduling only
+    ever delay a block, so the clock is fitted to the lower envelope of the
+    records: the sample rate (the PPK2 sample clock relative to the host
+    clock) is the slope of a least squares line through the least delayed
+    record of each of FIT_SECTIONS sections of the capture, and the line is
+    shifted down to the least delayed record overall.
+
+    Records closer than min_interval are skipped. When max_records is
+    reached every other record is dropped and min_interval at least doubled, so the
+    whole capture stays covered with bounded memory.
+
+    :param max_records: Maximum number of records kept
+    :param min_interval: Initial minimum host time between records, in seconds
+    """
+    FIT_SECTIONS = 32
+
+    def __init__(self, max_records: int = 1 << 14, min_interval: float = 0.01):
+        self.max_records = max_records
+        self.initial_interval = min_interval
+        self.lock = threading.Lock()
+        self._index = np.empty(max_records, dtype=np.float64)
+        self._time = np.empty(max_records, dtype=np.float64)
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all records, e.g. when a new capture starts.
+        """
+        with self.lock:
+            self.records = 0
+            self.min_interval = self.initial_interval
+            self._fit = None
+
+    def add(self, sample_index: int, timestamp: float):
+        """
+        Record the host time at which a sample was received.
+
+        :param sample_index: Index of the sample following the block just read
+        :param timestamp: Host time.monotonic() when the block was read
+        """
+        with self.lock:
+            if self.records and timestamp - self._time[self.records - 1] < self.min_interval:
+                return
+            if self.records == self.max_records:
+                half = (self.records + 1) // 2
+                self._index[:half] = self._index[0:self.records:2]
+                self._time[:half] = self._time[0:self.records:2]
+                self.records = half
+                self.min_interval = max(self.min_interval * 2, (timestamp - self._time[0]) / half)
+            self._index[self.records] = sample_index
+            self._time[self.records] = timestamp
+            self.records += 1
+            self._fit = None
+
+    def fit(self):
+        """
+        Estimate the host time of the first sample and the sample rate.
+
+        :return: Dictionary with t0 (host monotonic time of sample 0),
+            sample_rate (samples per host second), jitter_s (standard
+            deviation of the read delays) and records, or None without records
+        """
+        with self.lock:
+            if self._fit is not None or self.records == 0:
+                return self._fit
+            index = self._index[:self.records]
+            times = self._time[:self.records]
+            rate = SAMPLE_RATE
+            if self.records > 1 and index[-1] > index[0]:
+                # The least delayed record of each section of the capture
+                delays = times - index / SAMPLE_RATE
+                sections = np.array_split(np.arange(self.records), min(self.records, self.FIT_SECTIONS))
+                best = np.array([section[np.argmin(delays[section])] for section in sections])
+                x, y = index[best], times[best]
+                x_mean = x.mean()
+                denominator = np.sum((x - x_mean) ** 2)
+                slope = np.dot(x - x_mean, y - y.mean()) / denominator if denominator else 0
+                if slope > 0:
+                    rate = 1 / slope
+            delays = times - index / rate
+            t0 = float(delays.min())
+            self._fit = {'t0': t0, 'sample_rate': float(rate), 'jitter_s': float(np.std(delays - t0)),
+                         'records': self.records}
+            return self._fit
+
+    def sample_to_time(self, sample_index):
+        """
+        :return: Host monotonic time of a sample index (or array of indexes),
+            None without records
+        """
+        fit = self.fit()
+        if fit is None:
+            return None
+        return fit['t0'] + np.asarray(sample_index, dtype=np.float64) / fit['sample_rate']
+
+    def time_to_sample(self, timestamp):
+        """
+        :return: Sample index (float) at a host monotonic time (or array of
+            times), None without records
+        """
+        fit = self.fit()
+        if fit is None:
+            return None
+        return (np.asarray(timestamp, dtype=np.float64) - fit['t0']) * fit['sample_rate']
@@ -207,6 +207,13 @@ def program_boards(test: bool, config_file: str, images: str, binary_base: str,
     with open(config_file, 'r') as stream:
         config = yaml.safe_load(stream)
 
+    # Index each image directory once, on first use, for all boards
+    file_indexes = {}
+    def find_image_file(base: str, image_type: str, image_name: str):
+        if base not in file_indexes:
+            file_indexes[base] = board_config_util.FileIndex(base)
+        return board_config_util.find_image_file(config, base, image_type, image_name, file_indexes[base])
+
     # Loop to program each board in the list
     for board in config['boards']:
         logger.debug("Programming board {}".format(board['name']))
@@ -270,9 +277,9 @@ def program_boards(test: bool, config_file: str, images: str, binary_base: str,
                 # 1. The current build under test
                 # 2. The released build
                 # 3. Download the image from a URL
-                files = board_config_util.find_image_file(config, binary_base, image_type, image_name)
+                files = find_image_file(binary_base, image_type, image_name)
                 if files is None:
-                    files = board_config_util.find_image_file(config, release_base, image_type, image_name)
+                    files = find_image_file(release_base, image_type, image_name)
                 if files is None:
                     files = download_image_file(config, tmp_dir, image_type, image_name)
                 if files is None:
@@ -11,9 +11,26 @@ from typing import List, Dict, Any, Set, FrozenSet, Tuple
 import board_config_util
 import binascii
 import hashlib
+import json
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 DEFAULT_CONFIG_FILE = "board_config.yml"
 
+# On-disk cache of OTA file digests, see sha256sum_many(). The digests are
+# trusted, so the cache lives in the per-user cache directory.
+DIGEST_CACHE_ENV = 'BOARD_DIGEST_CACHE'
+DEFAULT_DIGEST_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                    'board_config', 'sha256.json')
+DIGEST_CACHE_VERSION = 1
+HASH_BUFFER_SIZE = 1 << 20
+HASH_THREADS = min(8, os.cpu_count() or 1)
+
+_digest_cache = {}
+_digest_cache_path = None
+_digest_cache_lock = threading.Lock()
+
 
 class InvalidPropertyError(Exception):
     pass
@@ -188,11 +205,123 @@ def sha256sum(filename: str) -> bytes:
     :returns: The SHA256 hash of the file as bytes.
     """
     sha256 = hashlib.sha256()
-    with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            sha256.update(chunk)
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(filename, "rb", buffering=0) as f:
+        # hashlib releases the GIL for large updates, so files hash in parallel threads
+        for n in iter(lambda: f.readinto(buffer), 0):
+            sha256.update(view[:n])
     return sha256.digest()
 
+def _file_key(st: os.stat_result) -> list:
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+def _owned_by_user(path: str) -> bool:
+    """
+    Check that a file is missing or owned by the current user, so digests
+    planted by another user are never trusted.
+    """
+    if not hasattr(os, 'getuid'):
+        return True
+    try:
+        return os.stat(path).st_uid == os.getuid()
+    except FileNotFoundError:
+        return True
+    except OSError:
+        return False
+
+def _load_digest_cache(cache_path: str) -> dict:
+    """
+    Load the digest cache file, an empty cache if it is missing, invalid or
+    not owned by the current user.
+    """
+    if not _owned_by_user(cache_path):
+        logging.warning(f"Ignoring digest cache {cache_path} owned by another user")
+        return {}
+    try:
+        with open(cache_path, 'r') as f:
+            data = json.load(f)
+        if data.get('version') == DIGEST_CACHE_VERSION and isinstance(data.get('files'), dict):
+            return data['files']
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {}
+
+def _save_digest_cache(cache_path: str, files: dict):
+    """
+    Write the digest cache file. A temporary file is renamed over the cache so
+    other processes never read a partial file.
+    """
+    cache_dir = os.path.dirname(cache_path) or '.'
+    if not _owned_by_user(cache_path):
+        return
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    except OSError as e:
+        logging.warning(f"Unable to write digest cache {cache_path}: {e}")
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'version': DIGEST_CACHE_VERSION, 'files': files}, f)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        logging.warning(f"Unable to write digest cache {cache_path}: {e}")
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+def sha256sum_many(filenames: List[str], cache_path: str = None) -> Dict[str, bytes]:
+    """
+    Calculate the SHA256 hashes of many files, reusing the digests of files
+    that have not changed since they were last hashed.
+
+    Digests are cached on disk keyed by the absolute path, size, modification
+    time (ns) and inode of each file, so a repeated call only costs a stat()
+    per file. Files not in the cache are hashed in parallel threads.
+
+    :param filenames: The paths of the files to hash.
+    :param cache_path: The digest cache file. Defaults to the BOARD_DIGEST_CACHE
+        environment variable or board_config/sha256.json in the user's cache
+        directory. A cache file owned by another user is ignored.
+    :returns: A dictionary of the SHA256 hash (bytes) of each file name.
+    """
+    global _digest_cache, _digest_cache_path
+    if cache_path is None:
+        cache_path = os.environ.get(DIGEST_CACHE_ENV, DEFAULT_DIGEST_CACHE)
+
+    with _digest_cache_lock:
+        if cache_path != _digest_cache_path:
+            _digest_cache = _load_digest_cache(cache_path)
+            _digest_cache_path = cache_path
+        cache = _digest_cache
+
+        digests = {}
+        misses = {}
+        for filename in dict.fromkeys(filenames):
+            path = os.path.abspath(filename)
+            key = _file_key(os.stat(path))
+            entry = cache.get(path)
+            if entry is not None and entry[:3] == key:
+                digests[filename] = binascii.unhexlify(entry[3])
+            else:
+                misses[filename] = (path, key)
+
+        if misses:
+            logging.info(f"Hashing {len(misses)} of {len(digests) + len(misses)} files")
+            with ThreadPoolExecutor(max_workers=HASH_THREADS) as pool:
+                hashed = pool.map(sha256sum, [path for path, _ in misses.values()])
+                for (filename, (path, key)), digest in zip(misses.items(), hashed):
+                    digests[filename] = digest
+                    cache[path] = key + [binascii.hexlify(digest).decode('ascii')]
+            # Drop entries of files that no longer exist before saving
+            for path in [path for path in cache if not os.path.exists(path)]:
+                del cache[path]
+            _save_digest_cache(cache_path, cache)
+
+    return digests
+
 def load_board_file(file_path: str, binary_base: str = "", image_list: str = "") -> dict:
     """
     Load a board configuration file and return its content.
@@ -223,6 +352,9 @@ def load_board_file(file_path: str, binary_base: str = "", image_list: str = "")
         except yaml.YAMLError as e:
             raise ValueError(f"Error parsing YAML file '{file_path}': {e}")
 
+    # Index the build artifacts once for all boards
+    file_index = board_config_util.FileIndex(binary_base)
+
     # For each board in the configuration, build the list of image files for the board
     for board in config['boards']:
         board['ota_files'] = []
@@ -247,11 +379,12 @@ def load_board_file(file_path: str, binary_base: str = "", image_list: str = "")
                 image_list.remove(image_name)
 
             # Get the list of image files for this image type and name
-            files = board_config_util.find_image_file(config, binary_base, image_type, image_name)
+            files = board_config_util.find_image_file(config, binary_base, image_type, image_name, file_index)
 
             # For each file found, use the path to search for OTA image files
             if files is None or 'ota_pattern' not in config['images'][image_type]:
                 continue
+            ota_pattern = re.compile(config['images'][image_type]['ota_pattern'])
             for file in files:
                 # Grab the end of the path to use as a place to start searching
                 # NOTE: This assumes a specific directory structure, which includes at the
@@ -259,28 +392,25 @@ def load_board_file(file_path: str, binary_base: str = "", image_list: str = "")
                 file_path_parts = os.path.normpath(file[0]).split(os.path.sep)[-5:-1]
                 file_path = os.path.join(*file_path_parts)
                 logging.info(f"Searching for OTA files in {file_path} for {file[0]}")
-                possible_dirs = []
-                for root, dirs, _ in os.walk(binary_base):
-                    for d in dirs:
-                        # Check if the directory name matches the current file path
-                        this_dir = os.path.join(root, d)
-                        logging.info(f"Checking directory: {this_dir}")
-                        if this_dir.endswith(file_path):
-                            possible_dirs.append(this_dir)
+
+                # Directories under binary_base whose path ends with the same components
+                possible_dirs = file_index.dirs_ending_with(file_path_parts)
 
                 # If we found any directories, add the files to the board's OTA files
                 if possible_dirs:
                     logging.info(f"Found {len(possible_dirs)} directories for {file_path}")
                     for d in possible_dirs:
+                        logging.debug(f"Checking directory: {d}")
                         # Search for all files in the directory that match the file name
-                        for dirpath, _, filenames in os.walk(d):
-                            for f in filenames:
-                                match = re.match(config['images'][image_type]['ota_pattern'], f)
-                                if match:
-                                    # Store the full path to the file and the sha256 hash in a tuple
-                                    file_path = os.path.join(dirpath, f)
-                                    sha256_hash = sha256sum(file_path)
-                                    board['ota_files'].append((file_path, sha256_hash))
+                        for ota_path in file_index.files_under(d):
+                            if ota_pattern.match(os.path.basename(ota_path)):
+                                board['ota_files'].append(ota_path)
+
+    # Store the full path to each file and the sha256 hash in a tuple, hashing
+    # all of the files together so unchanged files come from the digest cache
+    digests = sha256sum_many([f for board in config['boards'] for f in board['ota_files']])
+    for board in config['boards']:
+        board['ota_files'] = [(f, digests[f]) for f in board['ota_files']]
 
     return config
 